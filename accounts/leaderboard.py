@@ -0,0 +1,359 @@
+"""Leaderboards
+
+Ranks users by coins, collection size and collection value (see
+``User.card_count`` and ``User.market_value``). Each ranking is an
+indexable skiplist in memory, so the top N and any user's rank are
+found in O(log n) without touching the database.
+
+Rankings are built on the first lookup and kept up to date by user
+saves and collection statistic changes in this process. They are
+rebuilt when the leaderboard generation changes (bulk updates such as
+``update_interest`` bump it) and every
+``POKETRADE_LEADERBOARD_REBUILD_SECONDS``, to pick up changes made by
+other processes.
+"""
+
+__all__ = ["IndexableSkiplist", "Leaderboard", "LEADERBOARDS", "BOARDS",
+           "leaderboard_generation", "bump_leaderboard_generation"]
+__author__ = "Advaith Menon"
+
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import User, collection_stats_changed
+
+
+# Rankings -> the User field ranked, highest first.
+BOARDS = {"coins": "coins", "cards": "card_count",
+          "value": "market_value"}
+
+# Cache key of the leaderboard generation.
+GENERATION_KEY = "accounts:leaderboard_generation"
+
+
+def leaderboard_generation():
+    """Get the leaderboard generation.
+
+    Processes rebuild their rankings when it changes.
+
+    :rtype: int
+    """
+    return cache.get_or_set(GENERATION_KEY, time.time_ns(), None)
+
+
+def bump_leaderboard_generation():
+    """Make every process rebuild its rankings.
+
+    Call it after changing coins or collection statistics in bulk.
+    """
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # evicted
+        cache.set(GENERATION_KEY, time.time_ns(), None)
+
+
+class _Node(object):
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        # the number of bottom level steps to next
+        self.width = [1] * levels
+
+
+class IndexableSkiplist(object):
+    """A sorted list with O(log n) insertion, removal, rank and index.
+
+    Keys must be unique and comparable.
+    """
+    MAX_LEVELS = 24
+
+    def __init__(self, seed=None):
+        self._head = _Node(None, self.MAX_LEVELS)
+        self._size = 0
+        self._random = random.Random(seed)
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def from_sorted(cls, keys, seed=None):
+        """Build a list from sorted keys in O(n).
+
+        Levels are assigned by position (every second key on level 2,
+        every fourth on level 3...) rather than at random.
+        """
+        rv = cls(seed)
+        last = [rv._head] * cls.MAX_LEVELS
+        pos = [0] * cls.MAX_LEVELS
+        at = 0
+        for at, key in enumerate(keys, 1):
+            levels = min((at & -at).bit_length(), cls.MAX_LEVELS)
+            node = _Node(key, levels)
+            for lvl in range(levels):
+                last[lvl].next[lvl] = node
+                last[lvl].width[lvl] = at - pos[lvl]
+                last[lvl], pos[lvl] = node, at
+        for lvl in range(cls.MAX_LEVELS):
+            last[lvl].width[lvl] = at + 1 - pos[lvl]
+        rv._size = at
+        return rv
+
+    def _chain(self, key):
+        """Find the last node before key at every level, and its
+        position (the head is 0)."""
+        chain = [None] * self.MAX_LEVELS
+        pos = [0] * self.MAX_LEVELS
+        node, steps = self._head, 0
+        for lvl in reversed(range(self.MAX_LEVELS)):
+            while node.next[lvl] is not None and node.next[lvl].key < key:
+                steps += node.width[lvl]
+                node = node.next[lvl]
+            chain[lvl], pos[lvl] = node, steps
+        return chain, pos
+
+    def insert(self, key):
+        """Add a key."""
+        chain, pos = self._chain(key)
+        levels = 1
+        while levels < self.MAX_LEVELS and self._random.random() < 0.5:
+            levels += 1
+        new = _Node(key, levels)
+        at = pos[0] + 1
+        for lvl in range(levels):
+            prev = chain[lvl]
+            new.next[lvl] = prev.next[lvl]
+            new.width[lvl] = prev.width[lvl] - (at - pos[lvl]) + 1
+            prev.next[lvl] = new
+            prev.width[lvl] = at - pos[lvl]
+        for lvl in range(levels, self.MAX_LEVELS):
+            chain[lvl].width[lvl] += 1
+        self._size += 1
+
+    def remove(self, key):
+        """Remove a key.
+
+        :raises KeyError: If it is not in the list
+        """
+        chain, _ = self._chain(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for lvl in range(self.MAX_LEVELS):
+            prev = chain[lvl]
+            if prev.next[lvl] is node:
+                prev.width[lvl] += node.width[lvl] - 1
+                prev.next[lvl] = node.next[lvl]
+            else:
+                prev.width[lvl] -= 1
+        self._size -= 1
+
+    def rank(self, key):
+        """Get the index of a key.
+
+        :rtype: int
+        :raises KeyError: If it is not in the list
+        """
+        chain, pos = self._chain(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        return pos[0]
+
+    def islice(self, start, stop):
+        """Iterate over the keys from index start to stop."""
+        if start < 0 or start >= self._size:
+            return
+        node, steps = self._head, 0
+        for lvl in reversed(range(self.MAX_LEVELS)):
+            while (node.next[lvl] is not None
+                   and steps + node.width[lvl] <= start + 1):
+                steps += node.width[lvl]
+                node = node.next[lvl]
+        for _ in range(start, min(stop, self._size)):
+            yield node.key
+            node = node.next[0]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._size
+        for key in self.islice(i, i + 1):
+            return key
+        raise IndexError(i)
+
+    def __iter__(self):
+        return self.islice(0, self._size)
+
+
+class Leaderboard(object):
+    """Users ranked by a score, highest first, ties by id."""
+    def __init__(self):
+        self._list = IndexableSkiplist()
+        self._scores = dict()
+
+    def __len__(self):
+        return len(self._scores)
+
+    @classmethod
+    def load(cls, scores):
+        """Build a ranking at once.
+
+        :param scores: user id -> score
+        :type scores: dict
+        """
+        rv = cls()
+        rv._scores = scores
+        rv._list = IndexableSkiplist.from_sorted(
+                sorted((-score, pk) for pk, score in scores.items()))
+        return rv
+
+    def set(self, pk, score):
+        """Set the score of a user, adding them if needed."""
+        old = self._scores.get(pk)
+        if old == score:
+            return
+        if old is not None:
+            self._list.remove((-old, pk))
+        self._scores[pk] = score
+        self._list.insert((-score, pk))
+
+    def add(self, pk, delta):
+        """Add to the score of a user already ranked."""
+        if pk in self._scores:
+            self.set(pk, self._scores[pk] + delta)
+
+    def discard(self, pk):
+        """Remove a user, if ranked."""
+        old = self._scores.pop(pk, None)
+        if old is not None:
+            self._list.remove((-old, pk))
+
+    def top(self, n, offset=0):
+        """Get the users ranked from offset + 1 to offset + n.
+
+        :return: A list of (user id, score) tuples
+        :rtype: list
+        """
+        return [(pk, -score) for score, pk
+                in self._list.islice(offset, offset + n)]
+
+    def rank(self, pk):
+        """Get the rank (from 1) of a user.
+
+        :return: A tuple of (rank, score), or None if not ranked
+        :rtype: tuple
+        """
+        score = self._scores.get(pk)
+        if score is None:
+            return None
+        return self._list.rank((-score, pk)) + 1, score
+
+
+class Leaderboards(object):
+    """Every ranking of this process, and the usernames shown."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.boards = {name: Leaderboard() for name in BOARDS}
+        self.names = dict()
+        self.built_at = None
+        self.generation = None
+
+    def build(self):
+        """Rebuild from the database."""
+        generation = leaderboard_generation()
+        scores = {name: dict() for name in BOARDS}
+        names = dict()
+        for pk, username, *row in User.objects.values_list(
+                "pk", "username", *BOARDS.values()).iterator():
+            names[pk] = username
+            for name, score in zip(BOARDS, row):
+                scores[name][pk] = score
+        boards = {name: Leaderboard.load(x) for name, x in scores.items()}
+        with self.lock:
+            self.boards = boards
+            self.names = names
+            self.built_at = time.monotonic()
+            self.generation = generation
+
+    def _maybe_build(self):
+        if (self.built_at is None
+                or self.generation != leaderboard_generation()
+                or time.monotonic() - self.built_at
+                >= settings.POKETRADE_LEADERBOARD_REBUILD_SECONDS):
+            self.build()
+
+    def top(self, board, n, offset=0):
+        """Get the best users of a ranking.
+
+        :param board: The ranking, one of ``BOARDS``
+        :type board: str
+        :param n: The number of users
+        :type n: int
+        :param offset: The number of users to skip
+        :type offset: int
+        :return: A list of (rank, user id, username, score) tuples
+        :rtype: list
+        """
+        self._maybe_build()
+        with self.lock:
+            return [(offset + i, pk, self.names.get(pk), score)
+                    for i, (pk, score) in enumerate(
+                        self.boards[board].top(n, offset), 1)]
+
+    def rank(self, board, pk):
+        """Get the rank of a user.
+
+        :return: A tuple of (rank, score), or None if not ranked
+        :rtype: tuple
+        """
+        self._maybe_build()
+        with self.lock:
+            return self.boards[board].rank(pk)
+
+    def __len__(self):
+        return len(self.names)
+
+
+# The leaderboards of this process.
+LEADERBOARDS = Leaderboards()
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or LEADERBOARDS.built_at is None:
+        # fixtures, or nothing to update yet
+        return
+    with LEADERBOARDS.lock:
+        LEADERBOARDS.names[instance.pk] = instance.username
+        LEADERBOARDS.boards["coins"].set(instance.pk, instance.coins)
+        if created:
+            for name, field in BOARDS.items():
+                LEADERBOARDS.boards[name].set(instance.pk,
+                                              getattr(instance, field))
+
+
+@receiver(post_delete, sender=User)
+def _user_deleted(sender, instance, **kwargs):
+    with LEADERBOARDS.lock:
+        LEADERBOARDS.names.pop(instance.pk, None)
+        for board in LEADERBOARDS.boards.values():
+            board.discard(instance.pk)
+
+
+@receiver(collection_stats_changed)
+def _stats_changed(sender, deltas, **kwargs):
+    if LEADERBOARDS.built_at is None:
+        return
+    with LEADERBOARDS.lock:
+        for pk, delta in deltas.items():
+            for name, field in BOARDS.items():
+                if delta.get(field):
+                    LEADERBOARDS.boards[name].add(pk, delta[field])
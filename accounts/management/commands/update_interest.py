@@ -8,6 +8,8 @@ __author__ = "Advaith Menon"
 
 from django.core.management.base import BaseCommand
 from django.db.models import F
+from django.utils import timezone
+from accounts.leaderboard import bump_leaderboard_generation
 from accounts.models import User
 
 
@@ -25,6 +27,10 @@ class Command(BaseCommand):
 
         Refer to Django Docs to learn more about this class.
         """
+        # update() skips save(), so bump the row versions ourselves
         User.objects.all().update(coins=(options["interest_value"] + 1) \
-                * F("coins"))
+                * F("coins"), version=F("version") + 1,
+                updated_at=timezone.now())
+        # every balance changed - rebuild the rankings
+        bump_leaderboard_generation()
 
@@ -0,0 +1,55 @@
+# Generated by Django 5.2 on 2026-10-19 13:03
+
+from django.db import migrations, models
+from django.db.models import Case, Count, F, Q, Sum, When
+
+
+def compute_stats(apps, schema_editor):
+    # see trading.models.rebuild_collection_stats
+    User = apps.get_model("accounts", "User")
+    Pokemon = apps.get_model("trading", "Pokemon")
+    stats = Pokemon.objects.filter(owner__isnull=False).order_by() \
+            .values("owner").annotate(
+                card_count=Count("pk"),
+                cost_basis=Sum("cost_price"),
+                market_value=Sum(Case(When(trend_price__gt=0,
+                                           then=F("trend_price")),
+                                      default=F("suggested_price"))),
+                listed_count=Count("pk", filter=Q(sell_price__gt=0)))
+    fields = ["card_count", "cost_basis", "market_value", "listed_count"]
+    User.objects.bulk_update(
+            (User(pk=x["owner"], **{f: x[f] for f in fields})
+             for x in stats.iterator()),
+            fields, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_user_version_updated_at'),
+        ('trading', '0014_collectionchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='card_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='cost_basis',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='listed_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='market_value',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.RunPython(compute_stats, migrations.RunPython.noop),
+    ]
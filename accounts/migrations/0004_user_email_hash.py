@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-19 13:20
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_emails(apps, schema_editor):
+    # see User.save
+    User = apps.get_model("accounts", "User")
+    users = list()
+    for user in User.objects.only("pk", "email", "username").iterator():
+        email = user.email or "%s@example.org" % user.username
+        user.email_hash = hashlib.sha256(email.encode()).hexdigest()
+        users.append(user)
+    User.objects.bulk_update(users, ["email_hash"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_user_collection_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='email_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(hash_emails, migrations.RunPython.noop),
+    ]
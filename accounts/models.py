@@ -19,14 +19,51 @@ By putting fields along with the User object, querying becomes faster
 and the database is free to do more work.
 """
 
-__all__ = ["User"]
+__all__ = ["User", "collection_stats_changed", "gravatar_url"]
 __author__ = "Advaith Menon"
 
+import functools
 import hashlib
 from urllib.parse import urlencode
 
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models import Case, F, Value, When
+from django.dispatch import Signal
+from django.utils import timezone
+
+
+# Sent by User.add_stats with the deltas added.
+collection_stats_changed = Signal()
+
+# The email hashed for users without one.
+DEFAULT_GRAVATAR_EMAIL = "{username}@example.org"
+
+
+def _hash_email(email, username, first, last, default):
+    email = email or default.format(username=username, first=first,
+                                    last=last)
+    return hashlib.sha256(email.encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=4096)
+def gravatar_url(email_hash, size=40, fallback="wavatar", name=" "):
+    """Make a Gravatar URL.
+
+    Memoized - pages show the same few users at the same few sizes.
+
+    :param email_hash: The SHA-256 of the email
+    :type email_hash: str
+    :param size: The size of the image
+    :type size: int
+    :param fallback: The fallback avatar to use
+    :type fallback: str
+    :param name: The user's full name
+    :type name: str
+    :rtype: str
+    """
+    param = urlencode({"d": fallback, "s": str(size), "name": name})
+    return "https://www.gravatar.com/avatar/{}?{}".format(email_hash, param)
 
 
 class User(AbstractUser):
@@ -42,6 +79,86 @@ class User(AbstractUser):
     # The user's streak
     streak = models.IntegerField(default=0)
 
+    # Row version and modification time, bumped on every save. Used to
+    # answer conditional GETs on the profile page without rendering.
+    # NOTE: QuerySet.update() does not call save() - bump these by hand.
+    version = models.PositiveIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    # Collection statistics, so profiles need no aggregates: the number
+    # of cards owned, what was paid for them, what they are worth
+    # (trend price, or suggested price) and how many are for sale.
+    # Kept up to date by Pokemon.save and Pokemon.delete with F()
+    # deltas; see add_stats.
+    # NOTE: bulk operations skip them - run manage.py rebuildstats.
+    card_count = models.IntegerField(default=0, editable=False)
+    cost_basis = models.FloatField(default=0, editable=False)
+    market_value = models.FloatField(default=0, editable=False)
+    listed_count = models.IntegerField(default=0, editable=False)
+
+    STAT_FIELDS = ("card_count", "cost_basis", "market_value",
+                   "listed_count")
+
+    # SHA-256 of the email Gravatar is asked for (see gravatar), so
+    # avatars need no hashing at render time. Refreshed by save.
+    email_hash = models.CharField(max_length=64, default="", blank=True,
+                                  editable=False)
+
+    # Fields the Gravatar email depends on.
+    GRAVATAR_FIELDS = ("email", "username", "first_name", "last_name")
+
+    def save(self, *args, **kwargs):
+        """Save the User, bumping its row version and hashing its
+        Gravatar email.
+
+        Saves of existing users never write the collection statistics,
+        which may have changed since the user was loaded.
+        """
+        self.version = (self.version or 0) + 1
+        update_fields = kwargs.get("update_fields")
+        hashed = update_fields is None \
+                or not set(update_fields).isdisjoint(self.GRAVATAR_FIELDS)
+        if hashed:
+            self.refresh_email_hash()
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "version",
+                                       "updated_at"}
+            if hashed:
+                kwargs["update_fields"].add("email_hash")
+        elif not self._state.adding and not kwargs.get("force_insert"):
+            kwargs["update_fields"] = [
+                    f.attname for f in self._meta.concrete_fields
+                    if not f.primary_key and f.attname not in
+                    self.STAT_FIELDS]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def add_stats(cls, deltas):
+        """Add to the collection statistics of users, atomically.
+
+        Runs a single ``UPDATE`` for all users, bumping their row
+        versions.
+
+        :param deltas: user id -> {stat field -> amount to add}
+        :type deltas: dict
+        """
+        deltas = {pk: d for pk, d in deltas.items()
+                  if pk is not None and any(d.values())}
+        if not deltas:
+            return
+        values = dict()
+        for f in cls.STAT_FIELDS:
+            field = cls._meta.get_field(f)
+            cases = [When(pk=pk, then=Value(d[f], output_field=field))
+                     for pk, d in deltas.items() if d.get(f)]
+            if cases:
+                values[f] = F(f) + Case(*cases, default=Value(
+                        0, output_field=field), output_field=field)
+        cls.objects.filter(pk__in=deltas).update(
+                version=F("version") + 1, updated_at=timezone.now(),
+                **values)
+        collection_stats_changed.send(sender=cls, deltas=deltas)
+
     def gravatar(self, size=40, *, fallback="wavatar",
                  default="{username}@example.org"):
         """Get the User's Gravatar.
@@ -63,21 +180,49 @@ class User(AbstractUser):
         :return: A string with the correct Gravatar URL.
         :rtype: str
         """
-        # Get the user's email
-        email = (self.email
-                 or default.format(username=self.username,
-                                   first=self.first_name,
-                                   last=self.last_name))
-
-        param = dict();
-
-        # Get the hash
-        hash = hashlib.sha256(email.encode()).hexdigest()
-        param["d"] = fallback
-        param["s"] = str(size)
-        param["name"] = ' '.join((self.first_name or "", self.last_name or ""))
-        param = urlencode(param);
-        return "https://www.gravatar.com/avatar/{}?{}".format(hash, param)
+        if default == DEFAULT_GRAVATAR_EMAIL and self.email_hash:
+            # hashed by save
+            hash = self.email_hash
+        else:
+            hash = self._hash_email(default)
+        return gravatar_url(hash, size, fallback, self._full_name())
+
+    def _hash_email(self, default):
+        return _hash_email(self.email, self.username, self.first_name,
+                           self.last_name, default)
+
+    def refresh_email_hash(self):
+        """Hash the Gravatar email into ``email_hash``.
+
+        Done by save; call it on users created with ``bulk_create``.
+        """
+        self.email_hash = self._hash_email(DEFAULT_GRAVATAR_EMAIL)
+
+    def _full_name(self):
+        return ' '.join((self.first_name or "", self.last_name or ""))
+
+    @classmethod
+    def gravatars(cls, pks, size=40, *, fallback="wavatar"):
+        """Get the Gravatars of many users, in one query.
+
+        :param pks: The user ids
+        :type pks: iterable
+        :param size: The size of the images
+        :type size: int
+        :param fallback: The fallback avatar to use
+        :type fallback: str
+        :return: user id -> Gravatar URL
+        :rtype: dict
+        """
+        rows = cls.objects.filter(pk__in=pks).values_list(
+                "pk", "email_hash", "email", "username", "first_name",
+                "last_name")
+        return {pk: gravatar_url(
+                    # not hashed if created in bulk
+                    hash or _hash_email(email, username, first, last,
+                                        DEFAULT_GRAVATAR_EMAIL),
+                    size, fallback, ' '.join((first or "", last or "")))
+                for pk, hash, email, username, first, last in rows}
 
     @property
     def gravatar_64(self):
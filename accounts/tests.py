@@ -3,17 +3,30 @@
 Test certain flows and model methods.
 """
 
-__all__ = ["GravatarTestCase"]
+__all__ = ["GravatarTestCase", "UpdateInterestTest",
+           "ProfileConditionalGetTest", "QueryBudgetTest",
+           "MyPokemonsTest", "CollectionStatsTest", "SkiplistTest",
+           "LeaderboardTest"]
 __author__ = "Advaith Menon"
 
+import bisect
 import hashlib
+import random
 from urllib.parse import parse_qs
 from io import StringIO
+from unittest import mock
 
+from django.core.cache import caches
 from django.core.management import call_command
 from django.test import TestCase
+from django.urls import reverse
 
+from .leaderboard import LEADERBOARDS, IndexableSkiplist
 from .models import User
+from poketrade2.testing import QueryBudgetMixin
+from trading.helpers import assign_pokemon_to_user
+from trading.models import Pokemon
+from trading.synthetic import CatalogueGenerator
 
 
 class GravatarTestCase(TestCase):
@@ -57,6 +70,58 @@ class GravatarTestCase(TestCase):
             "d": ["wavatar"], "s": ["40"], "name": ["Web Master"]},
             param);
 
+    def test_stored_hash(self):
+        """Test if saved users are not hashed again to render"""
+        self.u1.save()
+        url = self.u1.gravatar_64
+        usr = User.objects.get(pk=self.u1.pk)
+        with mock.patch("accounts.models.hashlib.sha256") as sha:
+            self.assertEqual(url, usr.gravatar_64)
+            self.assertEqual(url, usr.gravatar(64))
+        sha.assert_not_called()
+        # a custom default email is hashed as before
+        self.assertNotEqual(url, usr.gravatar(64, default="{first}@x.org"))
+
+    def test_hash_refreshed(self):
+        """Test if changing the email changes the Gravatar"""
+        self.u1.save()
+        old = self.u1.gravatar()
+        self.u1.email = "gpburdell@gatech.edu"
+        self.u1.save(update_fields=["email"])
+        self.u1.refresh_from_db()
+        self.assertEqual(self.u2.gravatar(), self.u1.gravatar().replace(
+                "Web+Master", "+"))
+        self.assertNotEqual(old, self.u1.gravatar())
+        # saves of other fields do not load or hash the email
+        usr = User.objects.only("pk", "coins", "version").get(pk=self.u1.pk)
+        with self.assertNumQueries(1):
+            usr.coins = 5
+            usr.save(update_fields=["coins"])
+
+    def test_bulk(self):
+        """Test if many Gravatars are made in one query"""
+        self.u1.save()
+        self.u2.username = "gpburdell"
+        self.u2.save()
+        with self.assertNumQueries(1):
+            urls = User.gravatars([self.u1.pk, self.u2.pk, 0], 64)
+        self.assertEqual({self.u1.pk: self.u1.gravatar_64,
+                          self.u2.pk: self.u2.gravatar_64}, urls)
+
+    def test_bulk_created(self):
+        """Test if users created in bulk get their hashed Gravatars"""
+        usr, = User.objects.bulk_create([User(username="misty")])
+        usr = User.objects.get(username="misty")
+        self.assertEqual("", usr.email_hash)
+        url = usr.gravatar(64)
+        self.assertIn(hashlib.sha256(b"misty@example.org").hexdigest(), url)
+        self.assertEqual({usr.pk: url}, User.gravatars([usr.pk], 64))
+        # generated users are hashed before they are saved
+        gen, = CatalogueGenerator(1).users(1)
+        self.assertEqual(User(username=gen.username, email=gen.email)
+                         .gravatar(), gen.gravatar())
+        self.assertTrue(gen.email_hash)
+
 
 class UpdateInterestTest(TestCase):
     """Tests if the Update Interest command works as intended.
@@ -91,3 +156,280 @@ class UpdateInterestTest(TestCase):
         self.assertEqual(120000 * 1.5, self.p47.coins)
         self.assertEqual(0, self.p46.coins)
 
+
+
+class ProfileConditionalGetTest(TestCase):
+    """Tests if the profile page honours conditional GETs.
+    """
+    def setUp(self):
+        self.usr = User.objects.create(username="gpburdell")
+        self.client.force_login(self.usr)
+        self.url = reverse("accounts:profile", args=[self.usr.pk])
+
+    def test_not_modified(self):
+        """Tests if an unchanged profile returns a 304.
+        """
+        etag = self.client.get(self.url)["ETag"]
+        rv = self.client.get(self.url, headers={"if-none-match": etag})
+        self.assertEqual(304, rv.status_code)
+
+    def test_interest_invalidates(self):
+        """Tests if bulk coin updates change the ETag.
+        """
+        etag = self.client.get(self.url)["ETag"]
+        call_command("update_interest", 0.5)
+        rv = self.client.get(self.url, headers={"if-none-match": etag})
+        self.assertEqual(200, rv.status_code)
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    """Pins the number of queries of every accounts view.
+
+    Budgets must not depend on the size of a collection.
+    """
+    def setUp(self):
+        self.usr = User.objects.create(username="gpburdell",
+                                       email="gpburdell@gatech.edu")
+        self.client.force_login(self.usr)
+        self.grow(3)
+
+    def grow(self, n=20):
+        """Adds Pokemon to the user's collection.
+        """
+        Pokemon.objects.bulk_create(
+                Pokemon(name="Buzz", owner=self.usr) for _ in range(n))
+
+    def test_profile(self):
+        url = reverse("accounts:profile", args=[self.usr.pk])
+        with self.assertQueryBudget(3):
+            self.client.get(url)
+        self.assertConstantQueries(lambda: self.client.get(url), self.grow)
+
+    def test_edit_profile(self):
+        url = reverse("accounts:edit_profile", args=[self.usr.pk])
+        # the user is read again on purpose - see ProfileUpdateView
+        with self.assertNumQueries(3):
+            self.client.get(url)
+        # a rejected edit leaves the logged in user alone
+        User.objects.create(username="taken")
+        rv = self.client.post(url, {"username": "taken"})
+        self.assertTrue(rv.context["form"].errors)
+        self.assertEqual("gpburdell", rv.context["user"].username)
+
+    def test_my_profile(self):
+        with self.assertQueryBudget(2):
+            self.client.get(reverse("accounts:my_profile"))
+
+    def test_my_pokemon(self):
+        url = reverse("accounts:my_pokemon")
+        with self.assertQueryBudget(5):
+            self.client.get(url)
+
+        def get_cold():
+            # bulk_create does not invalidate cached counts
+            caches["default"].clear()
+            return self.client.get(url)
+        self.assertConstantQueries(get_cold, self.grow)
+
+
+class MyPokemonsTest(TestCase):
+    """Test searching and paging the user's own Pokemon.
+    """
+    def setUp(self):
+        self.usr = User.objects.create(username="ash")
+        self.other = User.objects.create(username="gary")
+        Pokemon.objects.bulk_create(
+                Pokemon(name="Pikachu %03d" % i, hp=i, owner=self.usr)
+                for i in range(150))
+        Pokemon.objects.create(name="Pikachu 999", owner=self.other)
+        self.client.force_login(self.usr)
+        self.url = reverse("accounts:my_pokemon")
+        caches["default"].clear()
+
+    def names(self, rv):
+        return [x.name for x in rv.context["pokemons"]]
+
+    def test_pages(self):
+        rv = self.client.get(self.url, {"s": "Pika"})
+        self.assertEqual(100, len(rv.context["pokemons"]))
+        self.assertEqual(2, rv.context["paginator"].num_pages)
+        self.assertNotIn("Pikachu 999", self.names(rv))
+        # counts are not shared between users
+        self.client.force_login(self.other)
+        rv = self.client.get(self.url, {"s": "Pika"})
+        self.assertEqual(["Pikachu 999"], self.names(rv))
+
+    def test_search(self):
+        rv = self.client.get(self.url, {"q": "hp,GTE,140;hp,LT,145;@AND",
+                                        "o": "-name"})
+        self.assertEqual(["Pikachu %03d" % i for i in range(144, 139, -1)],
+                         self.names(rv))
+        self.assertEqual(400, self.client.get(
+                self.url, {"q": "hp,GT"}).status_code)
+
+    def test_cursor(self):
+        seen = list()
+        params = {"o": "-hp", "c": ""}
+        while True:
+            rv = self.client.get(self.url, params)
+            seen += [x.hp for x in rv.context["pokemons"]]
+            if not rv.context["next_cursor"]:
+                break
+            params["c"] = rv.context["next_cursor"]
+        self.assertEqual(list(range(149, -1, -1)), seen)
+
+
+class CollectionStatsTest(TestCase):
+    """Test that collection statistics follow the user's cards.
+    """
+    def setUp(self):
+        self.usr = User.objects.create(username="ash", coins=1000)
+        self.other = User.objects.create(username="gary")
+        self.pika = Pokemon.objects.create(name="Pikachu", owner=self.usr,
+                                           cost_price=5, trend_price=8)
+        self.eevee = Pokemon.objects.create(name="Eevee", owner=self.other,
+                                            sell_price=10,
+                                            suggested_price=12)
+
+    def stats(self, usr):
+        usr.refresh_from_db()
+        return tuple(getattr(usr, f) for f in User.STAT_FIELDS)
+
+    def assertRebuilt(self):
+        """Assert that the maintained statistics are right"""
+        before = [self.stats(x) for x in (self.usr, self.other)]
+        call_command("rebuildstats", stdout=StringIO())
+        self.assertEqual(before,
+                         [self.stats(x) for x in (self.usr, self.other)])
+
+    def test_create(self):
+        self.assertEqual((1, 5, 8, 0), self.stats(self.usr))
+        self.assertEqual((1, 0, 12, 1), self.stats(self.other))
+        self.assertRebuilt()
+
+    def test_buy(self):
+        self.client.force_login(self.usr)
+        rv = self.client.post(reverse("trading:buy_single",
+                                      args=[self.eevee.pk]))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual((2, 15, 20, 0), self.stats(self.usr))
+        self.assertEqual((0, 0, 0, 0), self.stats(self.other))
+        self.assertRebuilt()
+
+    def test_sell_and_delete(self):
+        self.client.force_login(self.usr)
+        self.client.post(reverse("trading:sell_single",
+                                 args=[self.pika.pk]), {"sell_price": 3})
+        self.assertEqual((1, 5, 8, 1), self.stats(self.usr))
+        Pokemon.objects.get(pk=self.pika.pk).delete()
+        self.assertEqual((0, 0, 0, 0), self.stats(self.usr))
+        self.assertRebuilt()
+
+    def test_assign(self):
+        Pokemon.objects.create(name="Mew", trend_price=100)
+        assign_pokemon_to_user(self.other)
+        self.assertEqual((2, 0, 112, 1), self.stats(self.other))
+        self.assertRebuilt()
+
+    def test_stale_user(self):
+        """Test that saving a stale user keeps the statistics"""
+        stale = User.objects.get(pk=self.usr.pk)
+        Pokemon.objects.create(name="Mew", owner=self.usr)
+        stale.coins = 5
+        stale.save()
+        self.assertEqual(2, self.stats(self.usr)[0])
+        self.assertEqual(5, self.usr.coins)
+
+    def test_deferred(self):
+        """Test saves that cannot tell what changed"""
+        pk = Pokemon.objects.only("name").get(pk=self.pika.pk)
+        pk.owner = self.other
+        pk.save()
+        self.assertEqual((2, 5, 20, 1), self.stats(self.other))
+
+
+class SkiplistTest(TestCase):
+    """Test the indexable skiplist against a sorted list.
+    """
+    def test_random(self):
+        rng = random.Random(0)
+        sl = IndexableSkiplist(seed=1)
+        ref = list()
+        for _ in range(3000):
+            key = rng.randrange(500)
+            i = bisect.bisect_left(ref, key)
+            if i < len(ref) and ref[i] == key:
+                self.assertEqual(i, sl.rank(key))
+                sl.remove(key)
+                del ref[i]
+            else:
+                sl.insert(key)
+                ref.insert(i, key)
+            self.assertEqual(len(ref), len(sl))
+        self.assertEqual(ref, list(sl))
+        self.assertEqual(ref[10:25], list(sl.islice(10, 25)))
+        self.assertEqual(ref[-1], sl[-1])
+        self.assertRaises(KeyError, sl.remove, 1000)
+        self.assertRaises(IndexError, sl.__getitem__, len(ref))
+
+    def test_from_sorted(self):
+        for n in (0, 1, 7, 64, 1000):
+            sl = IndexableSkiplist.from_sorted(range(0, 2 * n, 2))
+            self.assertEqual(list(range(0, 2 * n, 2)), list(sl))
+            if n:
+                self.assertEqual(n - 1, sl.rank(2 * n - 2))
+                sl.insert(3)
+                sl.remove(0)
+                self.assertEqual(sorted({*range(2, 2 * n, 2), 3}),
+                                 list(sl))
+
+
+class LeaderboardTest(TestCase):
+    """Test the rankings and their pages.
+    """
+    def setUp(self):
+        self.usrs = [User.objects.create(username="trainer%d" % i,
+                                         coins=10 * i) for i in range(5)]
+        self.ash = self.usrs[0]
+        LEADERBOARDS.build()
+
+    def test_coins(self):
+        self.assertEqual(["trainer4", "trainer3"],
+                         [x[2] for x in LEADERBOARDS.top("coins", 2)])
+        self.assertEqual((5, 0), LEADERBOARDS.rank("coins", self.ash.pk))
+        self.ash.coins = 35
+        self.ash.save()
+        self.assertEqual((2, 35), LEADERBOARDS.rank("coins", self.ash.pk))
+        # ties are broken by id
+        self.usrs[1].coins = 35
+        self.usrs[1].save()
+        self.assertEqual((3, 35),
+                         LEADERBOARDS.rank("coins", self.usrs[1].pk))
+
+    def test_cards(self):
+        Pokemon.objects.create(name="Mew", owner=self.usrs[2],
+                               trend_price=20)
+        self.assertEqual((1, 1),
+                         LEADERBOARDS.rank("cards", self.usrs[2].pk))
+        self.assertEqual((1, 20),
+                         LEADERBOARDS.rank("value", self.usrs[2].pk))
+
+    def test_bulk(self):
+        """Test that bulk updates rebuild the rankings"""
+        User.objects.filter(pk=self.ash.pk).update(coins=10 ** 6)
+        self.assertEqual((5, 0), LEADERBOARDS.rank("coins", self.ash.pk))
+        call_command("update_interest", 0.5)
+        self.assertEqual((1, 1.5 * 10 ** 6),
+                         LEADERBOARDS.rank("coins", self.ash.pk))
+
+    def test_view(self):
+        self.client.force_login(self.ash)
+        url = reverse("accounts:leaderboard", args=["coins"])
+        with self.settings(POKETRADE_LEADERBOARD_SIZE=2):
+            rv = self.client.get(url, {"page": 2})
+        self.assertEqual([3, 4], [x[0] for x in rv.context["rows"]])
+        self.assertTrue(rv.context["has_next"])
+        self.assertEqual((5, 0), rv.context["my_rank"])
+        self.assertEqual(self.usrs[1].gravatar(32), rv.context["rows"][1][4])
+        self.assertEqual(404, self.client.get(reverse(
+                "accounts:leaderboard", args=["streak"])).status_code)
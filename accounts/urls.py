@@ -21,5 +21,9 @@ urlpatterns = [
         path("profile/", v.my_profile, name="my_profile"),
         path("profile/pokemon", v.MyPokemonsListView.as_view(),
              name="my_pokemon"),
+        path("leaderboard/portfolio", v.PortfolioLeaderboardView.as_view(),
+             name="portfolio_leaderboard"),
+        path("leaderboard/<str:board>", v.LeaderboardView.as_view(),
+             name="leaderboard"),
         ]
 
@@ -4,49 +4,146 @@ Contains signup pages and the profile page.
 """
 
 __all__ = ["ProfileView", "ProfileUpdateView", "MyPokemonsListView",
-           "my_profile"]
+           "PortfolioLeaderboardView", "LeaderboardView", "my_profile"]
 
 __author__ = "Advaith Menon"
 
 from django.views.generic.detail import DetailView
-from django.views.generic import ListView
+from django.views.generic import ListView, TemplateView
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
+from django.http import Http404
 from django.shortcuts import redirect, reverse
 from django.views.generic.edit import UpdateView
 
+from .leaderboard import BOARDS, LEADERBOARDS
 from .models import User
+from trading.helpers import ConditionalGetMixin, QueryableMixin
 from trading.models import Pokemon
+from trading.valuation import PRICE_SOURCES, RANKINGS, latest_report, \
+        leaderboard, portfolio
+from trading.views import PokemonListView
 
 
-class MyPokemonsListView(LoginRequiredMixin, ListView):
+class MyPokemonsListView(LoginRequiredMixin, QueryableMixin,
+                         ConditionalGetMixin, ListView):
     """Lists a users' owned Pokemon.
+
+    Searches, sorts and pages like the other Pokemon lists. Only the
+    columns shown are loaded; the collection is found (and sorted by
+    name) with ``ix_pokemon_owner_name``.
     """
     template_name = "accounts/my_pokemons.html"
     model = Pokemon
     context_object_name = "pokemons"
-
-    def get_context_data(self, **kwargs):
-        # to modify message on search
-        ctx = super().get_context_data(**kwargs)
-        ctx["query_str"] = self.request.GET.get("s", "")
-        return ctx
-
+    # browse traffic - may be served from a read replica
+    replica_reads = True
+    paginate_by = 100
+    generic_qparse = PokemonListView.generic_qparse
+    sort_fields = PokemonListView.sort_fields
+    # the columns of accounts/includes/pokemon_row.html
+    fields = ("name", "hp", "type_l", "cost_price", "version")
+
+    def get_search_key(self):
+        # the URL is the same for every user
+        return "%s:%d" % (super().get_search_key(), self.request.user.pk)
 
     def get_queryset(self):
-        if "s" in self.request.GET:
-            # we have a search term
-            term = self.request.GET["s"]
-            return self.request.user.pokemons.filter(name__contains=term)
-        return self.request.user.pokemons.all()
+        field, desc = self._get_sort()
+        # cursors read the sort field
+        fields = self.fields + (() if field == "pk" else (field,))
+        return super().get_queryset() \
+                .filter(owner=self.request.user).only(*fields)
 
 
-class ProfileView(LoginRequiredMixin, DetailView):
+class ProfileView(LoginRequiredMixin, ConditionalGetMixin, DetailView):
     """Enables viewing of profiles.
     """
     template_name = "accounts/user_detail.html"
     context_object_name = "the_user"
+    # browse traffic - may be served from a read replica
+    replica_reads = True
     model = User
+    # the latest valuation report, read with the version token
+    _report = None
+
+    def get_version_token(self):
+        row = User.objects.filter(pk=self.kwargs["pk"]) \
+                .values_list("version", "updated_at").first()
+        if row is None:
+            return None
+        # the valuation shown comes from the latest report
+        self._report = latest_report()
+        return ("%s:%s" % (row[0], (self._report or {}).get("generated_at")),
+                row[1])
+
+    def get_object(self, *args, **kw):
+        """Get the profile to show.
+
+        Your own profile is already loaded, so it is not fetched again.
+        """
+        if self.kwargs.get(self.pk_url_kwarg) == self.request.user.pk:
+            return self.request.user
+        return super().get_object(*args, **kw)
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        # valued nightly - never here
+        ctx["valuation"] = portfolio(self.object.pk, self._report or {})
+        if ctx["valuation"]:
+            ctx["valued_at"] = self._report["generated_at"]
+        return ctx
+
+
+class PortfolioLeaderboardView(LoginRequiredMixin, TemplateView):
+    """Ranks users by the value (or profit) of their collections.
+
+    Read from the nightly valuation report; see ``trading.valuation``.
+    """
+    template_name = "accounts/portfolio_leaderboard.html"
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        source = self.request.GET.get("source", "trend_price")
+        by = self.request.GET.get("by", "value")
+        if source not in PRICE_SOURCES or by not in RANKINGS:
+            raise Http404("No such leaderboard")
+        report = leaderboard()
+        ctx.update(source=source, by=by, sources=PRICE_SOURCES,
+                   rankings=RANKINGS,
+                   generated_at=report["generated_at"],
+                   rows=report["leaderboards"][source][by])
+        return ctx
+
+
+class LeaderboardView(LoginRequiredMixin, TemplateView):
+    """Ranks users by coins, collection size or collection value.
+
+    Served from the in-memory rankings of ``accounts.leaderboard``;
+    ``page`` pages through them, and the viewer's rank is shown too.
+    """
+    template_name = "accounts/leaderboard.html"
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        board = self.kwargs["board"]
+        if board not in BOARDS:
+            raise Http404("No such leaderboard")
+        try:
+            page = max(1, int(self.request.GET.get("page", 1)))
+        except ValueError:
+            page = 1
+        size = settings.POKETRADE_LEADERBOARD_SIZE
+        rows = LEADERBOARDS.top(board, size, (page - 1) * size)
+        # hashed on save - no hashing here
+        avatars = User.gravatars([row[1] for row in rows], 32)
+        rows = [(*row, avatars.get(row[1])) for row in rows]
+        ctx.update(board=board, boards=list(BOARDS), rows=rows,
+                   page=page, has_next=len(rows) == size
+                   and page * size < len(LEADERBOARDS),
+                   my_rank=LEADERBOARDS.rank(board, self.request.user.pk))
+        return ctx
 
 
 class ProfileUpdateView(LoginRequiredMixin, UpdateView):
@@ -54,6 +151,8 @@ class ProfileUpdateView(LoginRequiredMixin, UpdateView):
     fields = ["username", "first_name", "last_name", "email"]
     # accounts/user_update.html
     template_name_suffix = "_update"
+    # not "user", which would hide the logged in user from the page
+    context_object_name = "the_user"
 
     def get_object(self, *args, **kw):
         """Get the object requested by the user.
@@ -61,6 +160,10 @@ class ProfileUpdateView(LoginRequiredMixin, UpdateView):
         This is overriden to prevent users from editing each others'
         profiles.
         """
+        if self.kwargs.get(self.pk_url_kwarg) == self.request.user.pk:
+            # not request.user itself - an invalid form still changes
+            # the object, and the page shows request.user too
+            return User.objects.get(pk=self.request.user.pk)
         obj = super().get_object(*args, **kw)
         if obj != self.request.user:
             # malicious user
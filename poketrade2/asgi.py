@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'poketrade2.settings')
 
 application = get_asgi_application()
+
+# build the in-memory indexes (autocomplete, similar cards)
+from trading.apps import TradingConfig  # noqa: E402
+TradingConfig.warm_up()
@@ -0,0 +1,55 @@
+"""Instrumented Cache Backends
+
+Cache backends that report their hits and misses to the per-request
+instrumentation (see ``poketrade2.timing``) and to the process-wide
+metrics (see ``poketrade2.metrics``).
+"""
+
+__all__ = ["InstrumentedCacheMixin", "InstrumentedLocMemCache"]
+__author__ = "Advaith Menon"
+
+from django.core.cache.backends.locmem import LocMemCache
+
+from poketrade2.metrics import CACHE_LOOKUPS
+from poketrade2.timing import record_cache
+
+
+# Returned by get() on a miss, so that cached Nones count as hits.
+_MISSING = object()
+
+
+class InstrumentedCacheMixin(object):
+    """Counts hits and misses of ``get`` and ``get_many``.
+
+    Mix into any cache backend, before the backend class.
+    """
+    def __init__(self, location, params):
+        super().__init__(location, params)
+        # the metrics label of this cache
+        self._metrics_name = location or "default"
+
+    def _record(self, hits, misses):
+        record_cache(hits, misses)
+        if hits:
+            CACHE_LOOKUPS.inc(hits, cache=self._metrics_name, result="hit")
+        if misses:
+            CACHE_LOOKUPS.inc(misses, cache=self._metrics_name,
+                              result="miss")
+
+    def get(self, key, default=None, version=None):
+        val = super().get(key, _MISSING, version)
+        if val is _MISSING:
+            self._record(0, 1)
+            return default
+        self._record(1, 0)
+        return val
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        rv = super().get_many(keys, version)
+        self._record(len(rv), len(keys) - len(rv))
+        return rv
+
+
+class InstrumentedLocMemCache(InstrumentedCacheMixin, LocMemCache):
+    """A local memory cache which reports hits and misses."""
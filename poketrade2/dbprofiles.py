@@ -0,0 +1,108 @@
+"""Database Profiles
+
+PokeTrade2 runs on SQLite for small shards. SQLite's defaults are tuned
+for embedded use, not for a web server: with the rollback journal a
+purchase (a write) blocks every reader on the market page until it
+commits. A profile bundles the connection settings for one kind of
+deployment, and is picked with the ``POKETRADE_DB_PROFILE`` environment
+variable.
+
+The ``production`` profile turns on:
+
+#. ``journal_mode=WAL`` - readers no longer block on writers (and vice
+   versa). Only one writer at a time, still.
+#. ``synchronous=NORMAL`` - safe with WAL; only the last transactions
+   can be lost on power failure, never corrupted.
+#. ``busy_timeout`` - writers wait for the lock instead of failing with
+   ``database is locked`` straight away.
+#. ``mmap_size`` and ``cache_size`` - keep hot pages in memory.
+#. ``BEGIN IMMEDIATE`` transactions, so a read-then-write (buying) takes
+   the write lock upfront instead of failing halfway through.
+#. persistent connections, so the pragmas are not re-run per request.
+
+Pragmas are applied by the connection-init hook, i.e. SQLite's
+``init_command``, which Django runs on every new connection.
+"""
+
+__all__ = ["PROFILES", "get_pragmas", "init_command", "sqlite_database"]
+__author__ = "Advaith Menon"
+
+
+# Maps a profile name to the pragmas and connection settings it uses.
+# Pragmas are applied in order.
+PROFILES = {
+    "default": {
+        "pragmas": (),
+        "transaction_mode": None,
+        "conn_max_age": 0,
+    },
+    "production": {
+        "pragmas": (
+            ("journal_mode", "WAL"),
+            ("synchronous", "NORMAL"),
+            ("busy_timeout", 5000),
+            # 256 MiB
+            ("mmap_size", 268435456),
+            # negative values are in KiB, so this is 64 MiB
+            ("cache_size", -65536),
+            ("temp_store", "MEMORY"),
+            ("foreign_keys", "ON"),
+        ),
+        "transaction_mode": "IMMEDIATE",
+        "conn_max_age": 600,
+    },
+}
+
+
+def get_pragmas(profile):
+    """Get the pragmas of a profile.
+
+    :param profile: The name of the profile
+    :type profile: str
+    :return: A tuple of (pragma, value) pairs
+    :rtype: tuple
+    """
+    if profile not in PROFILES:
+        raise ValueError("No such database profile: %s" % profile)
+    return PROFILES[profile]["pragmas"]
+
+
+def init_command(profile):
+    """Get the connection-init hook of a profile.
+
+    :param profile: The name of the profile
+    :type profile: str
+    :return: The SQL to run on every new connection
+    :rtype: str
+    """
+    return "".join("PRAGMA %s=%s;" % x for x in get_pragmas(profile))
+
+
+def sqlite_database(name, profile="default"):
+    """Build a ``DATABASES`` entry for a SQLite file.
+
+    :param name: Path of the database file
+    :type name: str
+    :param profile: The name of the profile to use
+    :type profile: str
+    :return: A dictionary to use in ``settings.DATABASES``
+    :rtype: dict
+    """
+    prof = PROFILES.get(profile)
+    if prof is None:
+        raise ValueError("No such database profile: %s" % profile)
+
+    options = dict()
+    if prof["pragmas"]:
+        options["init_command"] = init_command(profile)
+    if prof["transaction_mode"]:
+        options["transaction_mode"] = prof["transaction_mode"]
+
+    return {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": name,
+        "OPTIONS": options,
+        "CONN_MAX_AGE": prof["conn_max_age"],
+        # persistent connections may have gone away in between
+        "CONN_HEALTH_CHECKS": prof["conn_max_age"] != 0,
+    }
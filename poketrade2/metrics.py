@@ -0,0 +1,468 @@
+"""Metrics
+
+An in-process registry of counters and histograms, exposed in the
+Prometheus text exposition format on an admin-only URL.
+
+Web servers run several worker processes, and management commands
+(imports) run in processes of their own, so in-memory values alone
+would only show one process. When ``POKETRADE_METRICS_DIR`` is set,
+every process periodically dumps its values to its own file in that
+directory, and the exposition sums the files of all processes. The
+files of processes that exited are merged into ``merged.json`` and
+removed when the values are collected, so their counters still count
+without a file being left behind by every worker ever started. Process
+ids are only meaningful on one host - do not share the directory
+between servers.
+
+The metrics PokeTrade2 records are defined at the bottom of this
+module.
+"""
+
+__all__ = ["Registry", "Counter", "Histogram", "REGISTRY", "metrics_view",
+           "PURCHASES", "PURCHASE_FAILURES", "SEARCH_ERRORS",
+           "LIST_LATENCY", "IMPORTED_CARDS", "CACHE_LOOKUPS",
+           "CACHE_HIT_RATIO"]
+__author__ = "Advaith Menon"
+
+import atexit
+import bisect
+import contextlib
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (Windows) - files of exited processes are kept
+    fcntl = None
+
+from django.conf import settings
+from django.http import HttpResponse
+
+
+logger = logging.getLogger(__name__)
+
+
+# File the values of exited processes are merged into.
+MERGED_FILE = "merged.json"
+
+# Buckets for latencies, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10)
+
+
+def _labels(labels):
+    """Turn keyword labels into a hashable, ordered key."""
+    return tuple(sorted(labels.items()))
+
+
+def _fmt_labels(key, extra=()):
+    pairs = [*key, *extra]
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+            '%s="%s"' % (k, str(v).replace("\\", "\\\\")
+                                  .replace('"', '\\"')
+                                  .replace("\n", "\\n"))
+            for k, v in pairs)
+
+
+def _fmt_value(val):
+    if val == float("inf"):
+        return "+Inf"
+    return repr(float(val)) if isinstance(val, float) else str(val)
+
+
+def _read(path):
+    """Read a values file, or None if it vanished or is unreadable."""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    """Write a values file - through a rename, so readers never see
+    half a file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as fp:
+        json.dump(data, fp)
+    os.replace(tmp, path)
+
+
+def _exited(path):
+    """Whether the file was written by a process that exited.
+
+    Only files named by pid (see ``Registry.flush``) are considered.
+    """
+    try:
+        pid = int(os.path.basename(path).split("-", 1)[0])
+    except ValueError:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        # alive, but someone else's
+        pass
+    return False
+
+
+class Counter(object):
+    """A value that only goes up.
+
+    Use through ``Registry.counter``.
+    """
+    type = "counter"
+
+    def __init__(self, registry, name, help):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.values = dict()
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter.
+
+        :param amount: The amount to add, must not be negative
+        :type amount: float
+        """
+        key = _labels(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+    def dump(self, values=None):
+        values = self.values if values is None else values
+        return [[list(map(list, k)), v] for k, v in values.items()]
+
+    def load(self, merged, data):
+        for key, val in data:
+            key = tuple(map(tuple, key))
+            merged[key] = merged.get(key, 0) + val
+
+    def expose(self, merged):
+        for key, val in sorted(merged.items()):
+            yield "%s%s %s" % (self.name, _fmt_labels(key), _fmt_value(val))
+
+
+class Histogram(object):
+    """Counts observations into buckets.
+
+    Use through ``Registry.histogram``.
+    """
+    type = "histogram"
+
+    def __init__(self, registry, name, help, buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.values = dict()
+
+    def observe(self, value, **labels):
+        """Record an observation.
+
+        :param value: The observed value
+        :type value: float
+        """
+        key = _labels(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.registry.lock:
+            counts, total = self.values.get(
+                    key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[i] += 1
+            self.values[key] = (counts, total + value)
+        self.registry.maybe_flush()
+
+    def dump(self, values=None):
+        values = self.values if values is None else values
+        return [[list(map(list, k)), list(c), s]
+                for k, (c, s) in values.items()]
+
+    def load(self, merged, data):
+        for key, counts, total in data:
+            key = tuple(map(tuple, key))
+            old, old_total = merged.get(key, ([0] * len(counts), 0.0))
+            merged[key] = ([a + b for a, b in zip(old, counts)],
+                           old_total + total)
+
+    def expose(self, merged):
+        for key, (counts, total) in sorted(merged.items()):
+            cum = 0
+            for le, n in zip((*self.buckets, float("inf")), counts):
+                cum += n
+                yield "%s_bucket%s %d" % (
+                        self.name, _fmt_labels(key, (("le", _fmt_value(le)),)),
+                        cum)
+            yield "%s_sum%s %s" % (self.name, _fmt_labels(key),
+                                   _fmt_value(total))
+            yield "%s_count%s %d" % (self.name, _fmt_labels(key), cum)
+
+
+class DerivedGauge(object):
+    """A value computed from other metrics when exposed.
+
+    Use through ``Registry.derived``.
+    """
+    type = "gauge"
+
+    def __init__(self, registry, name, help, func):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.func = func
+        # nothing of its own to share between processes
+        self.values = dict()
+
+    def dump(self, values=None):
+        return []
+
+    def load(self, merged, data):
+        pass
+
+    def expose(self, merged):
+        for key, val in sorted(self.func(self.registry._merged).items()):
+            yield "%s%s %s" % (self.name, _fmt_labels(key), _fmt_value(val))
+
+
+class Registry(object):
+    """A set of metrics, shared across processes through a directory.
+
+    :param directory: Directory to share values through. Defaults to
+        ``settings.POKETRADE_METRICS_DIR``; None keeps values in memory.
+    :type directory: str
+    :param ident: Name of this process's file. Defaults to the pid.
+    :type ident: str
+    """
+    def __init__(self, directory=None, ident=None):
+        self.metrics = dict()
+        self.lock = threading.Lock()
+        self._directory = directory
+        self._ident = ident
+        self._pid = os.getpid()
+        self._file = None
+        self._last_flush = time.monotonic()
+        self._merged = dict()
+
+    def counter(self, name, help):
+        """Define a counter.
+
+        :rtype: class`Counter`
+        """
+        return self._add(Counter(self, name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        """Define a histogram.
+
+        :rtype: class`Histogram`
+        """
+        return self._add(Histogram(self, name, help, buckets))
+
+    def derived(self, name, help, func):
+        """Define a gauge computed from the other metrics.
+
+        :param func: Called with the merged values of all metrics,
+            returns a map of label key to value.
+        :rtype: class`DerivedGauge`
+        """
+        return self._add(DerivedGauge(self, name, help, func))
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric already defined: %s" % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    @property
+    def directory(self):
+        if self._directory is not None:
+            return self._directory
+        return getattr(settings, "POKETRADE_METRICS_DIR", None)
+
+    def _check_fork(self):
+        """Forget values inherited from a parent process."""
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._file = None
+            for metric in self.metrics.values():
+                metric.values.clear()
+
+    def maybe_flush(self):
+        """Flush if the last flush is old enough."""
+        if (self.directory and time.monotonic() - self._last_flush
+                >= settings.POKETRADE_METRICS_FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        """Write the values of this process to the shared directory.
+        """
+        directory = self.directory
+        if not directory:
+            return
+        with self.lock:
+            self._check_fork()
+            if self._file is None:
+                os.makedirs(directory, exist_ok=True)
+                # pids get reused - make the name unique per process
+                ident = self._ident or "%d-%d" % (self._pid,
+                                                  time.time_ns())
+                self._file = os.path.join(directory, "%s.json" % ident)
+                atexit.register(self.flush)
+            data = {k: v.dump() for k, v in self.metrics.items()}
+            self._last_flush = time.monotonic()
+
+        try:
+            _write(self._file, data)
+        except OSError:
+            # metrics must never break a request - try again next time
+            logger.warning("Cannot write metrics to %s", directory,
+                           exc_info=True)
+
+    def collect(self):
+        """Merge the values of every process.
+
+        :return: A map of metric name to merged values
+        :rtype: dict
+        """
+        merged = {k: dict() for k in self.metrics}
+        if not self.directory:
+            with self.lock:
+                for name, metric in self.metrics.items():
+                    metric.load(merged[name], metric.dump())
+            return merged
+
+        self.flush()
+        try:
+            self._prune()
+        except OSError:
+            logger.warning("Cannot merge metrics in %s", self.directory,
+                           exc_info=True)
+        # a merge is never seen half done - with the merged file
+        # written but the files merged into it not yet removed
+        with self._locked(shared=True):
+            for path in glob.glob(os.path.join(self.directory, "*.json")):
+                data = _read(path)
+                if data is None:
+                    # vanished or unreadable, skip it
+                    continue
+                for name, values in data.items():
+                    if name in self.metrics:
+                        self.metrics[name].load(merged[name], values)
+        return merged
+
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        """Lock the shared directory, if files can be locked."""
+        try:
+            lock = None if fcntl is None else open(
+                    os.path.join(self.directory, ".lock"), "a")
+        except OSError:
+            # nothing can be written there either
+            lock = None
+        if lock is None:
+            yield
+            return
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+
+    def _prune(self):
+        """Merge the files of exited processes into ``MERGED_FILE``.
+
+        Merges and removes them under an exclusive lock on the
+        directory, which collectors read under, so no file is counted
+        twice.
+        """
+        directory = self.directory
+        if fcntl is None or not any(
+                map(_exited, glob.glob(os.path.join(directory, "*.json")))):
+            return
+        with self._locked():
+            # another collector may have merged them meanwhile
+            dead = [path for path in glob.glob(
+                    os.path.join(directory, "*.json")) if _exited(path)]
+            target = os.path.join(directory, MERGED_FILE)
+            totals = dict()
+            for path in [target, *dead]:
+                for name, values in (_read(path) or {}).items():
+                    if name in self.metrics:
+                        self.metrics[name].load(
+                                totals.setdefault(name, dict()), values)
+                    else:
+                        # a metric this code no longer defines
+                        totals.setdefault(name, []).extend(values)
+            _write(target, {name: self.metrics[name].dump(values)
+                            if name in self.metrics else values
+                            for name, values in totals.items()})
+            for path in dead:
+                os.remove(path)
+
+    def exposition(self):
+        """Render every metric in the text exposition format.
+
+        :rtype: str
+        """
+        merged = self._merged = self.collect()
+        lines = list()
+        for name, metric in self.metrics.items():
+            lines.append("# HELP %s %s" % (name, metric.help))
+            lines.append("# TYPE %s %s" % (name, metric.type))
+            lines.extend(metric.expose(merged[name]))
+        return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    """Serve the metrics of all processes.
+
+    Protect it - see ``poketrade2/urls.py``.
+    """
+    return HttpResponse(REGISTRY.exposition(),
+                        content_type="text/plain; version=0.0.4; "
+                                     "charset=utf-8")
+
+
+# The registry of PokeTrade2.
+REGISTRY = Registry()
+
+PURCHASES = REGISTRY.counter(
+        "poketrade_purchases_total", "Pokemon bought on the market.")
+PURCHASE_FAILURES = REGISTRY.counter(
+        "poketrade_purchase_failures_total",
+        "Purchases refused with PermissionDenied, by reason.")
+SEARCH_ERRORS = REGISTRY.counter(
+        "poketrade_search_errors_total",
+        "Searches that could not be run, by reason (invalid, limit or "
+        "timeout).")
+LIST_LATENCY = REGISTRY.histogram(
+        "poketrade_list_latency_seconds",
+        "Time to build and render the Pokemon list page.")
+IMPORTED_CARDS = REGISTRY.counter(
+        "poketrade_imported_cards_total",
+        "Cards imported into the catalogue, by source.")
+CACHE_LOOKUPS = REGISTRY.counter(
+        "poketrade_cache_lookups_total",
+        "Cache lookups, by cache and result (hit or miss).")
+
+
+def _hit_ratio(merged):
+    totals = dict()
+    for key, val in merged["poketrade_cache_lookups_total"].items():
+        labels = dict(key)
+        cache = (("cache", labels.get("cache", "")),)
+        hits, total = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (val if labels.get("result") == "hit"
+                                 else 0), total + val)
+    return {k: h / t for k, (h, t) in totals.items() if t}
+
+
+CACHE_HIT_RATIO = REGISTRY.derived(
+        "poketrade_cache_hit_ratio",
+        "Share of cache lookups that were hits, by cache.", _hit_ratio)
@@ -0,0 +1,104 @@
+"""Database Routers
+
+Sends browse traffic to read replicas and everything else to the
+primary. Replicas are configured with ``POKETRADE_DB_REPLICAS``.
+
+Reads only go to a replica when all of the following hold:
+
+#. the request is a ``GET`` or ``HEAD``,
+#. the view opted in with ``replica_reads = True`` (the view-level
+   hint),
+#. the request has not written anything yet - the first write pins the
+   rest of the request to the primary, so it reads its own writes,
+#. the client did not write in the last few seconds (tracked with a
+   cookie), so a redirect after a purchase does not show stale data
+   while the replicas catch up.
+
+Management commands and other code running outside a request always
+use the primary.
+"""
+
+__all__ = ["ReplicaRouter", "ReplicaRoutingMiddleware", "pin_to_primary"]
+__author__ = "Advaith Menon"
+
+import contextvars
+import random
+
+from django.conf import settings
+
+
+# Name of the cookie that pins recent writers to the primary.
+PIN_COOKIE = "poketrade_primary"
+
+
+class _RoutingState(object):
+    """Routing state of a single request."""
+    def __init__(self):
+        self.replica_reads = False
+        self.pinned = False
+
+
+# Routing state of the current request, or None outside requests.
+_state = contextvars.ContextVar("poketrade2_routing", default=None)
+
+
+def pin_to_primary():
+    """Send all further reads of the current request to the primary.
+    """
+    state = _state.get()
+    if state is not None:
+        state.pinned = True
+
+
+class ReplicaRouter(object):
+    """Routes reads of opted-in views to replicas, writes to primary.
+    """
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        replicas = settings.POKETRADE_DB_REPLICAS
+        if (not replicas or state is None or state.pinned
+                or not state.replica_reads):
+            return "default"
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas are copies of the primary, so everything relates
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get their schema through replication
+        return db not in settings.POKETRADE_DB_REPLICAS
+
+
+class ReplicaRoutingMiddleware(object):
+    """Tracks the routing state of each request.
+
+    Must come before any middleware that reads from the database.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = _RoutingState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+
+        if state.pinned:
+            response.set_cookie(PIN_COOKIE, "1", httponly=True,
+                                samesite="Lax",
+                                max_age=settings.POKETRADE_DB_PIN_SECONDS)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _state.get()
+        view = getattr(view_func, "view_class", view_func)
+        state.replica_reads = (getattr(view, "replica_reads", False)
+                               and request.method in ("GET", "HEAD")
+                               and PIN_COOKIE not in request.COOKIES)
@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 
+from poketrade2.dbprofiles import sqlite_database
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -51,7 +53,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that it measures everything else
+    'poketrade2.timing.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    # must come before anything that touches the database
+    'poketrade2.routers.ReplicaRoutingMiddleware',
+    'poketrade2.slowlog.SlowQueryMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -72,6 +79,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                # exposes fragment_timeout for cached card fragments
+                'trading.context_processors.fragment_cache',
             ],
         },
     },
@@ -83,11 +92,172 @@ WSGI_APPLICATION = 'poketrade2.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# The database profile tunes SQLite for the deployment. Use
+# "production" on servers; see poketrade2/dbprofiles.py.
+POKETRADE_DB_PROFILE = os.environ.get("POKETRADE_DB_PROFILE", "default")
+
 DATABASES = {
+    'default': sqlite_database(BASE_DIR / 'db.sqlite3',
+                               POKETRADE_DB_PROFILE),
+}
+
+# Read replicas, as a list of database files separated by os.pathsep.
+# Browse views read from these; see poketrade2/routers.py.
+POKETRADE_DB_REPLICAS = []
+for _i, _path in enumerate(
+        filter(None, os.environ.get("POKETRADE_DB_REPLICAS", "")
+               .split(os.pathsep)), 1):
+    _alias = "replica%d" % _i
+    DATABASES[_alias] = sqlite_database(_path, POKETRADE_DB_PROFILE)
+    # tests run against the primary only
+    DATABASES[_alias]["TEST"] = {"MIRROR": "default"}
+    POKETRADE_DB_REPLICAS.append(_alias)
+
+DATABASE_ROUTERS = ["poketrade2.routers.ReplicaRouter"]
+
+# Seconds to keep reading from the primary after a client wrote, while
+# the replicas catch up.
+POKETRADE_DB_PIN_SECONDS = 5
+
+
+# Caches
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+# Rendered card fragments go to their own cache, so flushing one does
+# not wipe out the other.
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'BACKEND': 'poketrade2.cache.InstrumentedLocMemCache',
+    },
+    'template_fragments': {
+        'BACKEND': 'poketrade2.cache.InstrumentedLocMemCache',
+        'LOCATION': 'template_fragments',
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    },
+}
+
+# Seconds an unused card fragment is kept for. Fragments are keyed on
+# Pokemon.version, so this does not affect freshness.
+POKETRADE_FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+# Fraction of requests to instrument with a Server-Timing header and a
+# log line; see poketrade2/timing.py. Off unless set - deployments set
+# it (0.01 is a good start), so test runs and shells print nothing.
+POKETRADE_TIMING_SAMPLE_RATE = float(
+        os.environ.get("POKETRADE_TIMING_SAMPLE_RATE", "0"))
+
+
+# Metrics
+# Directory every process (web workers, management commands) dumps its
+# metrics to, so that /metrics shows all of them. Unset keeps metrics
+# in memory, per process.
+POKETRADE_METRICS_DIR = os.environ.get("POKETRADE_METRICS_DIR") or None
+# How often a process dumps its metrics, in seconds
+POKETRADE_METRICS_FLUSH_SECONDS = 5
+
+
+# Limits of advanced searches (q=); see trading.helpers.QueryParser.
+# Searches over a limit get a 400.
+POKETRADE_SEARCH_MAX_TERMS = 32
+POKETRADE_SEARCH_MAX_STACK = 16
+POKETRADE_SEARCH_MAX_WILDCARDS = 4
+# Time budget of all queries of a search page, in milliseconds
+POKETRADE_SEARCH_TIMEOUT_MS = 2000
+# Seconds search results (counts) are cached for. Entries are keyed on
+# the catalogue generation, which every save changes, but the default
+# cache is per process, so other processes only notice after this.
+POKETRADE_SEARCH_CACHE_TIMEOUT = 60
+
+
+# Seconds between rebuilds of the autocomplete index of a process, which
+# picks up changes other processes made; see trading/autocomplete.py.
+POKETRADE_AUTOCOMPLETE_REBUILD_SECONDS = 600
+
+
+# Rows exports read from the database (and write out) at a time; see
+# trading/export.py.
+POKETRADE_EXPORT_CHUNK_SIZE = 2000
+
+
+# Days collection changes are kept for delta syncs. Clients that last
+# synced before that download their whole collection again.
+POKETRADE_SYNC_RETENTION_DAYS = 30
+
+
+# Portfolio valuation; see trading/valuation.py.
+# Report written nightly by manage.py valuationreport
+POKETRADE_VALUATION_REPORT = os.environ.get(
+        "POKETRADE_VALUATION_REPORT", str(BASE_DIR / "valuation.json"))
+# Seconds leaderboards computed without a report are cached for
+POKETRADE_VALUATION_CACHE_SECONDS = 300
+# Users per leaderboard
+POKETRADE_LEADERBOARD_SIZE = 50
+# Seconds between rebuilds of the in-memory rankings; see
+# accounts/leaderboard.py.
+POKETRADE_LEADERBOARD_REBUILD_SECONDS = 600
+
+
+# Price history; see trading.models.PriceSnapshot.
+# Days kept at daily resolution, then weekly until this many days old,
+# then monthly
+POKETRADE_PRICE_DAILY_DAYS = 90
+POKETRADE_PRICE_WEEKLY_DAYS = 730
+
+
+# Similar cards; see trading/similarity.py.
+# Index written by manage.py buildsimilarity
+POKETRADE_SIMILARITY_INDEX = os.environ.get(
+        "POKETRADE_SIMILARITY_INDEX", str(BASE_DIR / "similarity.npy"))
+# Cards shown on the detail page
+POKETRADE_SIMILAR_CARDS = 8
+
+
+# Slow query log; see poketrade2/slowlog.py.
+# Queries slower than this many milliseconds are logged, None (an empty
+# environment variable) disables the log.
+POKETRADE_SLOW_QUERY_MS = (
+        float(os.environ.get("POKETRADE_SLOW_QUERY_MS", "200"))
+        if os.environ.get("POKETRADE_SLOW_QUERY_MS", "200") else None)
+POKETRADE_SLOW_QUERY_LOG = os.environ.get(
+        "POKETRADE_SLOW_QUERY_LOG", str(BASE_DIR / "slowqueries.log"))
+
+
+# Logging
+# https://docs.djangoproject.com/en/5.2/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+        # the file is only created once a slow query is logged
+        'slowqueries': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': POKETRADE_SLOW_QUERY_LOG,
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'delay': True,
+        },
+    },
+    'loggers': {
+        # one structured line per sampled request
+        'poketrade2.timing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        # one JSON line per slow query
+        'poketrade2.slowlog': {
+            'handlers': ['slowqueries'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
 }
 
 
@@ -0,0 +1,139 @@
+"""Slow Query Log
+
+Records every SQL query slower than ``POKETRADE_SLOW_QUERY_MS``, with
+its parameters, the page and search (``q=``/``s=``) that caused it and
+the database's query plan. Advanced searches let users combine filters
+freely, so this is how pathological plans are found.
+
+Records are JSON lines sent to the ``poketrade2.slowlog`` logger, which
+``settings.LOGGING`` writes to a rotating file
+(``POKETRADE_SLOW_QUERY_LOG``). Summarize them with
+``manage.py slowqueries``.
+"""
+
+__all__ = ["SlowQueryMiddleware", "query_shape", "read_records"]
+__author__ = "Advaith Menon"
+
+import contextlib
+import json
+import logging
+import os
+import re
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+# Matches IN lists and VALUES rows of placeholders.
+PLACEHOLDERS = re.compile(r"\(%s(?:, %s)*\)")
+
+
+def query_shape(sql):
+    """Make statements that only differ in IN list lengths equal.
+
+    :param sql: The SQL statement, with ``%s`` placeholders
+    :type sql: str
+    :rtype: str
+    """
+    return PLACEHOLDERS.sub("(%s...)", sql)
+
+
+def read_records(path):
+    """Read a slow query log and its rotated backups.
+
+    Lines that are not valid records are skipped.
+
+    :param path: The path of the current log file
+    :type path: str
+    :return: A generator of records (dicts), oldest file first
+    """
+    paths = [path]
+    i = 1
+    while os.path.exists("%s.%d" % (path, i)):
+        paths.append("%s.%d" % (path, i))
+        i += 1
+    for p in reversed(paths):
+        if not os.path.exists(p):
+            continue
+        with open(p) as fp:
+            for line in fp:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(rec, dict) and "sql" in rec:
+                    yield rec
+
+
+class _Recorder(object):
+    """The execute wrapper of one request."""
+    def __init__(self, request, threshold):
+        self.request = request
+        self.threshold = threshold
+        self.explaining = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.explaining:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            if ms >= self.threshold:
+                self.record(sql, params, many, context["connection"], ms)
+
+    def explain(self, conn, sql, params):
+        """Get the plan of a statement, one line per step."""
+        if not sql.lstrip()[:6].upper() == "SELECT":
+            return None
+        self.explaining = True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("%s %s" % (conn.ops.explain_query_prefix(),
+                                          sql), params)
+                # SQLite: (id, parent, notused, detail) - keep detail
+                return [str(row[-1]) for row in cursor.fetchall()]
+        except Exception as e:
+            # never fail the request because of the log
+            return ["cannot explain: %s" % e]
+        finally:
+            self.explaining = False
+
+    def record(self, sql, params, many, conn, ms):
+        get = self.request.GET
+        logger.warning(json.dumps({
+            "time": time.time(),
+            "ms": round(ms, 2),
+            "alias": conn.alias,
+            "sql": sql,
+            "params": None if many else params,
+            "path": self.request.path,
+            "q": get.get("q") or get.get("s"),
+            "plan": None if many else self.explain(conn, sql, params),
+        }, default=str))
+
+
+class SlowQueryMiddleware(object):
+    """Logs the slow queries of every request.
+
+    Queries of lazily rendered templates run after the view, so this
+    wraps the whole request. Disabled if ``POKETRADE_SLOW_QUERY_MS`` is
+    None.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        threshold = settings.POKETRADE_SLOW_QUERY_MS
+        if threshold is None:
+            return self.get_response(request)
+
+        recorder = _Recorder(request, threshold)
+        with contextlib.ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(recorder))
+            return self.get_response(request)
@@ -0,0 +1,108 @@
+"""Testing Helpers
+
+Query budgets for views. A budget pins the maximum number of SQL
+queries a block (usually one request) may run, and flags N+1 patterns:
+the same statement run twice, or the same statement *shape* (literals
+stripped) run over and over with different parameters.
+
+Failures come with a numbered list of the queries that ran, so the
+offending template line is easy to find.
+"""
+
+__all__ = ["QueryBudgetMixin", "sql_shape"]
+__author__ = "Advaith Menon"
+
+import collections
+import contextlib
+import re
+
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+
+# Matches SQL literals: quoted strings and numbers.
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+# Matches IN lists after their literals were replaced.
+IN_LIST = re.compile(r"\(\?(?:,\s*\?)*\)")
+
+
+def sql_shape(sql):
+    """Strip the literals from a statement.
+
+    :param sql: The SQL statement, with parameters interpolated
+    :type sql: str
+    :return: The statement with every literal replaced by ``?``
+    :rtype: str
+    """
+    return IN_LIST.sub("(?...)", LITERAL.sub("?", sql))
+
+
+def _report(queries, title):
+    lines = [title]
+    for i, q in enumerate(queries, 1):
+        lines.append("%3d. %s" % (i, q["sql"]))
+    return "\n".join(lines)
+
+
+class QueryBudgetMixin(object):
+    """Adds query budget assertions to a ``TestCase``.
+    """
+    @contextlib.contextmanager
+    def assertQueryBudget(self, budget, *, max_repeats=2, using="default"):
+        """Assert a block stays within a query budget.
+
+        :param budget: The maximum number of queries
+        :type budget: int
+        :param max_repeats: How often one statement shape may run
+            before it is reported as an N+1. Identical statements may
+            never repeat.
+        :type max_repeats: int
+        :param using: The database alias to watch
+        :type using: str
+        """
+        with CaptureQueriesContext(connections[using]) as ctx:
+            yield ctx
+
+        queries = ctx.captured_queries
+        if len(queries) > budget:
+            self.fail(_report(queries,
+                              "%d queries run, budget is %d:"
+                              % (len(queries), budget)))
+
+        same = collections.Counter(q["sql"] for q in queries)
+        dupes = [sql for sql, n in same.items() if n > 1]
+        if dupes:
+            self.fail(_report(queries,
+                              "Identical queries run more than once:\n%s"
+                              "\nAll queries:"
+                              % "\n".join("  (%dx) %s" % (same[x], x)
+                                          for x in dupes)))
+
+        shapes = collections.Counter(sql_shape(q["sql"]) for q in queries)
+        n_plus_one = [sql for sql, n in shapes.items() if n > max_repeats]
+        if n_plus_one:
+            self.fail(_report(queries,
+                              "Possible N+1, same query run with "
+                              "different parameters:\n%s\nAll queries:"
+                              % "\n".join("  (%dx) %s" % (shapes[x], x)
+                                          for x in n_plus_one)))
+
+    def assertConstantQueries(self, request, grow, *, using="default"):
+        """Assert a request runs as many queries for any data size.
+
+        :param request: Makes the request, called without arguments
+        :param grow: Adds more rows to the data the request shows,
+            called without arguments
+        :param using: The database alias to watch
+        :type using: str
+        """
+        with CaptureQueriesContext(connections[using]) as small:
+            request()
+        grow()
+        with CaptureQueriesContext(connections[using]) as big:
+            request()
+        if len(small) != len(big):
+            self.fail(_report(big.captured_queries,
+                              "Query count grew with the data, from %d "
+                              "to %d:" % (len(small), len(big))))
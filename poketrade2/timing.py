@@ -0,0 +1,156 @@
+"""Per-request Performance Instrumentation
+
+Records, for a sample of requests, the number of SQL queries and the
+time spent in them, the view and template render times and the cache
+hits and misses. These are sent back in a ``Server-Timing`` header
+(shown in the browser's developer tools) and logged as one structured
+line to the ``poketrade2.timing`` logger.
+
+Requests that are not sampled only pay for a random number and a
+context variable lookup, so the middleware can stay on in production.
+The sampling rate is ``POKETRADE_TIMING_SAMPLE_RATE``, set in the
+environment of deployments; nothing is sampled by default.
+"""
+
+__all__ = ["ServerTimingMiddleware", "record_cache", "current"]
+__author__ = "Advaith Menon"
+
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimings(object):
+    """The measurements of a single request. Durations are seconds."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.view_start = None
+        self.view_time = None
+        self.render_time = None
+
+
+# The timings of the current request, or None if it is not sampled.
+_current = contextvars.ContextVar("poketrade2_timing", default=None)
+
+
+def current():
+    """Get the timings of the current request.
+
+    :return: The timings, or None if the request is not sampled
+    :rtype: class`RequestTimings`
+    """
+    return _current.get()
+
+
+def record_cache(hits, misses):
+    """Record cache lookups for the current request.
+
+    :param hits: The number of keys found
+    :type hits: int
+    :param misses: The number of keys missing
+    :type misses: int
+    """
+    t = _current.get()
+    if t is not None:
+        t.cache_hits += hits
+        t.cache_misses += misses
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    t = _current.get()
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        t.sql_count += 1
+        t.sql_time += time.perf_counter() - start
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class ServerTimingMiddleware(object):
+    """Adds ``Server-Timing`` to a sample of responses.
+
+    Should be the first middleware, so that it measures all others.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.POKETRADE_TIMING_SAMPLE_RATE:
+            return self.get_response(request)
+
+        t = RequestTimings()
+        token = _current.set(t)
+        try:
+            with contextlib.ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(_sql_wrapper))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        total = time.perf_counter() - t.start
+        if t.view_start is not None and t.view_time is None:
+            # not a TemplateResponse - the view ended just now
+            t.view_time = time.perf_counter() - t.view_start
+
+        metrics = [
+            ("db", t.sql_time, "%d queries" % t.sql_count),
+            ("view", t.view_time, None),
+            ("tpl", t.render_time, None),
+            ("cache", None, "hits=%d misses=%d" % (t.cache_hits,
+                                                   t.cache_misses)),
+            ("total", total, None),
+        ]
+        response.headers["Server-Timing"] = ", ".join(
+                name
+                + ("" if dur is None else ";dur=%s" % _ms(dur))
+                + ("" if desc is None else ';desc="%s"' % desc)
+                for name, dur, desc in metrics)
+
+        logger.info(json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": _ms(total),
+            "view_ms": _ms(t.view_time),
+            "render_ms": _ms(t.render_time),
+            "sql_ms": _ms(t.sql_time),
+            "sql_count": t.sql_count,
+            "cache_hits": t.cache_hits,
+            "cache_misses": t.cache_misses,
+        }))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        t = _current.get()
+        if t is not None:
+            t.view_start = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        t = _current.get()
+        if t is None:
+            return response
+        if t.view_start is not None:
+            t.view_time = time.perf_counter() - t.view_start
+        # render now (instead of in the handler) so it can be timed
+        start = time.perf_counter()
+        response.render()
+        t.render_time = time.perf_counter() - start
+        return response
@@ -19,10 +19,15 @@ __all__ = ["urlpatterns"]
 __author__ = "Advaith Menon et al."
 
 from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
 from django.urls import include, path
 from django.conf import settings
 
+from poketrade2.metrics import metrics_view
+
 urlpatterns = [
+    # Prometheus metrics, for staff (and scrapers logged in as staff)
+    path("metrics", staff_member_required(metrics_view), name="metrics"),
     # URL for the Accounts app
     path("accounts/", include("accounts.urls")),
     path('admin/', admin.site.urls),
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'poketrade2.settings')
 
 application = get_wsgi_application()
+
+# build the in-memory indexes (autocomplete, similar cards)
+from trading.apps import TradingConfig  # noqa: E402
+TradingConfig.warm_up()
@@ -1,6 +1,26 @@
+import threading
+
 from django.apps import AppConfig
 
 
 class TradingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'trading'
+
+    def ready(self):
+        # connects the receivers that keep suggestions, similar cards
+        # and evolution chains up to date
+        from . import autocomplete, evolution, similarity
+
+    @staticmethod
+    def warm_up():
+        """Build the in-memory indexes of a server process.
+
+        Called by the WSGI and ASGI entry points, not in ``ready`` -
+        management commands and tests should not scan the catalogue.
+        Builds run in the background; the server starts at once.
+        """
+        from . import autocomplete, similarity
+        autocomplete.start_refresh()
+        threading.Thread(target=similarity.warm, name="similarity-warm",
+                         daemon=True).start()
@@ -0,0 +1,256 @@
+"""Autocomplete
+
+Suggestions for the search box: Pokemon names, artists, and ability and
+attack names, ranked by popularity (the number of cards having them).
+
+Suggestions are served from a sorted array in memory, so lookups never
+touch the database. The array is built when the server starts (see
+``start_refresh``), kept up to date by Pokemon saves and deletes in
+this process, and rebuilt in the background every
+``POKETRADE_AUTOCOMPLETE_REBUILD_SECONDS`` to pick up changes made by
+other processes. Until the first build, there are no suggestions.
+"""
+
+__all__ = ["AutocompleteIndex", "INDEX", "start_refresh"]
+__author__ = "Advaith Menon"
+
+import bisect
+import heapq
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Ability, Attack, Pokemon
+
+
+# Kinds of suggestions, and the Pokemon field of those kept up to date
+# on save.
+POKEMON_KINDS = {"name": "name", "artist": "artist"}
+
+# Prefixes matching more keys than this are too slow to rank on every
+# lookup - their results are memoized.
+MEMO_THRESHOLD = 256
+
+# The most suggestions a lookup returns.
+MAX_RESULTS = 20
+
+# Where words start.
+WORD = re.compile(r"\w+")
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(text):
+    return text.casefold().strip()
+
+
+class AutocompleteIndex(object):
+    """Popularity-ranked prefix lookups over a sorted array.
+
+    Every word of a suggestion is a key, so "char" suggests "Dark
+    Charizard" too.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._clear()
+        self.built_at = None
+
+    def _clear(self):
+        # sorted (key, kind, text) tuples
+        self._keys = list()
+        # (kind, text) -> weight
+        self._weights = dict()
+        # prefix -> top MAX_RESULTS (kind, text) pairs
+        self._memo = dict()
+
+    @staticmethod
+    def _entry_keys(kind, text):
+        norm = _normalize(text)
+        for m in WORD.finditer(norm):
+            yield (norm[m.start():], kind, text)
+
+    def _forget(self, key):
+        for n in range(1, len(key) + 1):
+            self._memo.pop(key[:n], None)
+
+    def add(self, kind, text, weight=1):
+        """Add to the popularity of a suggestion, adding it if needed.
+
+        :param kind: The kind of suggestion, e.g. "name"
+        :type kind: str
+        :param text: The suggestion
+        :type text: str
+        :param weight: The amount to add, negative to subtract. The
+            suggestion is removed once it reaches 0.
+        :type weight: int
+        """
+        if not text or not text.strip():
+            return
+        with self.lock:
+            entry = (kind, text)
+            old = self._weights.get(entry, 0)
+            new = old + weight
+            keys = list(self._entry_keys(kind, text))
+            if new > 0:
+                self._weights[entry] = new
+                if not old:
+                    for key in keys:
+                        bisect.insort(self._keys, key)
+            elif old:
+                del self._weights[entry]
+                for key in keys:
+                    i = bisect.bisect_left(self._keys, key)
+                    if i < len(self._keys) and self._keys[i] == key:
+                        del self._keys[i]
+            for key in keys:
+                self._forget(key[0])
+
+    def remove(self, kind, text, weight=1):
+        """Subtract from the popularity of a suggestion."""
+        self.add(kind, text, -weight)
+
+    def build(self):
+        """Rebuild from the database."""
+        weights = dict()
+        for kind, field in POKEMON_KINDS.items():
+            for text, n in Pokemon.objects.order_by().values(field) \
+                    .annotate(n=Count("pk")).values_list(field, "n"):
+                if text and text.strip():
+                    weights[(kind, text)] = n
+        for text, n in Ability.objects.order_by() \
+                .annotate(n=Count("pokemons")).values_list("name", "n"):
+            weights[("ability", text)] = max(n, 1)
+        for text in Attack.objects.values_list("name", flat=True):
+            weights[("attack", text)] = 1
+
+        keys = sorted(key for kind, text in weights
+                      for key in self._entry_keys(kind, text))
+        with self.lock:
+            self._keys = keys
+            self._weights = weights
+            self._memo = dict()
+            self.built_at = time.monotonic()
+
+    def _rank(self, prefix, limit):
+        """Get the top suggestions, memoizing popular prefixes."""
+        top = self._memo.get(prefix)
+        if top is not None:
+            return top
+        weights = self._weights
+        lo = bisect.bisect_left(self._keys, (prefix,))
+        hi = bisect.bisect_left(self._keys, (prefix + "\U0010ffff",), lo)
+        if hi - lo > MEMO_THRESHOLD:
+            limit = MAX_RESULTS
+        # one suggestion may match on several words
+        matches = {(kind, text) for _, kind, text in self._keys[lo:hi]}
+        top = heapq.nsmallest(limit, matches,
+                              key=lambda x: (-weights.get(x, 0), x[1]))
+        if hi - lo > MEMO_THRESHOLD:
+            self._memo[prefix] = top
+        return top
+
+    def lookup(self, prefix, limit=10):
+        """Get the most popular suggestions for a prefix.
+
+        :param prefix: What the user typed
+        :type prefix: str
+        :param limit: The most suggestions to return, up to
+            ``MAX_RESULTS``
+        :type limit: int
+        :return: A list of (kind, text, weight) tuples, most popular
+            first; empty until the index is built
+        :rtype: list
+        """
+        prefix = _normalize(prefix)
+        limit = max(0, min(limit, MAX_RESULTS))
+        if not prefix or not limit:
+            return []
+        with self.lock:
+            top = self._rank(prefix, limit)
+            return [(kind, text, self._weights.get((kind, text), 0))
+                    for kind, text in top[:limit]]
+
+
+# The index of this process.
+INDEX = AutocompleteIndex()
+
+_refresher = None
+
+
+def _refresh(interval):
+    while True:
+        try:
+            INDEX.build()
+        except Exception:
+            logger.exception("Cannot build the autocomplete index")
+        finally:
+            # the thread's own connection, not to be left open
+            connection.close()
+        time.sleep(interval)
+
+
+def start_refresh(interval=None):
+    """Build the index in the background, and rebuild it periodically.
+
+    Called once by the server at startup; later calls do nothing.
+
+    :param interval: Seconds between rebuilds, defaults to
+        ``POKETRADE_AUTOCOMPLETE_REBUILD_SECONDS``
+    :type interval: float
+    """
+    global _refresher
+    if _refresher is not None:
+        return
+    interval = interval or settings.POKETRADE_AUTOCOMPLETE_REBUILD_SECONDS
+    _refresher = threading.Thread(target=_refresh, args=(interval,),
+                                  name="autocomplete-refresh", daemon=True)
+    _refresher.start()
+
+
+@receiver(post_save, sender=Pokemon)
+def _pokemon_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or INDEX.built_at is None:
+        # fixtures, or nothing to update yet
+        return
+    if created:
+        old = {}
+    elif hasattr(instance, "_loaded"):
+        old = instance._loaded
+    else:
+        # not loaded by from_db - cannot tell what changed, leave it
+        # to the next rebuild
+        return
+    for kind, field in POKEMON_KINDS.items():
+        # not getattr - a deferred field would be read from the database
+        if field not in instance.__dict__ or not (created or field in old):
+            # not loaded, or set without its old value known
+            continue
+        new_val = instance.__dict__[field]
+        if field in old:
+            if old[field] == new_val:
+                continue
+            INDEX.remove(kind, old[field])
+        INDEX.add(kind, new_val)
+
+
+@receiver(post_delete, sender=Pokemon)
+def _pokemon_deleted(sender, instance, **kwargs):
+    if INDEX.built_at is None:
+        return
+    for kind, field in POKEMON_KINDS.items():
+        INDEX.remove(kind, getattr(instance, field))
+
+
+@receiver(post_save, sender=Ability)
+@receiver(post_save, sender=Attack)
+def _move_saved(sender, instance, created, raw=False, **kwargs):
+    # renames and popularity are picked up by the next rebuild
+    if created and not raw and INDEX.built_at is not None:
+        INDEX.add(sender.__name__.lower(), instance.name)
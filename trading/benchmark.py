@@ -0,0 +1,147 @@
+"""Trading Benchmarks
+
+A small load-testing harness for the trading views. Endpoints are
+driven through Django's test client from a pool of worker threads,
+each logged in as its own user, and every request is timed and has
+its SQL queries counted.
+
+The results are plain dictionaries so they can be dumped as JSON and
+compared between runs.
+"""
+
+__all__ = ["Endpoint", "percentile", "summarize", "run"]
+__author__ = "Advaith Menon"
+
+import collections
+import math
+import random
+import threading
+import time
+
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+
+# An endpoint to benchmark.
+#
+# ``request`` is called as ``request(client, worker, rng)`` and must
+# perform exactly one request with the client, returning the response.
+# ``worker`` is the per-thread state dictionary set up by ``run``.
+Endpoint = collections.namedtuple("Endpoint", ("name", "weight",
+                                               "request"))
+
+
+def percentile(values, p):
+    """Get a percentile with the nearest-rank method.
+
+    :param values: The sorted values
+    :type values: list
+    :param p: The percentile, between 0 and 100
+    :type p: float
+    :return: The value at that percentile, or None if there are none
+    """
+    if not values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def summarize(samples, wall_time):
+    """Summarize the samples of one endpoint.
+
+    :param samples: A list of (latency in seconds, query count, status)
+    :type samples: list
+    :param wall_time: The duration of the whole run, in seconds
+    :type wall_time: float
+    :return: Latency percentiles (ms), throughput and query counts
+    :rtype: dict
+    """
+    lat = sorted(round(x[0] * 1000, 3) for x in samples)
+    queries = [x[1] for x in samples]
+    statuses = collections.Counter(str(x[2]) for x in samples)
+    return {
+        "requests": len(samples),
+        "throughput_rps": round(len(samples) / wall_time, 2)
+                          if wall_time else None,
+        "latency_ms": {
+            "p50": percentile(lat, 50),
+            "p95": percentile(lat, 95),
+            "p99": percentile(lat, 99),
+            "max": lat[-1] if lat else None,
+        },
+        "queries": {
+            "mean": round(sum(queries) / len(queries), 2)
+                    if queries else None,
+            "max": max(queries, default=None),
+        },
+        "status": dict(statuses),
+    }
+
+
+def _worker(endpoints, user, n, seed, samples, lock, setup):
+    rng = random.Random(seed)
+    client = Client()
+    client.force_login(user)
+    state = setup(user) if setup else dict()
+    weights = [x.weight for x in endpoints]
+    local = collections.defaultdict(list)
+    try:
+        for _ in range(n):
+            ep = rng.choices(endpoints, weights)[0]
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                rv = ep.request(client, state, rng)
+                elapsed = time.perf_counter() - start
+            local[ep.name].append((elapsed, len(ctx), rv.status_code))
+    finally:
+        # every thread has its own connection
+        connections.close_all()
+    with lock:
+        for k, v in local.items():
+            samples[k].extend(v)
+
+
+def run(endpoints, users, *, concurrency=4, requests=1000, seed=0,
+        setup=None):
+    """Run a benchmark.
+
+    :param endpoints: The endpoints to drive, picked by weight
+    :type endpoints: list
+    :param users: The users to log the workers in as
+    :type users: list
+    :param concurrency: The number of worker threads
+    :type concurrency: int
+    :param requests: The total number of requests to make
+    :type requests: int
+    :param seed: Seed for picking endpoints, so runs are reproducible
+    :type seed: int
+    :param setup: Called with the user of each worker, returning the
+        worker's state dictionary
+    :return: The wall time and the summary of every endpoint, keyed
+        by name
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    samples = collections.defaultdict(list)
+    lock = threading.Lock()
+    per_worker = [requests // concurrency] * concurrency
+    for i in range(requests % concurrency):
+        per_worker[i] += 1
+
+    threads = [threading.Thread(target=_worker,
+                                args=(endpoints, rng.choice(users), n,
+                                      rng.random(), samples, lock, setup))
+               for n in per_worker]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall_time = time.perf_counter() - start
+
+    return {
+        "wall_time_s": round(wall_time, 3),
+        "endpoints": {k: summarize(v, wall_time)
+                      for k, v in sorted(samples.items())},
+    }
@@ -0,0 +1,21 @@
+"""Context Processors for Trading
+
+Makes trading-wide settings available to every template.
+"""
+
+__all__ = ["fragment_cache"]
+__author__ = "Advaith Menon"
+
+from django.conf import settings
+
+
+def fragment_cache(request):
+    """Expose the fragment cache timeout to templates.
+
+    Card fragments are keyed on ``Pokemon.version``, so they never go
+    stale - the timeout only bounds how long unused fragments linger.
+
+    :return: A context with the key ``fragment_timeout``
+    :rtype: dict
+    """
+    return {"fragment_timeout": settings.POKETRADE_FRAGMENT_CACHE_TIMEOUT}
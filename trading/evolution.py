@@ -0,0 +1,210 @@
+"""Evolution chains
+
+``Pokemon.evolves_from`` names the species (card name) a card evolves
+from. Cards are grouped by species, and every chain is precomputed in
+the ``Evolution`` closure table: a species has a row for itself and for
+each of its ancestors and descendants, with the number of generations
+between them. A whole chain - Pichu, Pikachu, Raichu - is then one
+indexed lookup, whichever species it is asked for.
+
+Saves add the edges of new species as they come (in O(size of the
+chain)); ``manage.py buildevolutions`` rebuilds the table from scratch,
+which also drops species no card names any more.
+
+Chains (and their card counts) change the evolution generation, which
+pages showing them put in their ETags.
+"""
+
+__all__ = ["closure", "rebuild", "add_edge", "chain", "line",
+           "evolution_generation", "bump_evolution_generation"]
+__author__ = "Advaith Menon"
+
+import collections
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Evolution, Pokemon
+
+
+# Cache key of the evolution generation.
+GENERATION_KEY = "trading:evolution_generation"
+
+
+def evolution_generation():
+    """Get the evolution generation.
+
+    It changes whenever a chain or the number of cards of a species
+    may have.
+
+    :rtype: int
+    """
+    return cache.get_or_set(GENERATION_KEY, time.time_ns(), None)
+
+
+def bump_evolution_generation():
+    """Invalidate every page showing an evolution chain."""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # evicted
+        cache.set(GENERATION_KEY, time.time_ns(), None)
+
+
+def closure(pairs):
+    """Compute the closure of an evolution graph.
+
+    Species reachable by more than one path keep the shortest; cycles
+    (bad data) are cut where they close.
+
+    :param pairs: (species, species it evolves from) tuples
+    :type pairs: iterable
+    :return: A generator of (name, relative, offset) tuples, offset
+        being negative for ancestors and 0 for the species itself
+    """
+    parents = collections.defaultdict(set)
+    species = set()
+    for name, parent in pairs:
+        if name and parent and name != parent:
+            parents[name].add(parent)
+            species.update((name, parent))
+    for name in species:
+        # breadth first, so the shortest path is found first
+        seen = {name: 0}
+        queue = collections.deque([name])
+        while queue:
+            cur = queue.popleft()
+            for parent in parents[cur]:
+                if parent not in seen:
+                    seen[parent] = seen[cur] + 1
+                    queue.append(parent)
+        yield name, name, 0
+        for ancestor, n in seen.items():
+            if n:
+                yield name, ancestor, -n
+                yield ancestor, name, n
+
+
+def rebuild(chunk_size=None):
+    """Rebuild the evolution table from every Pokemon.
+
+    :param chunk_size: Rows inserted per query
+    :type chunk_size: int
+    :return: The number of rows written
+    :rtype: int
+    """
+    chunk_size = chunk_size or settings.POKETRADE_EXPORT_CHUNK_SIZE
+    pairs = Pokemon.objects.exclude(evolves_from=None) \
+            .exclude(evolves_from="").order_by() \
+            .values_list("name", "evolves_from").distinct()
+    rows = {(name, rel): offset for name, rel, offset in closure(pairs)}
+    with transaction.atomic():
+        Evolution.objects.all().delete()
+        Evolution.objects.bulk_create(
+                (Evolution(name=name, relative=rel, offset=offset)
+                 for (name, rel), offset in rows.items()),
+                batch_size=chunk_size)
+    bump_evolution_generation()
+    return len(rows)
+
+
+def add_edge(name, parent):
+    """Record that a species evolves from another.
+
+    Every ancestor of the parent becomes an ancestor of every
+    descendant of the species. Does nothing if the edge is known or
+    would close a cycle.
+
+    :param name: The species
+    :type name: str
+    :param parent: The species it evolves from
+    :type parent: str
+    """
+    if not name or not parent or name == parent or Evolution.objects \
+            .filter(name=name, relative=parent, offset=-1).exists():
+        return
+    # generations up from the parent, and down from the species
+    up = dict(Evolution.objects.filter(name=parent, offset__lt=0)
+              .values_list("relative", "offset"))
+    up = {rel: -offset for rel, offset in up.items()}
+    up[parent] = 0
+    down = dict(Evolution.objects.filter(name=name, offset__gt=0)
+                .values_list("relative", "offset"))
+    down[name] = 0
+    if up.keys() & down.keys():
+        # a cycle
+        return
+    rows = [Evolution(name=x, relative=x, offset=0) for x in (name, parent)]
+    for ancestor, a in up.items():
+        for descendant, d in down.items():
+            rows.append(Evolution(name=descendant, relative=ancestor,
+                                  offset=-(a + 1 + d)))
+            rows.append(Evolution(name=ancestor, relative=descendant,
+                                  offset=a + 1 + d))
+    # rows already there (another path) keep their offset
+    Evolution.objects.bulk_create(rows, ignore_conflicts=True)
+    bump_evolution_generation()
+
+
+def chain(name):
+    """Get the evolution chain of a species, in one query.
+
+    :param name: The species
+    :type name: str
+    :return: A list of dicts with the relative (species), offset
+        (generations from the species asked for) and number of cards of
+        each species of the chain, the earliest first; empty if the
+        species does not evolve
+    :rtype: list
+    """
+    cards = Pokemon.objects.filter(name=OuterRef("relative")).order_by() \
+            .values("name").annotate(n=Count("pk")).values("n")
+    return list(Evolution.objects.filter(name=name)
+                .annotate(cards=Coalesce(Subquery(cards), Value(0)))
+                .order_by("offset", "relative")
+                .values("relative", "offset", "cards"))
+
+
+def line(lookup, value):
+    """Resolve the ``evolution_line`` search field.
+
+    :param lookup: The lookup on the species name, e.g. "exact"
+    :type lookup: str
+    :param value: The value looked up
+    :type value: str
+    :return: A (lookup, value) pair matching the cards of the chains
+        of every species matched
+    :rtype: tuple
+    """
+    names = Evolution.objects.filter(**{"name__" + lookup: value}) \
+            .values_list("relative", flat=True)
+    names = tuple(sorted(set(names)))
+    if not names:
+        # species that do not evolve are their own line
+        return "name__" + lookup, value
+    return "name__in", names
+
+
+@receiver(post_save, sender=Pokemon)
+def _pokemon_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    new = {f: instance.__dict__.get(f) for f in ("name", "evolves_from")}
+    old = getattr(instance, "_loaded", {})
+    changed = created or any(old.get(f) != v for f, v in new.items())
+    if changed and new["name"]:
+        # card counts of the chain
+        bump_evolution_generation()
+    if changed and all(new.values()):
+        add_edge(new["name"], new["evolves_from"])
+
+
+@receiver(post_delete, sender=Pokemon)
+def _pokemon_deleted(sender, instance, **kwargs):
+    bump_evolution_generation()
@@ -0,0 +1,129 @@
+"""Exports
+
+Streams Pokemon as NDJSON (one JSON object per line) or CSV, for
+partners pulling the market and users exporting their collections.
+
+Rows are read with ``QuerySet.iterator``, a chunk at a time, and
+written out as they are read, so memory use does not grow with the
+size of the export. Clients pick the columns they need with
+``fields=name,sell_price,...``.
+"""
+
+__all__ = ["ExportMixin", "EXPORT_FIELDS", "DEFAULT_FIELDS"]
+__author__ = "Advaith Menon"
+
+import csv
+import itertools
+import json
+
+from django.conf import settings
+from django.http import Http404, HttpResponseBadRequest, \
+        StreamingHttpResponse
+
+from .helpers import SearchError
+
+
+# Exported column -> model field (or lookup).
+EXPORT_FIELDS = {
+    "id": "pk",
+    "tcg_id": "tcg_id",
+    "name": "name",
+    "supertype": "supertype",
+    "types": "type_l",
+    "hp": "hp",
+    "rarity": "rarity",
+    "artist": "artist",
+    "number": "number",
+    "owner": "owner__username",
+    "sell_price": "sell_price",
+    "average_sell_price": "average_sell_price",
+    "low_price": "low_price",
+    "trend_price": "trend_price",
+    "suggested_price": "suggested_price",
+    "updated_at": "updated_at",
+}
+
+# Columns exported if the client does not ask for any.
+DEFAULT_FIELDS = ("id", "name", "hp", "rarity", "owner", "sell_price",
+                  "trend_price")
+
+# Formats -> content type.
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+class _Echo(object):
+    """A file-like object that returns what is written to it."""
+    def write(self, value):
+        return value
+
+
+def _json_default(val):
+    # datetimes
+    return val.isoformat()
+
+
+class ExportMixin(object):
+    """Streams the view's queryset as NDJSON or CSV.
+
+    Takes the format from the ``fmt`` URL argument. Put it before
+    ``QueryableMixin`` - exports are not bound by the search time limit.
+    """
+    export_name = "pokemon"
+
+    def get_export_fields(self):
+        """Get the columns the client asked for.
+
+        :return: A list of column names
+        :rtype: list
+        :raises ValueError: If a column does not exist
+        """
+        raw = self.request.GET.get("fields")
+        if not raw:
+            return list(DEFAULT_FIELDS)
+        fields = list(dict.fromkeys(x.strip() for x in raw.split(",")))
+        for f in fields:
+            if f not in EXPORT_FIELDS:
+                raise ValueError("No such field: %s" % f)
+        return fields
+
+    def _rows(self, queryset, fields):
+        return queryset.values_list(*(EXPORT_FIELDS[f] for f in fields)) \
+                .iterator(chunk_size=settings.POKETRADE_EXPORT_CHUNK_SIZE)
+
+    def _ndjson(self, rows, fields):
+        for row in rows:
+            yield json.dumps(dict(zip(fields, row)),
+                             default=_json_default) + "\n"
+
+    def _csv(self, rows, fields):
+        writer = csv.writer(_Echo())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow(row)
+
+    def get(self, request, *args, **kwargs):
+        fmt = self.kwargs.get("fmt")
+        if fmt not in FORMATS:
+            raise Http404("No such format")
+        try:
+            fields = self.get_export_fields()
+            queryset = self.get_queryset()
+        except (ValueError, SearchError) as e:
+            return HttpResponseBadRequest(str(e),
+                                          content_type="text/plain")
+
+        lines = getattr(self, "_" + fmt)(self._rows(queryset, fields),
+                                         fields)
+        # one write per chunk, not per row
+        size = settings.POKETRADE_EXPORT_CHUNK_SIZE
+        chunks = ("".join(itertools.islice(lines, size))
+                  for _ in itertools.count())
+        response = StreamingHttpResponse(
+                itertools.takewhile(bool, chunks),
+                content_type=FORMATS[fmt])
+        response["Content-Disposition"] = \
+                'attachment; filename="%s.%s"' % (self.export_name, fmt)
+        return response
@@ -15,7 +15,10 @@ from django.core.files import File
 from pokemontcgsdk import Card
 from PIL import Image
 
+from poketrade2.metrics import IMPORTED_CARDS
+from trading import evolution
 from trading.models import Pokemon
+from trading.similarity import INDEX
 
 
 # Offset values for cropping - don't change
@@ -131,6 +134,7 @@ class Command(BaseCommand):
                 self.stderr.write("    * cannot add image {} {}".format(
                     e.__class__.__name__, str(e)))
         pk.save()
+        IMPORTED_CARDS.inc(source="tcg")
 
 
     def add_arguments(self, parser):
@@ -139,11 +143,20 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         self.stdout.write("Query: {}".format(repr(options["q"])))
+        # saves add to the similar card index as we go
+        if not INDEX.load():
+            INDEX.build()
+        added = 0
         for poke in Card.where(q=options["q"]):
             self.stdout.write("Adding {}".format(repr(poke.name)))
             if Pokemon.objects.filter(tcg_id__exact=poke.id):
                 self.stdout.write("    * Already exists in DB")
                 continue
             self._add_pokemon(poke)
+            added += 1
+        if added:
+            INDEX.save()
+            # drops the edges of species no card names any more
+            evolution.rebuild()
 
 
@@ -0,0 +1,170 @@
+"""Benchmark the SQLite database profiles
+
+Runs concurrent market-page readers against concurrent buyers on a
+scratch database, once per profile, and reports the throughput of
+each as JSON. The production database is never touched.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from poketrade2.dbprofiles import PROFILES, get_pragmas
+
+
+# A stripped down version of the trading tables - enough to make the
+# buy transaction and the market page do the same I/O.
+SCHEMA = (
+    "CREATE TABLE user (id INTEGER PRIMARY KEY, coins INTEGER)",
+    "CREATE TABLE pokemon (id INTEGER PRIMARY KEY, name TEXT, "
+    "sell_price REAL, owner_id INTEGER REFERENCES user(id))",
+    "CREATE INDEX ix_pokemon_owner ON pokemon (owner_id)",
+)
+
+
+def _connect(path, profile):
+    """Open a connection the way Django would for a profile.
+    """
+    conn = sqlite3.connect(path, timeout=5, isolation_level=None,
+                           check_same_thread=False)
+    for pragma in get_pragmas(profile):
+        conn.execute("PRAGMA %s=%s" % pragma)
+    return conn
+
+
+def _seed(path, profile, users, rows):
+    conn = _connect(path, profile)
+    for stmt in SCHEMA:
+        conn.execute(stmt)
+    rng = random.Random(0)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO user VALUES (?, ?)",
+                     ((i, 10 ** 9) for i in range(1, users + 1)))
+    conn.executemany("INSERT INTO pokemon VALUES (?, ?, ?, ?)",
+                     ((i, "pokemon %d" % i, rng.randint(1, 100),
+                       rng.randint(1, users)) for i in range(1, rows + 1)))
+    conn.execute("COMMIT")
+    conn.close()
+
+
+def _reader(conn, rows, stop, stats):
+    rng = random.Random()
+    while not stop.is_set():
+        try:
+            conn.execute("SELECT id, name, sell_price FROM pokemon "
+                         "WHERE sell_price > 0 ORDER BY id LIMIT 100 "
+                         "OFFSET ?", (rng.randrange(rows),)).fetchall()
+            stats["reads"] += 1
+        except sqlite3.OperationalError:
+            stats["read_errors"] += 1
+
+
+def _writer(conn, begin, users, rows, stop, stats):
+    rng = random.Random()
+    while not stop.is_set():
+        pok, buyer = rng.randint(1, rows), rng.randint(1, users)
+        try:
+            conn.execute(begin)
+            price, seller = conn.execute(
+                    "SELECT sell_price, owner_id FROM pokemon WHERE id=?",
+                    (pok,)).fetchone()
+            conn.execute("UPDATE user SET coins = coins - ? WHERE id=?",
+                         (price, buyer))
+            conn.execute("UPDATE user SET coins = coins + ? WHERE id=?",
+                         (price, seller))
+            conn.execute("UPDATE pokemon SET owner_id=? WHERE id=?",
+                         (buyer, pok))
+            conn.execute("COMMIT")
+            stats["writes"] += 1
+        except sqlite3.OperationalError:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            stats["write_errors"] += 1
+
+
+def run_profile(profile, *, readers, writers, duration, users, rows):
+    """Benchmark a single profile.
+
+    :param profile: The name of the profile to benchmark
+    :type profile: str
+    :return: Throughput and error counts of the run
+    :rtype: dict
+    """
+    mode = PROFILES[profile]["transaction_mode"]
+    begin = "BEGIN %s" % mode if mode else "BEGIN"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.sqlite3")
+        _seed(path, profile, users, rows)
+
+        stop = threading.Event()
+        stats = list()
+        threads = list()
+        conns = list()
+        for i in range(readers + writers):
+            conn = _connect(path, profile)
+            st = {"reads": 0, "writes": 0, "read_errors": 0,
+                  "write_errors": 0}
+            if i < readers:
+                args = (_reader, (conn, rows, stop, st))
+            else:
+                args = (_writer, (conn, begin, users, rows, stop, st))
+            threads.append(threading.Thread(target=args[0], args=args[1]))
+            stats.append(st)
+            conns.append(conn)
+
+        for t in threads:
+            t.start()
+        time.sleep(duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        for conn in conns:
+            conn.close()
+
+    total = {k: sum(x[k] for x in stats) for k in stats[0]}
+    return {
+        "reads_per_sec": round(total["reads"] / duration, 1),
+        "writes_per_sec": round(total["writes"] / duration, 1),
+        "read_errors": total["read_errors"],
+        "write_errors": total["write_errors"],
+    }
+
+
+class Command(BaseCommand):
+    help = ("Benchmark concurrent reads and purchases on each SQLite "
+            "database profile.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--profile", action="append",
+                            choices=sorted(PROFILES),
+                            help="Profile to benchmark (repeatable). "
+                                 "Default: all")
+        parser.add_argument("--readers", type=int, default=4)
+        parser.add_argument("--writers", type=int, default=2)
+        parser.add_argument("--duration", type=float, default=5,
+                            help="Seconds to run each profile for")
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--rows", type=int, default=20000)
+
+    def handle(self, *args, **options):
+        if options["readers"] + options["writers"] < 1:
+            raise CommandError("Need at least one reader or writer")
+
+        report = dict()
+        for profile in options["profile"] or sorted(PROFILES):
+            self.stderr.write("Benchmarking {}...".format(profile))
+            report[profile] = run_profile(
+                    profile, readers=options["readers"],
+                    writers=options["writers"],
+                    duration=options["duration"],
+                    users=options["users"], rows=options["rows"])
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,25 @@
+"""Rebuild the evolution chains
+
+Recomputes the ``Evolution`` table (see ``trading.evolution``) from the
+``evolves_from`` of every Pokemon. Saves keep it up to date otherwise,
+but never remove a chain - run this after renames and deletions.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from trading.evolution import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recompute the evolution chains of every species."
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        n = rebuild()
+        self.stdout.write("Wrote {} evolution rows in {:.2f}s".format(
+                n, time.perf_counter() - start))
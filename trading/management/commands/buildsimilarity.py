@@ -0,0 +1,34 @@
+"""Build the similar card index
+
+Computes the feature vector of every Pokemon (see
+``trading.similarity``) and writes them to
+``POKETRADE_SIMILARITY_INDEX``, which the web processes reload. Run it
+after bulk imports; saves keep it up to date otherwise.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from trading.similarity import INDEX
+
+
+class Command(BaseCommand):
+    help = "Rebuild the index of similar cards."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=None,
+                            help="File to write, defaults to "
+                                 "POKETRADE_SIMILARITY_INDEX")
+
+    def handle(self, *args, **options):
+        path = options["output"] or settings.POKETRADE_SIMILARITY_INDEX
+        start = time.perf_counter()
+        INDEX.build()
+        INDEX.save(path)
+        self.stdout.write("Indexed {} Pokemon in {:.2f}s, wrote {}".format(
+                len(INDEX), time.perf_counter() - start, path))
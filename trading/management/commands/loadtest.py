@@ -0,0 +1,180 @@
+"""Load-test the trading views
+
+Seeds a throwaway database with users and Pokemon, drives the list,
+search, detail, buy and sell endpoints at the requested concurrency
+and prints per-endpoint latency percentiles, throughput and query
+counts as JSON. The configured database is never touched.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import datetime
+import json
+import logging
+import os
+import tempfile
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.test.utils import (setup_test_environment,
+                               teardown_test_environment)
+from django.urls import reverse
+
+from accounts.models import User
+from trading import benchmark
+from trading.models import Pokemon, rebuild_collection_stats
+from trading.synthetic import SYLLABLES, TYPES, CatalogueGenerator
+
+
+# Default share of each endpoint in the request mix.
+DEFAULT_MIX = "list=30,search=25,detail=30,buy=10,sell=5"
+
+# Advanced queries to pick from for the search endpoint.
+SEARCHES = (
+    "name,CONTAINS,{syl}",
+    "hp,GT,{hp}",
+    "sell_price,GT,0",
+    "name,CONTAINS,{syl};hp,GTE,{hp};@AND",
+    "sell_price,GT,0;name,BEGINS,{syl};@AND",
+)
+
+
+def _seed(users, pokemon, seed):
+    """Fill the database with benchmark data.
+
+    :return: The users, the Pokemon pks and the pks for sale
+    :rtype: tuple
+    """
+    gen = CatalogueGenerator(seed, {t: ("", "pokemon_card/bench.png")
+                                    for t in TYPES})
+    usrs = list(gen.users(users, "bench"))
+    for usr in usrs:
+        # rich enough to never be refused a purchase
+        usr.coins = 10 ** 9
+    usrs = User.objects.bulk_create(usrs)
+    poks = Pokemon.objects.bulk_create(gen.pokemon(pokemon, usrs, owned=0.7),
+                                       batch_size=1000)
+    rebuild_collection_stats()
+    return (usrs, [x.pk for x in poks],
+            [x.pk for x in poks if x.sell_price > 0])
+
+
+def _endpoints(mix, pks, for_sale):
+    def _list(client, state, rng):
+        return client.get(reverse("trading:list"))
+
+    def _search(client, state, rng):
+        q = rng.choice(SEARCHES).format(syl=rng.choice(SYLLABLES),
+                                        hp=rng.randrange(30, 340, 10))
+        return client.get(reverse("trading:list"), {"q": q})
+
+    def _detail(client, state, rng):
+        return client.get(reverse("trading:single_detail",
+                                  args=[rng.choice(pks)]))
+
+    def _buy(client, state, rng):
+        pk = rng.choice(for_sale)
+        rv = client.post(reverse("trading:buy_single", args=[pk]))
+        if rv.status_code == 200:
+            state["owned"].append(pk)
+        return rv
+
+    def _sell(client, state, rng):
+        pk = rng.choice(state["owned"] or pks)
+        return client.post(reverse("trading:sell_single", args=[pk]),
+                           {"sell_price": rng.randint(0, 500)})
+
+    funcs = {"list": _list, "search": _search, "detail": _detail,
+             "buy": _buy, "sell": _sell}
+    eps = list()
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in funcs:
+            raise CommandError("No such endpoint: %s" % name)
+        try:
+            weight = float(weight)
+        except ValueError:
+            raise CommandError("Bad weight for %s" % name)
+        if weight > 0:
+            eps.append(benchmark.Endpoint(name, weight, funcs[name]))
+    if not eps:
+        raise CommandError("Nothing to benchmark")
+    return eps
+
+
+def _setup_worker(user):
+    return {"owned": list(user.pokemons.values_list("pk", flat=True))}
+
+
+class Command(BaseCommand):
+    help = ("Load-test the trading views on a throwaway database and "
+            "report latency, throughput and query counts as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--pokemon", type=int, default=5000)
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--mix", default=DEFAULT_MIX,
+                            help="Endpoint weights, default: %s"
+                                 % DEFAULT_MIX)
+        parser.add_argument("-o", "--output",
+                            help="Write the report here instead of stdout")
+
+    def handle(self, *args, **options):
+        if options["users"] < 1 or options["pokemon"] < 1:
+            raise CommandError("Need at least one user and one Pokemon")
+        if options["concurrency"] < 1:
+            raise CommandError("Concurrency must be at least 1")
+
+        # lost races on buy/sell are expected, do not log each one
+        logging.getLogger("django.request").setLevel(logging.CRITICAL)
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            # a file, not memory, so that worker threads do not trip
+            # over SQLite's shared-cache table locks. The alias itself
+            # points there too, so nothing connecting before (or
+            # after) the test database is set up can open - and create
+            # - the configured database.
+            path = os.path.join(tmp, "loadtest.sqlite3")
+            connection.close()
+            connection.settings_dict["NAME"] = path
+            connection.settings_dict["TEST"]["NAME"] = path
+            old_config = runner.setup_databases()
+            try:
+                self.stderr.write("Seeding...")
+                users, pks, for_sale = _seed(options["users"],
+                                             options["pokemon"],
+                                             options["seed"])
+                if not for_sale:
+                    raise CommandError("Nothing was put up for sale")
+                self.stderr.write("Running...")
+                result = benchmark.run(
+                        _endpoints(options["mix"], pks, for_sale), users,
+                        concurrency=options["concurrency"],
+                        requests=options["requests"],
+                        seed=options["seed"], setup=_setup_worker)
+            finally:
+                runner.teardown_databases(old_config)
+                teardown_test_environment()
+
+        report = {
+            "started_at": datetime.datetime.now(datetime.timezone.utc)
+                          .isoformat(),
+            "django": django.get_version(),
+            "params": {k: options[k] for k in ("users", "pokemon",
+                                                "concurrency", "requests",
+                                                "seed", "mix")},
+            **result,
+        }
+        out = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as fp:
+                fp.write(out + "\n")
+        else:
+            self.stdout.write(out)
@@ -0,0 +1,43 @@
+"""Prune old collection changes
+
+Deletes the collection changes (see ``trading.models.CollectionChange``)
+older than ``POKETRADE_SYNC_RETENTION_DAYS``. Clients holding a token
+from before then are told to resync.
+
+Changes are deleted oldest first, by id, and the newest change is
+always kept, so that the sync endpoint can tell pruned tokens apart.
+Run it daily.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from trading.models import CollectionChange
+
+
+class Command(BaseCommand):
+    help = "Delete collection changes older than the retention period."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int,
+                            default=settings.POKETRADE_SYNC_RETENTION_DAYS,
+                            help="Keep changes this many days old")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options["days"])
+        agg = CollectionChange.objects.aggregate(
+                last=Max("id"),
+                old=Max("id", filter=Q(created_at__lt=cutoff)))
+        if agg["old"] is None:
+            self.stdout.write("Nothing to prune")
+            return
+        upto = min(agg["old"], agg["last"] - 1)
+        n, _ = CollectionChange.objects.filter(id__lte=upto).delete()
+        self.stdout.write("Pruned {} changes".format(n))
@@ -0,0 +1,31 @@
+"""Rebuild the collection statistics of users
+
+The statistics on ``User`` (card count, cost basis, market value and
+listed count) are kept up to date by ``Pokemon.save``, but bulk
+operations such as ``seeddata`` and ``QuerySet.update`` skip it. This
+recomputes them from the cards with a single grouped query.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from trading.models import rebuild_collection_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute the collection statistics of users."
+
+    def add_arguments(self, parser):
+        parser.add_argument("users", nargs="*", type=int,
+                            help="Ids of the users to rebuild, defaults "
+                                 "to all")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        rebuild_collection_stats(options["users"] or None)
+        self.stdout.write("Rebuilt statistics in {:.2f}s".format(
+                time.perf_counter() - start))
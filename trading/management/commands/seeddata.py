@@ -0,0 +1,80 @@
+"""Seed the database with a synthetic catalogue
+
+Streams generated users and Pokemon into the database with
+``bulk_create`` in chunks, so catalogues with a million cards can be
+built in minutes. The same seed always gives the same data.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from accounts.models import User
+from poketrade2.metrics import IMPORTED_CARDS
+from trading.models import Pokemon, bump_catalogue_generation, \
+        rebuild_collection_stats
+from trading.synthetic import CatalogueGenerator, chunked, \
+        placeholder_images
+
+
+class Command(BaseCommand):
+    help = "Seed the database with synthetic users and Pokemon."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pokemon", type=int, default=10000,
+                            help="Number of Pokemon to generate")
+        parser.add_argument("--users", type=int, default=100,
+                            help="Number of users to generate")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--chunk-size", type=int, default=5000)
+        parser.add_argument("--prefix", default="trainer",
+                            help="Prefix of the generated usernames")
+        parser.add_argument("--owned", type=float, default=0.3,
+                            help="Fraction of Pokemon with an owner")
+        parser.add_argument("--for-sale", type=float, default=0.4,
+                            help="Fraction of owned Pokemon for sale")
+        parser.add_argument("--no-images", action="store_true",
+                            help="Do not set placeholder images")
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("Chunk size must be at least 1")
+        if not (0 <= options["owned"] <= 1
+                and 0 <= options["for_sale"] <= 1):
+            raise CommandError("Fractions must be between 0 and 1")
+        if User.objects.filter(
+                username__startswith=options["prefix"]).exists():
+            raise CommandError("Users named {}* already exist, pick "
+                               "another --prefix".format(options["prefix"]))
+
+        start = time.perf_counter()
+        images = None if options["no_images"] else placeholder_images()
+        gen = CatalogueGenerator(options["seed"], images)
+
+        users = list()
+        for chunk in chunked(gen.users(options["users"], options["prefix"]),
+                             options["chunk_size"]):
+            users += User.objects.bulk_create(chunk)
+        self.stdout.write("Created {} users".format(len(users)))
+
+        done = 0
+        for chunk in chunked(gen.pokemon(options["pokemon"], users,
+                                         owned=options["owned"],
+                                         for_sale=options["for_sale"]),
+                             options["chunk_size"]):
+            with transaction.atomic():
+                Pokemon.objects.bulk_create(chunk)
+            IMPORTED_CARDS.inc(len(chunk), source="synthetic")
+            # bulk_create skips save()
+            bump_catalogue_generation()
+            done += len(chunk)
+            self.stdout.write("Created {} Pokemon ({:.0f}/s)".format(
+                done, done / (time.perf_counter() - start)))
+
+        # bulk_create skips the owners' statistics too
+        rebuild_collection_stats()
+        self.stdout.write("Rebuilt the collection statistics")
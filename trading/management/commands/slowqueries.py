@@ -0,0 +1,86 @@
+"""Summarize the slow query log
+
+Groups the records of the slow query log (see ``poketrade2.slowlog``)
+by statement shape and prints the shapes that cost the most time in
+total, each with its slowest example: parameters, search and query
+plan. Plans with ``SCAN`` over a big table are the ones to index.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from poketrade2.slowlog import query_shape, read_records
+
+
+def summarize(records):
+    """Group slow query records by shape.
+
+    :param records: The records, as read by ``read_records``
+    :return: One dict per shape, the most total time first
+    :rtype: list
+    """
+    shapes = dict()
+    for rec in records:
+        shape = query_shape(rec["sql"])
+        s = shapes.get(shape)
+        if s is None:
+            s = shapes[shape] = {"shape": shape, "count": 0,
+                                 "total_ms": 0.0, "max_ms": 0.0,
+                                 "searches": set(), "slowest": rec}
+        s["count"] += 1
+        s["total_ms"] += rec["ms"]
+        if rec["ms"] >= s["max_ms"]:
+            s["max_ms"] = rec["ms"]
+            s["slowest"] = rec
+        if rec.get("q"):
+            s["searches"].add(rec["q"])
+
+    rv = sorted(shapes.values(), key=lambda x: x["total_ms"], reverse=True)
+    for s in rv:
+        s["total_ms"] = round(s["total_ms"], 2)
+        s["mean_ms"] = round(s["total_ms"] / s["count"], 2)
+        s["searches"] = sorted(s["searches"])
+    return rv
+
+
+class Command(BaseCommand):
+    help = "Summarize the worst query shapes of the slow query log."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", default=None,
+                            help="Log to read, defaults to "
+                                 "POKETRADE_SLOW_QUERY_LOG")
+        parser.add_argument("--top", type=int, default=10,
+                            help="Number of shapes to show")
+        parser.add_argument("--json", action="store_true",
+                            help="Print JSON instead of text")
+
+    def handle(self, *args, **options):
+        path = options["file"] or settings.POKETRADE_SLOW_QUERY_LOG
+        shapes = summarize(read_records(path))[:options["top"]]
+
+        if options["json"]:
+            self.stdout.write(json.dumps(shapes, indent=2, default=str))
+            return
+        if not shapes:
+            self.stdout.write("No slow queries in {}".format(path))
+            return
+
+        for i, s in enumerate(shapes, 1):
+            slowest = s["slowest"]
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                    "{}. {} runs, {} ms total, {} ms mean, {} ms max"
+                    .format(i, s["count"], s["total_ms"], s["mean_ms"],
+                            s["max_ms"])))
+            self.stdout.write("   " + s["shape"])
+            self.stdout.write("   slowest: {} params={}".format(
+                    slowest.get("path"), slowest.get("params")))
+            for q in s["searches"][:5]:
+                self.stdout.write("   search: " + q)
+            for step in slowest.get("plan") or ():
+                self.stdout.write("   plan: " + step)
@@ -0,0 +1,48 @@
+"""Record the prices of every Pokemon
+
+Copies the market prices of every card into its price history (see
+``trading.pricehistory``), then rolls old days up into weeks and
+months. Run it daily, after prices are synced.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from trading.pricehistory import compact, snapshot
+
+
+class Command(BaseCommand):
+    help = "Record today's prices of every Pokemon in their history."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--date", default=None,
+                            help="Day to record the prices as "
+                                 "(YYYY-MM-DD), defaults to today")
+        parser.add_argument("--no-compact", action="store_true",
+                            help="Do not roll up old prices")
+
+    def handle(self, *args, **options):
+        day = None
+        if options["date"]:
+            try:
+                day = datetime.date.fromisoformat(options["date"])
+            except ValueError:
+                raise CommandError("Invalid date: " + options["date"])
+
+        start = time.perf_counter()
+        n = snapshot(day)
+        self.stdout.write("Recorded {} prices in {:.2f}s".format(
+                n, time.perf_counter() - start))
+        if options["no_compact"]:
+            return
+
+        start = time.perf_counter()
+        weeks, months = compact(day)
+        self.stdout.write("Rolled up into {} weeks and {} months in "
+                          "{:.2f}s".format(weeks, months,
+                                           time.perf_counter() - start))
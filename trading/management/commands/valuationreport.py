@@ -0,0 +1,49 @@
+"""Write the nightly valuation report
+
+Values every user's collection (see ``trading.valuation``) and writes
+the leaderboards, totals and each user's valuation as JSON to
+``POKETRADE_VALUATION_REPORT``, where the leaderboard and profile pages
+read them. Run it nightly, after prices
+are imported.
+"""
+
+__all__ = ["Command"]
+__author__ = "Advaith Menon"
+
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from trading.valuation import Valuation
+
+
+class Command(BaseCommand):
+    help = "Value every collection and write the leaderboards."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=None,
+                            help="File to write, defaults to "
+                                 "POKETRADE_VALUATION_REPORT")
+        parser.add_argument("--top", type=int, default=None,
+                            help="Users per leaderboard")
+
+    def handle(self, *args, **options):
+        path = options["output"] or settings.POKETRADE_VALUATION_REPORT
+        start = time.perf_counter()
+        valuation = Valuation.load()
+        loaded = time.perf_counter()
+        report = valuation.report(options["top"])
+
+        # readers never see a half-written report
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(report, f)
+        os.replace(tmp, path)
+        self.stdout.write(
+                "Valued {} collections in {:.2f}s ({:.2f}s loading), "
+                "wrote {}".format(report["users"],
+                                  time.perf_counter() - start,
+                                  loaded - start, path))
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0010_alter_pokemon_artist_alter_pokemon_flavortext_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pokemon',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
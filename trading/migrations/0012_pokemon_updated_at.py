@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0011_pokemon_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pokemon',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
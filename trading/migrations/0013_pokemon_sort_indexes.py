@@ -0,0 +1,71 @@
+# Generated by Django 5.2 on 2026-10-19 12:54
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0012_pokemon_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['sell_price', 'id'], name='ix_pokemon_sell_price'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['hp', 'id'], name='ix_pokemon_hp'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['name', 'id'], name='ix_pokemon_name'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['rarity', 'id'], name='ix_pokemon_rarity'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['updated_at', 'id'], name='ix_pokemon_updated_at'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['owner', 'sell_price', 'id'], name='ix_pokemon_owner_sell_price'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['owner', 'hp', 'id'], name='ix_pokemon_owner_hp'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['owner', 'name', 'id'], name='ix_pokemon_owner_name'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['owner', 'rarity', 'id'], name='ix_pokemon_owner_rarity'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['owner', 'updated_at', 'id'], name='ix_pokemon_owner_updated_at'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['rarity', 'sell_price', 'id'], name='ix_pokemon_rarity_sell_price'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['rarity', 'hp', 'id'], name='ix_pokemon_rarity_hp'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['rarity', 'name', 'id'], name='ix_pokemon_rarity_name'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['rarity', 'updated_at', 'id'], name='ix_pokemon_rarity_updated_at'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-19 13:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0014_collectionchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('D', 'Day'), ('W', 'Week'), ('M', 'Month')], max_length=1)),
+                ('period', models.DateField()),
+                ('average_sell_price', models.FloatField(null=True)),
+                ('low_price', models.FloatField(null=True)),
+                ('trend_price', models.FloatField(null=True)),
+                ('suggested_price', models.FloatField(null=True)),
+                ('pokemon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_history', to='trading.pokemon')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['resolution', 'period'], name='ix_pricesnapshot_res_period')],
+                'constraints': [models.UniqueConstraint(fields=('pokemon', 'period', 'resolution'), name='uniq_pricesnapshot_period')],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2 on 2026-10-19 13:16
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_chains(apps, schema_editor):
+    # see trading.evolution.rebuild
+    from trading.evolution import closure
+    Evolution = apps.get_model("trading", "Evolution")
+    Pokemon = apps.get_model("trading", "Pokemon")
+    pairs = Pokemon.objects.exclude(evolves_from=None) \
+            .exclude(evolves_from="").order_by() \
+            .values_list("name", "evolves_from").distinct()
+    rows = {(name, rel): offset for name, rel, offset in closure(pairs)}
+    Evolution.objects.bulk_create(
+            (Evolution(name=name, relative=rel, offset=offset)
+             for (name, rel), offset in rows.items()),
+            batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0015_pricesnapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Evolution',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256)),
+                ('relative', models.CharField(max_length=256)),
+                ('offset', models.SmallIntegerField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['evolves_from'], name='ix_pokemon_evolves_from'),
+        ),
+        migrations.AddConstraint(
+            model_name='evolution',
+            constraint=models.UniqueConstraint(fields=('name', 'relative'), name='uniq_evolution_pair'),
+        ),
+        migrations.RunPython(build_chains, migrations.RunPython.noop),
+    ]
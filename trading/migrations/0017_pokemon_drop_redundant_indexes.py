@@ -0,0 +1,34 @@
+# Generated by Django 5.2 on 2026-10-19 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0016_evolution'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='pokemon',
+            name='ix_pokemon_owner_sell_price',
+        ),
+        migrations.RemoveIndex(
+            model_name='pokemon',
+            name='ix_pokemon_owner_hp',
+        ),
+        migrations.RemoveIndex(
+            model_name='pokemon',
+            name='ix_pokemon_owner_rarity',
+        ),
+        migrations.RemoveIndex(
+            model_name='pokemon',
+            name='ix_pokemon_owner_updated_at',
+        ),
+        migrations.AlterField(
+            model_name='pokemon',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
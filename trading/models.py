@@ -4,14 +4,90 @@ Since PokeTrade2 is already used as the application management folder,
 we have to use a separate folder. "Trading" sounded the best.
 """
 
-__all__ = ["TradingPolicy", "Pokemon", "Ability", "Attack"]
+__all__ = ["TradingPolicy", "Pokemon", "Ability", "Attack",
+           "CollectionChange", "PriceSnapshot", "catalogue_generation",
+           "bump_catalogue_generation", "rebuild_collection_stats"]
 __author__ = "Advaith Menon"
 
-from django.db import models
+import collections
+import time
 
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Q, Sum, When
+from django.utils import timezone
+
+from accounts.leaderboard import bump_leaderboard_generation
 from accounts.models import User
 
 
+# Fields the Pokemon lists can be sorted by.
+SORT_FIELDS = ("sell_price", "hp", "name", "rarity", "updated_at")
+
+# Cache key of the catalogue generation.
+CATALOGUE_GENERATION_KEY = "trading:catalogue_generation"
+
+
+def catalogue_generation():
+    """Get the catalogue generation.
+
+    The generation changes whenever a Pokemon is saved or deleted, so
+    caches of search results (counts, pages) keyed on it never serve
+    stale data. Starts from the clock, so an evicted generation never
+    comes back to an old value.
+
+    :rtype: int
+    """
+    return cache.get_or_set(CATALOGUE_GENERATION_KEY, time.time_ns(),
+                            None)
+
+
+def bump_catalogue_generation():
+    """Invalidate every cache keyed on the catalogue generation.
+
+    Called by ``Pokemon.save`` and ``Pokemon.delete``; call it by hand
+    after bulk operations.
+    """
+    try:
+        cache.incr(CATALOGUE_GENERATION_KEY)
+    except ValueError:
+        # evicted
+        cache.set(CATALOGUE_GENERATION_KEY, time.time_ns(), None)
+
+
+def rebuild_collection_stats(users=None):
+    """Recompute the collection statistics of users from their cards.
+
+    See ``User.card_count``; these are normally kept up to date by
+    ``Pokemon.save``. Uses one grouped query for the cards.
+
+    :param users: The ids of the users to rebuild, or None for all
+    :type users: iterable
+    """
+    owned = Pokemon.objects.filter(owner__isnull=False)
+    accounts = User.objects.all()
+    if users is not None:
+        users = list(users)
+        owned = owned.filter(owner__in=users)
+        accounts = accounts.filter(pk__in=users)
+    stats = owned.order_by().values("owner").annotate(
+            card_count=Count("pk"),
+            cost_basis=Sum("cost_price"),
+            market_value=Sum(Case(When(trend_price__gt=0,
+                                       then=F("trend_price")),
+                                  default=F("suggested_price"))),
+            listed_count=Count("pk", filter=Q(sell_price__gt=0)))
+    with transaction.atomic():
+        accounts.update(version=F("version") + 1,
+                        updated_at=timezone.now(),
+                        **dict.fromkeys(User.STAT_FIELDS, 0))
+        User.objects.bulk_update(
+                (User(pk=x["owner"], **{f: x[f] for f in User.STAT_FIELDS})
+                 for x in stats.iterator()),
+                User.STAT_FIELDS, batch_size=500)
+    bump_leaderboard_generation()
+
+
 class TradingPolicy(object):
     """Represents the trading policy of a pokemon.
 
@@ -111,8 +187,8 @@ class Pokemon(models.Model):
     # robots take over the world, there will be nothing left. Just
     # better robots.
     # evolvesTo = models.CharField(max_length=127, null=True, blank=True)
-    # NOTE: we don't need evolvesTo, we can just query for all
-    # "children" of a pokemon since evolvesFrom is a PK.
+    # NOTE: we don't need evolvesTo - evolves_from is a name, and
+    # whole chains are precomputed in Evolution (see trading.evolution).
 
     # separated by newlines
     rules = models.TextField(default="", blank=True);
@@ -197,9 +273,127 @@ class Pokemon(models.Model):
                               null=True, blank=True,
                               related_name="pokemons")
 
+    # Row version, bumped on every save. Rendered fragments (card tiles,
+    # collection rows) are cached under this number, so a save is all
+    # it takes to invalidate them.
+    # NOTE: QuerySet.update() does not call save() - bump it by hand
+    # with F("version") + 1 (and set updated_at) if you change rendered
+    # fields that way.
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # Last time the row was saved. ix_pokemon_updated_at lets list pages
+    # get their Last-Modified/ETag with a single MAX() query.
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # One index per sort of the list pages, the id breaking ties:
+        # unfiltered (market) and by rarity (the usual exact filter), so
+        # sorted pages are read in index order. Collections are small -
+        # the owner index finds them and other sorts are done as read,
+        # but their default (by name) has an index of its own. See
+        # QueryableMixin.sort_fields.
+        indexes = [
+                *(models.Index(fields=[f, "id"], name="ix_pokemon_%s" % f)
+                  for f in SORT_FIELDS),
+                models.Index(fields=["owner", "name", "id"],
+                             name="ix_pokemon_owner_name"),
+                *(models.Index(fields=["rarity", f, "id"],
+                               name="ix_pokemon_rarity_%s" % f)
+                  for f in SORT_FIELDS if f != "rarity"),
+                # children of a species, and the evolves_from filter
+                models.Index(fields=["evolves_from"],
+                             name="ix_pokemon_evolves_from"),
+                ];
+
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        obj = super().from_db(db, field_names, values)
+        # the values as loaded, so post_save receivers can tell what a
+        # save changed (see trading.autocomplete)
+        obj._loaded = {f: v for f, v in zip(field_names, values)
+                       if v is not models.DEFERRED}
+        return obj
+
+    # Fields the collection statistics of the owner depend on.
+    STAT_SOURCE_FIELDS = ("owner_id", "cost_price", "sell_price",
+                          "trend_price", "suggested_price")
+
+    @staticmethod
+    def stat_contribution(values):
+        """Get what a Pokemon adds to its owner's collection statistics.
+
+        :param values: The ``STAT_SOURCE_FIELDS`` of the Pokemon
+        :type values: dict
+        :return: Stat field (see ``User.STAT_FIELDS``) -> amount
+        :rtype: dict
+        """
+        trend = values["trend_price"]
+        return {"card_count": 1,
+                "cost_basis": values["cost_price"],
+                "market_value": (trend if trend > 0
+                                 else values["suggested_price"]),
+                "listed_count": int(values["sell_price"] > 0)}
+
+    def _update_owner_stats(self, old, new):
+        """Move this Pokemon's statistics from its old to its new owner.
+
+        :param old: The values before the change, empty if there were
+            none, None if unknown
+        :type old: dict
+        :param new: The values after the change, empty if deleted
+        :type new: dict
+        """
+        fields = self.STAT_SOURCE_FIELDS
+        if old is None or any(x and not all(f in x for f in fields)
+                              for x in (old, new)):
+            # deferred fields - cannot tell what changed
+            rebuild_collection_stats({(old or {}).get("owner_id"),
+                                      new.get("owner_id")} - {None})
+            return
+        deltas = collections.defaultdict(collections.Counter)
+        if old.get("owner_id") is not None:
+            deltas[old["owner_id"]].subtract(self.stat_contribution(old))
+        if new.get("owner_id") is not None:
+            deltas[new["owner_id"]].update(self.stat_contribution(new))
+        User.add_stats(deltas)
+
+    def save(self, *args, **kwargs):
+        """Save the Pokemon, bumping its row version and the catalogue
+        generation, and logging collection changes and the owner's
+        statistics.
+        """
+        self.version = (self.version or 0) + 1
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "version",
+                                       "updated_at"}
+        adding = self._state.adding
+        # no savepoint - if the log fails, so does the save
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+            CollectionChange.log(self, adding)
+            self._update_owner_stats(
+                    {} if adding else getattr(self, "_loaded", None),
+                    self.__dict__)
+        bump_catalogue_generation()
+        self._loaded = {f.attname: getattr(self, f.attname)
+                        for f in self._meta.concrete_fields
+                        if f.attname in self.__dict__}
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(savepoint=False):
+            if self.owner_id is not None:
+                CollectionChange.objects.create(
+                        user_id=self.owner_id, pokemon_id=self.pk,
+                        kind=CollectionChange.Kind.REMOVED)
+            old = getattr(self, "_loaded", self.__dict__)
+            rv = super().delete(*args, **kwargs)
+            self._update_owner_stats(old, {})
+        bump_catalogue_generation()
+        return rv
+
     @property
     def weaknesses(self):
         """A Pythonic Getter for weaknesses.
@@ -408,3 +602,132 @@ class Attack(models.Model):
                 ];
 
 
+class CollectionChange(models.Model):
+    """A change to a user's collection, for delta syncs.
+
+    The id of the latest change a client has seen is its sync token:
+    the changes after it are all it needs to catch up. Written by
+    ``Pokemon.save`` and ``Pokemon.delete``; bulk operations do not log
+    changes. Old changes are removed by ``manage.py prunechanges``.
+    """
+    class Kind(models.TextChoices):
+        ADDED = "A", "Added"
+        REMOVED = "R", "Removed"
+        MODIFIED = "M", "Modified"
+
+    # Changes of these fields (besides the owner) are logged - every
+    # field the sync endpoint returns, but the id and version (which
+    # every save bumps).
+    TRACKED_FIELDS = ("name", "hp", "rarity", "sell_price", "cost_price",
+                      "trend_price")
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name="collection_changes")
+    # not a foreign key - removals outlive the Pokemon
+    pokemon_id = models.BigIntegerField()
+    kind = models.CharField(max_length=1, choices=Kind)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+                models.Index(fields=["user", "id"],
+                             name="ix_collectionchange_user_id"),
+                ];
+
+    @classmethod
+    def log(cls, pokemon, adding):
+        """Log the changes a save made to collections.
+
+        :param pokemon: The Pokemon just saved
+        :type pokemon: class`Pokemon`
+        :param adding: Whether the Pokemon was just created
+        :type adding: bool
+        """
+        new_owner = pokemon.owner_id
+        if adding:
+            old, old_owner = {}, None
+        else:
+            # without values loaded by from_db, the owner is assumed
+            # unchanged and everything else changed
+            old = getattr(pokemon, "_loaded", {})
+            old_owner = old.get("owner_id", new_owner)
+
+        changes = list()
+        if old_owner != new_owner:
+            if old_owner is not None:
+                changes.append(cls(user_id=old_owner, pokemon_id=pokemon.pk,
+                                   kind=cls.Kind.REMOVED))
+            if new_owner is not None:
+                changes.append(cls(user_id=new_owner, pokemon_id=pokemon.pk,
+                                   kind=cls.Kind.ADDED))
+        elif new_owner is not None and any(
+                f not in old or old[f] != getattr(pokemon, f)
+                for f in cls.TRACKED_FIELDS):
+            changes.append(cls(user_id=new_owner, pokemon_id=pokemon.pk,
+                               kind=cls.Kind.MODIFIED))
+        if changes:
+            cls.objects.bulk_create(changes)
+
+
+class PriceSnapshot(models.Model):
+    """The market prices of a Pokemon over a day, week or month.
+
+    ``manage.py snapshotprices`` records the prices of every card daily,
+    then (unless given ``--no-compact``) rolls old days up into weeks,
+    and old weeks into months, so each card keeps a bounded number of
+    rows: ``POKETRADE_PRICE_DAILY_DAYS`` of days, weeks up to
+    ``POKETRADE_PRICE_WEEKLY_DAYS`` and then a row per month.
+    """
+    class Resolution(models.TextChoices):
+        DAY = "D", "Day"
+        WEEK = "W", "Week"
+        MONTH = "M", "Month"
+
+    # The Pokemon fields recorded.
+    PRICE_FIELDS = ("average_sell_price", "low_price", "trend_price",
+                    "suggested_price")
+
+    pokemon = models.ForeignKey(Pokemon, on_delete=models.CASCADE,
+                                related_name="price_history")
+    resolution = models.CharField(max_length=1, choices=Resolution)
+    # the first day of the period
+    period = models.DateField()
+    # averages over the period; NULL if the card had no price (the
+    # Pokemon fields use 0), so that averages skip it
+    average_sell_price = models.FloatField(null=True)
+    low_price = models.FloatField(null=True)
+    trend_price = models.FloatField(null=True)
+    suggested_price = models.FloatField(null=True)
+
+    class Meta:
+        constraints = [
+                # also the index of a card's series, in order
+                models.UniqueConstraint(
+                    fields=["pokemon", "period", "resolution"],
+                    name="uniq_pricesnapshot_period"),
+                ];
+        indexes = [
+                models.Index(fields=["resolution", "period"],
+                             name="ix_pricesnapshot_res_period"),
+                ];
+
+
+class Evolution(models.Model):
+    """Two species (Pokemon names) of the same evolution chain.
+
+    A closure table over ``Pokemon.evolves_from``: a species has a row
+    for itself and for each of its ancestors and descendants, so its
+    whole chain is one indexed lookup. Maintained by
+    ``trading.evolution``; ``manage.py buildevolutions`` rebuilds it.
+    """
+    name = models.CharField(max_length=256)
+    relative = models.CharField(max_length=256)
+    # generations from name to relative, negative for ancestors
+    offset = models.SmallIntegerField()
+
+    class Meta:
+        constraints = [
+                # also the index of a chain
+                models.UniqueConstraint(fields=["name", "relative"],
+                                        name="uniq_evolution_pair"),
+                ];
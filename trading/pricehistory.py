@@ -0,0 +1,134 @@
+"""Price history
+
+Records the market prices of every Pokemon daily and rolls old days up
+into weekly and monthly averages; see ``PriceSnapshot``. Periods are
+rolled up whole: a week once all its days are older than
+``POKETRADE_PRICE_DAILY_DAYS``, and a month once all its weeks started
+over ``POKETRADE_PRICE_WEEKLY_DAYS`` ago. A week counts towards the
+month it starts in.
+"""
+
+__all__ = ["snapshot", "compact", "series"]
+__author__ = "Advaith Menon"
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg
+from django.db.models.functions import TruncMonth, TruncWeek
+from django.utils import timezone
+
+from .models import Pokemon, PriceSnapshot
+
+
+_UNIQUE = ("pokemon", "period", "resolution")
+
+
+def _save(rows, chunk_size):
+    """Insert snapshots, replacing those of the same period."""
+    batch = list()
+    n = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            n += _flush(batch)
+    return n + _flush(batch)
+
+
+def _flush(batch):
+    if batch:
+        with transaction.atomic():
+            PriceSnapshot.objects.bulk_create(
+                    batch, update_conflicts=True, unique_fields=_UNIQUE,
+                    update_fields=PriceSnapshot.PRICE_FIELDS)
+    n = len(batch)
+    batch.clear()
+    return n
+
+
+def snapshot(day=None, chunk_size=None):
+    """Record the current prices of every Pokemon.
+
+    Running it again on the same day replaces that day's prices.
+
+    :param day: The day to record them as, defaults to today
+    :type day: class`datetime.date`
+    :param chunk_size: Rows written per transaction
+    :type chunk_size: int
+    :return: The number of snapshots written
+    :rtype: int
+    """
+    day = day or timezone.localdate()
+    chunk_size = chunk_size or settings.POKETRADE_EXPORT_CHUNK_SIZE
+    fields = PriceSnapshot.PRICE_FIELDS
+    rows = Pokemon.objects.order_by().values_list("pk", *fields) \
+            .iterator(chunk_size=chunk_size)
+    # 0 is no price
+    return _save((PriceSnapshot(
+                pokemon_id=row[0], period=day,
+                resolution=PriceSnapshot.Resolution.DAY,
+                **{f: v or None for f, v in zip(fields, row[1:])})
+            for row in rows), chunk_size)
+
+
+def _rollup(src, dst, trunc, before, chunk_size):
+    """Average the src snapshots before a day into dst snapshots."""
+    old = PriceSnapshot.objects.filter(resolution=src, period__lt=before)
+    rows = old.annotate(bucket=trunc("period")).order_by() \
+            .values("pokemon_id", "bucket") \
+            .annotate(**{f: Avg(f) for f in PriceSnapshot.PRICE_FIELDS})
+    with transaction.atomic():
+        n = _save((PriceSnapshot(
+                    pokemon_id=row["pokemon_id"], period=row["bucket"],
+                    resolution=dst,
+                    **{f: row[f] for f in PriceSnapshot.PRICE_FIELDS})
+                   for row in rows.iterator(chunk_size=chunk_size)),
+                  chunk_size)
+        old.delete()
+    return n
+
+
+def compact(today=None, chunk_size=None):
+    """Roll old days up into weeks, and old weeks into months.
+
+    :param today: The day to count ages from, defaults to today
+    :type today: class`datetime.date`
+    :param chunk_size: Rows written per transaction
+    :type chunk_size: int
+    :return: The number of (weekly, monthly) snapshots written
+    :rtype: tuple
+    """
+    today = today or timezone.localdate()
+    chunk_size = chunk_size or settings.POKETRADE_EXPORT_CHUNK_SIZE
+    Res = PriceSnapshot.Resolution
+
+    day = today - datetime.timedelta(
+            days=settings.POKETRADE_PRICE_DAILY_DAYS)
+    # the Monday starting the first week with days to keep
+    weeks = _rollup(Res.DAY, Res.WEEK, TruncWeek,
+                    day - datetime.timedelta(days=day.weekday()),
+                    chunk_size)
+
+    day = today - datetime.timedelta(
+            days=settings.POKETRADE_PRICE_WEEKLY_DAYS)
+    months = _rollup(Res.WEEK, Res.MONTH, TruncMonth, day.replace(day=1),
+                     chunk_size)
+    return weeks, months
+
+
+def series(pokemon, since=None):
+    """Get the price history of a Pokemon, oldest first.
+
+    :param pokemon: The Pokemon's id
+    :type pokemon: int
+    :param since: The first day to return
+    :type since: class`datetime.date`
+    :return: A list of dicts with the period, resolution and prices
+    :rtype: list
+    """
+    rows = PriceSnapshot.objects.filter(pokemon=pokemon)
+    if since is not None:
+        rows = rows.filter(period__gte=since)
+    return list(rows.order_by("period").values(
+            "period", "resolution", *PriceSnapshot.PRICE_FIELDS))
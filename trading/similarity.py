@@ -0,0 +1,370 @@
+"""Similar cards
+
+Recommends cards like a given one. Every Pokemon gets a numeric feature
+vector - its types, subtypes, weaknesses, resistances, HP, rarity,
+retreat cost and price - and cards are compared by the cosine of their
+vectors. Vectors are rows of one contiguous float32 array, so a lookup
+is a single matrix-vector product over the catalogue.
+
+``manage.py buildsimilarity`` writes the array to
+``POKETRADE_SIMILARITY_INDEX`` (a ``.npy`` file, with the ids next to
+it), which every process loads and reloads when it changes. Saves in
+this process update it incrementally. Servers load it at startup (see
+``warm``), building it from the database if there is no file; until
+then, there are no suggestions.
+
+Builds, and saves that change a vector, change the similarity
+generation, which pages showing similar cards put in their ETags.
+"""
+
+__all__ = ["features", "SimilarityIndex", "INDEX", "DIM", "FEATURE_FIELDS",
+           "warm", "similarity_generation", "bump_similarity_generation"]
+__author__ = "Advaith Menon"
+
+import logging
+import math
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Pokemon
+
+
+# Energy types, for types, weaknesses and resistances.
+ENERGY_TYPES = ("Colorless", "Darkness", "Dragon", "Fairy", "Fighting",
+                "Fire", "Grass", "Lightning", "Metal", "Psychic", "Water")
+_TYPE_INDEX = {t: i for i, t in enumerate(ENERGY_TYPES)}
+
+# Subtypes are many and open-ended - they are hashed into buckets.
+SUBTYPE_BUCKETS = 16
+
+_RARITIES = {r: i for i, r in enumerate(Pokemon.Rarity.values)}
+
+# Feature group -> (width, weight). Each group is scaled to its weight,
+# so groups count the same however many columns they have.
+GROUPS = {
+    "types": (len(ENERGY_TYPES), 2.0),
+    "subtypes": (SUBTYPE_BUCKETS, 1.0),
+    "weaknesses": (len(ENERGY_TYPES), 0.5),
+    "resistances": (len(ENERGY_TYPES), 0.5),
+    "hp": (1, 1.0),
+    "rarity": (len(_RARITIES), 1.0),
+    "retreat": (1, 0.5),
+    "price": (1, 1.0),
+}
+
+# The length of a feature vector.
+DIM = sum(width for width, _ in GROUPS.values())
+
+# The Pokemon fields features are made of.
+FEATURE_FIELDS = ("type_l", "subtype_l", "weakness_h", "resistance_h",
+                  "hp", "rarity", "retreat_l", "trend_price",
+                  "suggested_price", "average_sell_price")
+
+# HP and price are scaled to 1 at these.
+MAX_HP = 340
+MAX_PRICE = 1000
+
+# Cache key of the similarity generation.
+GENERATION_KEY = "trading:similarity_generation"
+
+logger = logging.getLogger(__name__)
+
+
+def similarity_generation():
+    """Get the similarity generation.
+
+    It changes whenever the similar cards of a Pokemon may have, in
+    any process.
+
+    :rtype: int
+    """
+    return cache.get_or_set(GENERATION_KEY, time.time_ns(), None)
+
+
+def bump_similarity_generation():
+    """Invalidate every page showing similar cards."""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # evicted
+        cache.set(GENERATION_KEY, time.time_ns(), None)
+
+
+def _split(val, sep):
+    return [x.strip() for x in (val or "").split(sep) if x.strip()]
+
+
+def features(pokemon):
+    """Get the feature vector of a Pokemon.
+
+    :param pokemon: The Pokemon, or a dict of its ``FEATURE_FIELDS``
+    :return: A unit vector of length ``DIM``
+    :rtype: numpy.ndarray
+    """
+    if not isinstance(pokemon, dict):
+        pokemon = {f: getattr(pokemon, f) for f in FEATURE_FIELDS}
+    vec = np.zeros(DIM, dtype=np.float32)
+    groups = dict()
+    at = 0
+    for name, (width, weight) in GROUPS.items():
+        groups[name] = vec[at:at + width]
+        at += width
+
+    for name, field, sep in (("types", "type_l", ","),
+                             ("weaknesses", "weakness_h", ";"),
+                             ("resistances", "resistance_h", ";")):
+        for t in _split(pokemon[field], sep):
+            i = _TYPE_INDEX.get(t.partition("=")[0])
+            if i is not None:
+                groups[name][i] = 1
+    for st in _split(pokemon["subtype_l"], ","):
+        groups["subtypes"][zlib.crc32(st.encode()) % SUBTYPE_BUCKETS] = 1
+    if pokemon["rarity"] in _RARITIES:
+        groups["rarity"][_RARITIES[pokemon["rarity"]]] = 1
+    groups["hp"][0] = min(max(pokemon["hp"] or 0, 0), MAX_HP) / MAX_HP
+    retreat = len(_split(pokemon["retreat_l"], ","))
+    groups["retreat"][0] = min(retreat, 5) / 5
+    price = (pokemon["trend_price"] or pokemon["suggested_price"]
+             or pokemon["average_sell_price"] or 0)
+    groups["price"][0] = min(math.log1p(max(price, 0))
+                             / math.log1p(MAX_PRICE), 1)
+
+    for name, (width, weight) in GROUPS.items():
+        norm = np.linalg.norm(groups[name])
+        if norm:
+            groups[name] *= weight / norm if width > 1 else weight
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def _ids_path(path):
+    return os.path.splitext(path)[0] + ".ids.npy"
+
+
+class SimilarityIndex(object):
+    """Feature vectors of Pokemon, by id, for top-k similarity lookups.
+
+    Rows are kept sorted by id in arrays with room to grow, so imports
+    append in amortized O(1).
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._ids = np.empty(0, dtype=np.int64)
+        self._vectors = np.empty((0, DIM), dtype=np.float32)
+        self._n = 0
+        self.built_at = None
+        # mtime of the file loaded
+        self._mtime = None
+        # what was loaded, or "b" if built (see version)
+        self._source = None
+
+    def __len__(self):
+        return self._n
+
+    def _reset(self, ids, vectors, source):
+        with self.lock:
+            self._ids, self._vectors, self._n = ids, vectors, len(ids)
+            self._source = source
+
+    def version(self):
+        """Get a token that changes whenever lookups may.
+
+        Loads the file first if it changed. The token is the same in
+        every process that loaded the same file (or built from the
+        database), whatever process saved a Pokemon since.
+
+        :rtype: str
+        """
+        self._maybe_load()
+        return "%s.%d" % (self._source, similarity_generation())
+
+    def build(self, queryset=None):
+        """Rebuild from the database.
+
+        :param queryset: The Pokemon to index, defaults to all
+        :type queryset: class`QuerySet`
+        """
+        queryset = Pokemon.objects.all() if queryset is None else queryset
+        ids = list()
+        rows = list()
+        for row in queryset.order_by("pk").values("pk", *FEATURE_FIELDS) \
+                .iterator(chunk_size=settings.POKETRADE_EXPORT_CHUNK_SIZE):
+            ids.append(row["pk"])
+            rows.append(features(row))
+        self._reset(np.array(ids, dtype=np.int64),
+                    np.array(rows, dtype=np.float32).reshape(-1, DIM), "b")
+        self.built_at = time.monotonic()
+        # cards not saved through the ORM may have changed
+        bump_similarity_generation()
+
+    def save(self, path=None):
+        """Write the index, for other processes to load.
+
+        :param path: The file, defaults to ``POKETRADE_SIMILARITY_INDEX``
+        :type path: str
+        """
+        path = path or settings.POKETRADE_SIMILARITY_INDEX
+        with self.lock:
+            ids = self._ids[:self._n].copy()
+            vectors = self._vectors[:self._n].copy()
+        # ids first - readers load once the vectors change
+        for dest, arr in ((_ids_path(path), ids), (path, vectors)):
+            tmp = "%s.%d.tmp.npy" % (dest, os.getpid())
+            np.save(tmp, arr)
+            os.replace(tmp, dest)
+        self._mtime = os.stat(path).st_mtime_ns
+        # what the file has, as other processes will see it
+        self._source = "f%d" % self._mtime
+
+    def load(self, path=None):
+        """Load an index written by ``save``.
+
+        :return: False if the file is missing or being written
+        :rtype: bool
+        """
+        path = path or settings.POKETRADE_SIMILARITY_INDEX
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            vectors = np.load(path)
+            ids = np.load(_ids_path(path))
+        except (OSError, ValueError):
+            return False
+        if len(ids) != len(vectors) or vectors.shape[1:] != (DIM,):
+            # half written, or an older layout
+            return False
+        self._reset(ids, vectors, "f%d" % mtime)
+        self._mtime = mtime
+        self.built_at = time.monotonic()
+        return True
+
+    def _maybe_load(self):
+        path = settings.POKETRADE_SIMILARITY_INDEX
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime != self._mtime:
+            # never built here - that is for startup and buildsimilarity
+            self.load(path)
+
+    def update(self, pokemon):
+        """Add or replace the vector of a Pokemon.
+
+        :return: Whether the vector is new or changed
+        :rtype: bool
+        """
+        vec = features(pokemon)
+        with self.lock:
+            n = self._n
+            i = np.searchsorted(self._ids[:n], pokemon.pk)
+            if i < n and self._ids[i] == pokemon.pk:
+                if np.array_equal(self._vectors[i], vec):
+                    return False
+                self._vectors[i] = vec
+                return True
+            if n == len(self._ids):
+                cap = max(16, 2 * n)
+                ids = np.empty(cap, dtype=np.int64)
+                vectors = np.empty((cap, DIM), dtype=np.float32)
+                ids[:n], vectors[:n] = self._ids[:n], self._vectors[:n]
+                self._ids, self._vectors = ids, vectors
+            # new ids are usually the largest, so this moves nothing
+            self._ids[i + 1:n + 1] = self._ids[i:n].copy()
+            self._vectors[i + 1:n + 1] = self._vectors[i:n].copy()
+            self._ids[i], self._vectors[i] = pokemon.pk, vec
+            self._n += 1
+            return True
+
+    def remove(self, pk):
+        """Remove a Pokemon, if indexed."""
+        with self.lock:
+            n = self._n
+            i = np.searchsorted(self._ids[:n], pk)
+            if i == n or self._ids[i] != pk:
+                return
+            self._ids[i:n - 1] = self._ids[i + 1:n].copy()
+            self._vectors[i:n - 1] = self._vectors[i + 1:n].copy()
+            self._n -= 1
+
+    def similar(self, pk, k=None):
+        """Get the Pokemon most like one.
+
+        :param pk: The Pokemon's id
+        :type pk: int
+        :param k: The number of Pokemon, defaults to
+            ``POKETRADE_SIMILAR_CARDS``
+        :type k: int
+        :return: A list of (id, cosine similarity) tuples, the most
+            similar first; empty if the Pokemon is not indexed, or
+            nothing is
+        :rtype: list
+        """
+        self._maybe_load()
+        k = k or settings.POKETRADE_SIMILAR_CARDS
+        with self.lock:
+            n = self._n
+            i = np.searchsorted(self._ids[:n], pk)
+            if i == n or self._ids[i] != pk:
+                return []
+            k = min(k, n - 1)
+            if k <= 0:
+                return []
+            scores = self._vectors[:n] @ self._vectors[i]
+            scores[i] = -np.inf
+            ids = self._ids[:n]
+            # partial sort - only the top k need ordering
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.lexsort((ids[top], -scores[top]))]
+            return [(int(ids[j]), float(scores[j])) for j in top]
+
+
+# The index of this process.
+INDEX = SimilarityIndex()
+
+
+def warm():
+    """Load the index of this process, building it if there is no file.
+
+    Run by servers at startup, in the background.
+    """
+    try:
+        if not INDEX.load():
+            INDEX.build()
+    except Exception:
+        logger.exception("Cannot load the similar card index")
+    finally:
+        # the thread's own connection, not to be left open
+        connection.close()
+
+
+@receiver(post_save, sender=Pokemon)
+def _pokemon_saved(sender, instance, created, raw=False, **kwargs):
+    new = instance.__dict__
+    if raw or not all(f in new for f in FEATURE_FIELDS):
+        # fixtures, or features not loaded
+        return
+    if INDEX.built_at is not None:
+        changed = INDEX.update(instance)
+    else:
+        # nothing to update here - other processes may have an index
+        old = getattr(instance, "_loaded", {})
+        changed = created or any(old.get(f) != new[f]
+                                 for f in FEATURE_FIELDS)
+    if changed:
+        bump_similarity_generation()
+
+
+@receiver(post_delete, sender=Pokemon)
+def _pokemon_deleted(sender, instance, **kwargs):
+    if INDEX.built_at is not None:
+        INDEX.remove(instance.pk)
+    bump_similarity_generation()
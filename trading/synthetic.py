@@ -0,0 +1,225 @@
+"""Synthetic Catalogues
+
+Generates realistic-looking users and Pokemon for benchmarks and tests
+at scale, without the TCG API. Everything is driven by a single seeded
+random number generator, so the same seed always gives the same
+catalogue.
+
+The distributions are rough approximations of the real TCG catalogue:
+
+#. rarities are skewed towards Common and Uncommon, with a long tail of
+   special rarities,
+#. one in ten cards has two types,
+#. prices are log-normal around a median that grows with rarity,
+#. a few collectors own most of the owned cards (Zipf-like).
+
+Rows are only generated, never saved - use ``chunked`` and
+``bulk_create`` to stream them into the database.
+"""
+
+__all__ = ["CatalogueGenerator", "chunked", "placeholder_images",
+           "SYLLABLES", "TYPES"]
+__author__ = "Advaith Menon"
+
+import io
+import itertools
+import math
+import random
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from accounts.models import User
+from .models import Pokemon
+
+
+# Name fragments. Generated names are 2-3 of these.
+SYLLABLES = ("pi", "ka", "chu", "char", "man", "der", "bul", "ba", "saur",
+             "squir", "tle", "mew", "two", "ee", "vee", "snor", "lax",
+             "gar", "dos", "ra", "ti", "lu", "gia", "dra", "go", "nite")
+
+# Energy types and how common they are.
+TYPES = {
+    "Grass": 14, "Fire": 11, "Water": 15, "Lightning": 10, "Psychic": 12,
+    "Fighting": 11, "Darkness": 8, "Metal": 7, "Fairy": 3, "Dragon": 4,
+    "Colorless": 15,
+}
+
+# Rarity -> (weight, median price). Rarities not listed are not
+# generated.
+_R = Pokemon.Rarity
+RARITIES = {
+    _R.COMMON: (400, 0.10),
+    _R.UNCOMMON: (300, 0.25),
+    _R.RARE: (120, 0.80),
+    _R.RARE_HOLO: (80, 2.50),
+    _R.DOUBLE_RARE: (25, 4.00),
+    _R.RARE_HOLO_EX: (15, 6.00),
+    _R.RARE_HOLO_GX: (15, 6.00),
+    _R.RARE_HOLO_V: (15, 5.00),
+    _R.ULTRA_RARE: (10, 12.00),
+    _R.RARE_ULTRA: (8, 15.00),
+    _R.ILLUSTRATION_RARE: (6, 10.00),
+    _R.RARE_SECRET: (3, 35.00),
+    _R.SPECIAL_ILLUSTRATION_RARE: (2, 60.00),
+    _R.HYPER_RARE: (1, 80.00),
+}
+
+# Name suffix for the flashier rarities.
+SUFFIXES = {
+    Pokemon.Rarity.RARE_HOLO_EX: " ex",
+    Pokemon.Rarity.RARE_HOLO_GX: " GX",
+    Pokemon.Rarity.RARE_HOLO_V: " V",
+    Pokemon.Rarity.DOUBLE_RARE: " ex",
+}
+
+ARTISTS = ("Ken Sugimori", "Mitsuhiro Arita", "Kagemaru Himeno",
+           "Atsuko Nishida", "5ban Graphics", "Akira Egawa",
+           "Tomokazu Komiya", "Naoyo Kimura", "Kouki Saitou", "sowsow")
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most ``size`` items.
+
+    :param iterable: The iterable to split
+    :param size: The maximum length of every chunk
+    :type size: int
+    :return: A generator of lists
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def placeholder_images(prefix="placeholder"):
+    """Make one placeholder image and card per type.
+
+    Files are written once to the default storage and shared by every
+    generated row, so seeding a million cards writes a dozen files.
+
+    :param prefix: Sub-directory to keep the placeholders in
+    :type prefix: str
+    :return: A map of type to (image name, card name)
+    :rtype: dict
+    """
+    # only needed here, and slow to import
+    from PIL import Image
+
+    rv = dict()
+    for i, typ in enumerate(sorted(TYPES)):
+        names = list()
+        for folder, size in (("pokemon_images", (180, 100)),
+                             ("pokemon_card", (245, 342))):
+            name = "%s/%s/%s.png" % (folder, prefix, typ.lower())
+            if not default_storage.exists(name):
+                hue = int(255 * i / len(TYPES))
+                buf = io.BytesIO()
+                Image.new("RGB", size, (hue, 160, 255 - hue)) \
+                        .save(buf, format="png")
+                name = default_storage.save(name,
+                                            ContentFile(buf.getvalue()))
+            names.append(name)
+        rv[typ] = tuple(names)
+    return rv
+
+
+class CatalogueGenerator(object):
+    """Generates users and Pokemon from a fixed seed.
+
+    :param seed: The seed of the random number generator
+    :type seed: int
+    :param images: A map of type to (image name, card name), as made by
+        ``placeholder_images``. No images are set if it is None.
+    :type images: dict
+    """
+    def __init__(self, seed=0, images=None):
+        self.rng = random.Random(seed)
+        self.images = images
+        self._types = list(TYPES)
+        self._type_cw = list(itertools.accumulate(TYPES.values()))
+        self._rarities = list(RARITIES)
+        self._rarity_cw = list(itertools.accumulate(
+                x[0] for x in RARITIES.values()))
+
+    def users(self, n, prefix="trainer"):
+        """Generate users.
+
+        Passwords are unusable - log in with ``force_login`` or set one.
+
+        :param n: The number of users
+        :type n: int
+        :param prefix: Prefix of the usernames
+        :type prefix: str
+        :return: A generator of unsaved users
+        """
+        rng = self.rng
+        for i in range(n):
+            user = User(username="%s%d" % (prefix, i),
+                        email="%s%d@example.org" % (prefix, i),
+                        password="!",
+                        coins=int(rng.lognormvariate(math.log(500), 1.2)))
+            # bulk_create skips save
+            user.refresh_email_hash()
+            yield user
+
+    def name(self):
+        """Generate a Pokemon name.
+
+        :rtype: str
+        """
+        return "".join(self.rng.choices(SYLLABLES,
+                                        k=self.rng.randint(2, 3))).title()
+
+    def pokemon(self, n, owners=(), owned=0.3, for_sale=0.4):
+        """Generate Pokemon.
+
+        :param n: The number of Pokemon
+        :type n: int
+        :param owners: The (saved) users that may own Pokemon
+        :type owners: list
+        :param owned: Fraction of Pokemon that have an owner
+        :type owned: float
+        :param for_sale: Fraction of owned Pokemon that are for sale
+        :type for_sale: float
+        :return: A generator of unsaved Pokemon
+        """
+        rng = self.rng
+        owners = list(owners)
+        # Zipf-like: the i-th user owns about 1/i as much as the first
+        owner_cw = list(itertools.accumulate(
+                1 / (i + 1) for i in range(len(owners))))
+        for _ in range(n):
+            rarity = rng.choices(self._rarities,
+                                 cum_weights=self._rarity_cw)[0]
+            types = rng.choices(self._types, cum_weights=self._type_cw,
+                                k=2 if rng.random() < 0.1 else 1)
+            median = RARITIES[rarity][1]
+            avg = round(rng.lognormvariate(math.log(median), 0.8), 2)
+            pk = Pokemon(
+                name=self.name() + SUFFIXES.get(rarity, ""),
+                supertype="Pokémon",
+                subtype_l=rng.choice(("Basic", "Basic", "Stage 1",
+                                      "Stage 2")),
+                hp=rng.randrange(30, 340, 10),
+                type_l=",".join(types),
+                rarity=rarity,
+                artist=rng.choice(ARTISTS),
+                number=str(rng.randint(1, 250)),
+                retreat_l=",".join(["Colorless"] * rng.randint(1, 4)),
+                average_sell_price=avg,
+                low_price=round(avg * rng.uniform(0.3, 0.8), 2),
+                trend_price=round(avg * rng.uniform(0.85, 1.15), 2),
+                suggested_price=round(avg * rng.uniform(0.9, 1.3), 2),
+                version=1)
+            if self.images:
+                pk.image, pk.card = self.images[types[0]]
+            if owners and rng.random() < owned:
+                pk.owner = rng.choices(owners, cum_weights=owner_cw)[0]
+                pk.cost_price = round(avg * rng.uniform(0.5, 1.2), 2)
+                if rng.random() < for_sale:
+                    pk.sell_price = max(
+                            1, round(pk.trend_price * rng.uniform(0.8, 1.5)))
+            yield pk
@@ -5,15 +5,59 @@ text-encoded fields.
 """
 
 __all__ = ["QueryParserTest",
-           "TradingPolicyGetterTest", "StringEncodingTestCase"]
+           "TradingPolicyGetterTest", "StringEncodingTestCase",
+           "FragmentCacheTest", "ConditionalGetTest",
+           "DatabaseProfileTest", "ReplicaRouterTest",
+           "BenchmarkSummaryTest", "SeedDataTest", "ServerTimingTest",
+           "QueryBudgetTest", "MetricsTest", "SlowQueryLogTest",
+           "SearchLimitTest", "SearchCacheTest", "SortTest",
+           "AutocompleteTest", "ExportTest", "CollectionChangesTest",
+           "ValuationTest", "PriceHistoryTest"]
 __author__ = "Advaith Menon"
 
-from django.test import TestCase
+import atexit
+import datetime
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from io import StringIO
+from unittest import mock
+
+import numpy as np
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.http import HttpResponse
+from django.db import connection, connections
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
 from accounts.models import User
-from .models import Pokemon
-from .helpers import QueryParser
+from .models import Ability, Attack, CollectionChange, Evolution, \
+        Pokemon, PriceSnapshot
+from .pricehistory import compact, snapshot
+from .evolution import chain, closure, rebuild
+from .helpers import QueryLimitError, QueryParser
+from .views import PokemonListView, UserPokemonListView
+from .autocomplete import INDEX, AutocompleteIndex
+from .valuation import PRICE_SOURCES, Valuation, load_report
+from .similarity import INDEX as SIMILAR, DIM, FEATURE_FIELDS, \
+        SimilarityIndex, features, warm
+from .benchmark import percentile, summarize
+from .synthetic import TYPES, CatalogueGenerator
+from poketrade2.dbprofiles import init_command, sqlite_database
+from poketrade2.metrics import PURCHASES, PURCHASE_FAILURES, Registry
+from poketrade2.slowlog import query_shape
+from poketrade2.routers import (PIN_COOKIE, ReplicaRouter,
+                                ReplicaRoutingMiddleware)
+from poketrade2.testing import QueryBudgetMixin, sql_shape
 
 
 class _Q(object):
@@ -79,6 +123,50 @@ class QueryParserTest(TestCase):
                 "1991}O{'name__contains': 'ail'}",
                 rv.str)
 
+    def test_canonical(self):
+        """Test if equivalent expressions get the same key"""
+        qp = QueryParser(valid_fields={"name": str, "hp": int})
+        key = lambda q: qp.canonical_key(qp.canonicalize(qp.parse_ast(q)))
+        base = key("name,CONTAINS,pika;hp,GT,50;@AND")
+        for q in ("hp,GT,50;name,contains,pika;@and",
+                  "hp,GT,50;name,CONTAINS,pika",
+                  "hp,GT,50;name,CONTAINS,pika;hp,GT,50;@AND;@AND",
+                  "hp,GT,50;@NOT;@NOT;name,CONTAINS,pika;@AND"):
+            self.assertEqual(base, key(q), q)
+        self.assertNotEqual(base, key("name,CONTAINS,pika;hp,GT,50;@OR"))
+        self.assertNotEqual(base, key("name,CONTAINS,Pika;hp,GT,50;@AND"))
+
+        # (a OR b) OR c == a OR (b OR c)
+        self.assertEqual(
+                key("name,IDENT,a;name,IDENT,b;@OR;name,IDENT,c;@OR"),
+                key("name,IDENT,c;name,IDENT,b;name,IDENT,a;@OR;@OR"))
+        self.assertEqual(
+                ("or", (("filter", "name__exact", "a"),
+                        ("filter", "name__exact", "b"))),
+                qp.canonicalize(qp.parse_ast(
+                    "name,IDENT,b;name,IDENT,a;@OR;name,IDENT,a;@OR")))
+
+    def test_limits(self):
+        """Test if expensive expressions are refused"""
+        qp = QueryParser(valid_fields={"name": str, "year": int},
+                         max_terms=5, max_stack=2, max_wildcards=1)
+        qp.parse("name,CONTAINS,a;year,GT,1;@AND;year,LT,9;@AND", qcb=_Q)
+        with self.assertRaises(QueryLimitError):
+            qp.parse("year,GT,1;" * 5 + "@AND", qcb=_Q)
+        with self.assertRaises(QueryLimitError):
+            qp.parse("year,GT,1;year,GT,2;year,GT,3;@AND;@AND", qcb=_Q)
+        with self.assertRaises(QueryLimitError):
+            qp.parse("name,CONTAINS,a;name,ENDS,b;@OR", qcb=_Q)
+        # BEGINS can use an index
+        qp.parse("name,CONTAINS,a;name,BEGINS,b;@OR", qcb=_Q)
+
+    def test_malformed(self):
+        """Test if malformed expressions raise ValueError"""
+        qp = QueryParser(valid_fields={"name": str})
+        for q in ("@AND", "name,IDENT,a;@OR", "name,IDENT,a;@XOR", ""):
+            with self.assertRaises(ValueError):
+                qp.parse(q, qcb=_Q)
+
 
 class TradingPolicyGetterTest(TestCase):
     """Test if the Trading Policy Getters work properly, and
@@ -178,3 +266,1430 @@ class StringEncodingTestCase(TestCase):
                          mario.resistance_h);
 
 
+class FragmentCacheTest(TestCase):
+    """Test if card fragments are cached per row version.
+    """
+    def setUp(self):
+        caches["template_fragments"].clear()
+        self.pk = Pokemon.objects.create(name="Pikachu",
+                                         card="pokemon_card/pika.png")
+
+    def test_version_bumped(self):
+        """Test if every save bumps the row version"""
+        self.assertEqual(1, self.pk.version)
+        self.pk.save()
+        self.assertEqual(2, self.pk.version)
+        self.pk.save(update_fields=["name"])
+        self.pk.refresh_from_db()
+        self.assertEqual(3, self.pk.version)
+
+    def test_fragment_reused(self):
+        """Test if an unchanged version serves the cached fragment"""
+        self.assertContains(self.client.get(reverse("trading:list")),
+                            "pika.png")
+        # update() skips save(), so the version stays the same
+        Pokemon.objects.filter(pk=self.pk.pk) \
+                .update(card="pokemon_card/raichu.png")
+        self.assertContains(self.client.get(reverse("trading:list")),
+                            "pika.png")
+
+    def test_fragment_invalidated(self):
+        """Test if saving the Pokemon invalidates its fragment"""
+        self.client.get(reverse("trading:list"))
+        self.pk.card = "pokemon_card/raichu.png"
+        self.pk.save()
+        self.assertContains(self.client.get(reverse("trading:list")),
+                            "raichu.png")
+
+
+class ConditionalGetTest(TestCase):
+    """Test if unchanged pages are answered with a 304.
+    """
+    def setUp(self):
+        self.pk = Pokemon.objects.create(name="Pikachu",
+                                         card="pokemon_card/pika.png")
+        self.detail = reverse("trading:single_detail", args=[self.pk.pk])
+
+    def test_detail_not_modified(self):
+        """Test if a matching ETag skips rendering"""
+        etag = self.client.get(self.detail)["ETag"]
+        with self.assertNumQueries(1):
+            rv = self.client.get(self.detail, headers={"if-none-match": etag})
+        self.assertEqual(304, rv.status_code)
+
+    def test_detail_modified(self):
+        """Test if a save changes the ETag"""
+        etag = self.client.get(self.detail)["ETag"]
+        self.pk.save()
+        rv = self.client.get(self.detail, headers={"if-none-match": etag})
+        self.assertEqual(200, rv.status_code)
+        self.assertNotEqual(etag, rv["ETag"])
+
+    def test_detail_cached(self):
+        """Test if the cached card follows its owner"""
+        usr = User.objects.create(username="ash")
+        self.pk.owner = usr
+        self.pk.save()
+        self.assertContains(self.client.get(self.detail), "ash")
+        usr.username = "misty"
+        usr.save()
+        self.assertContains(self.client.get(self.detail), "misty")
+
+    def test_detail_related(self):
+        """Test if changes to the similar cards and evolution chain
+        change the ETag"""
+        self.addCleanup(SIMILAR.__init__)
+        SIMILAR.build()
+        etag = self.client.get(self.detail)["ETag"]
+        # another card, similar to this one
+        raichu = Pokemon.objects.create(name="Raichu", evolves_from="Pikachu")
+        rv = self.client.get(self.detail, headers={"if-none-match": etag})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([raichu], rv.context["similar"])
+        self.assertEqual(["Pikachu", "Raichu"],
+                         [x["relative"] for x in rv.context["evolution"]])
+        etag = rv["ETag"]
+        SIMILAR.build()
+        rv = self.client.get(self.detail, headers={"if-none-match": etag})
+        self.assertEqual(200, rv.status_code)
+        etag = rv["ETag"]
+        rv = self.client.get(self.detail, headers={"if-none-match": etag})
+        self.assertEqual(304, rv.status_code)
+        # a save of another card leaving its features alone does not
+        raichu.sell_price = 10
+        raichu.save()
+        rv = self.client.get(self.detail, headers={"if-none-match": etag})
+        self.assertEqual(304, rv.status_code)
+
+    def test_detail_same_version(self):
+        """Test if a save writing a version already cached is seen"""
+        self.client.get(self.detail)
+        Pokemon.objects.filter(pk=self.pk.pk).update(
+                name="Raichu", updated_at=timezone.now())
+        self.assertContains(self.client.get(self.detail), "Raichu")
+
+    def test_detail_last_modified(self):
+        """Test if anonymous pages can be revalidated by date"""
+        rv = self.client.get(self.detail)
+        rv = self.client.get(
+                self.detail,
+                headers={"if-modified-since": rv["Last-Modified"]})
+        self.assertEqual(304, rv.status_code)
+
+    def test_detail_missing(self):
+        """Test if a missing Pokemon still 404s"""
+        rv = self.client.get(reverse("trading:single_detail", args=[0]))
+        self.assertEqual(404, rv.status_code)
+
+    def test_list(self):
+        """Test if list pages change ETag when rows come and go"""
+        url = reverse("trading:list")
+        etag = self.client.get(url)["ETag"]
+        rv = self.client.get(url, headers={"if-none-match": etag})
+        self.assertEqual(304, rv.status_code)
+        Pokemon.objects.create(name="Raichu")
+        rv = self.client.get(url, headers={"if-none-match": etag})
+        self.assertEqual(200, rv.status_code)
+
+    def test_viewer_in_etag(self):
+        """Test if pages are not shared between viewers"""
+        anon = self.client.get(self.detail)["ETag"]
+        self.client.force_login(User.objects.create(username="ash"))
+        self.assertNotEqual(anon, self.client.get(self.detail)["ETag"])
+
+
+class DatabaseProfileTest(TestCase):
+    """Test if the SQLite database profiles are applied.
+    """
+    def test_default(self):
+        """Test if the default profile keeps SQLite's defaults"""
+        db = sqlite_database("db.sqlite3")
+        self.assertEqual({}, db["OPTIONS"])
+        self.assertEqual(0, db["CONN_MAX_AGE"])
+
+    def test_production(self):
+        """Test if the production profile enables WAL"""
+        db = sqlite_database("db.sqlite3", "production")
+        self.assertEqual("IMMEDIATE", db["OPTIONS"]["transaction_mode"])
+        self.assertNotEqual(0, db["CONN_MAX_AGE"])
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(os.path.join(tmp, "x.sqlite3"))
+            conn.executescript(db["OPTIONS"]["init_command"])
+            self.assertEqual(
+                    "wal", conn.execute("PRAGMA journal_mode").fetchone()[0])
+            self.assertEqual(
+                    5000, conn.execute("PRAGMA busy_timeout").fetchone()[0])
+            conn.close()
+
+    def test_unknown(self):
+        """Test if unknown profiles are rejected"""
+        with self.assertRaises(ValueError):
+            init_command("turbo")
+
+    def test_benchmark(self):
+        """Test if the benchmark reports every profile"""
+        out = StringIO()
+        call_command("benchsqlite", duration=0.1, rows=100, users=10,
+                     stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+        self.assertEqual({"default", "production"}, set(report))
+        self.assertIn("writes_per_sec", report["production"])
+
+
+@override_settings(POKETRADE_DB_REPLICAS=["replica1"])
+class ReplicaRouterTest(TestCase):
+    """Test if reads are routed to replicas only when safe.
+    """
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.seen = list()
+
+    def _view(self, write=False, replica_reads=True):
+        """Make a view that records where its reads would go"""
+        def view(request):
+            if write:
+                self.router.db_for_write(Pokemon)
+            self.seen.append(self.router.db_for_read(Pokemon))
+            return HttpResponse()
+        view.replica_reads = replica_reads
+        return view
+
+    def _run(self, request, view):
+        """Run a view through the middleware, like the handler would"""
+        mw = ReplicaRoutingMiddleware(None)
+        def get_response(req):
+            mw.process_view(req, view, (), {})
+            return view(req)
+        mw.get_response = get_response
+        return mw(request)
+
+    def test_outside_request(self):
+        """Test if management commands use the primary"""
+        self.assertEqual("default", self.router.db_for_read(Pokemon))
+
+    def test_browse(self):
+        """Test if opted-in GETs read from a replica"""
+        rv = self._run(RequestFactory().get("/"), self._view())
+        self.assertEqual(["replica1"], self.seen)
+        self.assertNotIn(PIN_COOKIE, rv.cookies)
+
+    def test_not_opted_in(self):
+        """Test if other views read from the primary"""
+        self._run(RequestFactory().get("/"),
+                  self._view(replica_reads=False))
+        self.assertEqual(["default"], self.seen)
+
+    def test_post(self):
+        """Test if unsafe methods read from the primary"""
+        self._run(RequestFactory().post("/"), self._view())
+        self.assertEqual(["default"], self.seen)
+
+    def test_read_after_write(self):
+        """Test if a write pins the request and the client"""
+        rv = self._run(RequestFactory().get("/"), self._view(write=True))
+        self.assertEqual(["default"], self.seen)
+        self.assertIn(PIN_COOKIE, rv.cookies)
+
+        req = RequestFactory().get("/")
+        req.COOKIES[PIN_COOKIE] = "1"
+        self._run(req, self._view())
+        self.assertEqual(["default", "default"], self.seen)
+
+    def test_no_migrations_on_replica(self):
+        """Test if replicas are left to replication"""
+        self.assertFalse(self.router.allow_migrate("replica1", "trading"))
+        self.assertTrue(self.router.allow_migrate("default", "trading"))
+
+
+@override_settings(POKETRADE_DB_REPLICAS=["replica1"])
+class ReplicaDatabaseTest(TestCase):
+    """Test the routing against a real second database file.
+
+    The replica is a copy of the empty test database holding a card the
+    primary does not have, so pages show which one they were read from.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(cls.tmp.name, "replica.sqlite3")
+        # "replicate" the schema
+        connection.ensure_connection()
+        with sqlite3.connect(path) as dst:
+            connection.connection.backup(dst)
+        dst.close()
+        connections.settings["replica1"] = connections.configure_settings(
+                {"default": {}, "replica1": sqlite_database(path)}
+                )["replica1"]
+        # not a class attribute - the system checks run before the
+        # replica exists
+        cls.databases = {"default", "replica1"}
+        super().setUpClass()
+        Pokemon.objects.using("replica1").bulk_create(
+                [Pokemon(name="Mewtwo", sell_price=5)])
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections["replica1"].close()
+        del connections["replica1"]
+        del connections.settings["replica1"]
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        self.usr = User.objects.create(username="ash", coins=100)
+        self.pk = Pokemon.objects.create(name="Pikachu", sell_price=5,
+                                         owner=User.objects.create(
+                                                 username="gary"))
+        caches["default"].clear()
+
+    def _names(self, rv):
+        return [x.name for x in rv.context["pokemons"]]
+
+    def test_routing(self):
+        """Test browse reads, writes and pinned reads"""
+        url = reverse("trading:list")
+        rv = self.client.get(url)
+        self.assertEqual(["Mewtwo"], self._names(rv))
+        self.assertNotIn(PIN_COOKIE, rv.cookies)
+
+        self.client.force_login(self.usr)
+        rv = self.client.post(reverse("trading:buy_single",
+                                      args=[self.pk.pk]))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(PIN_COOKIE, rv.cookies)
+        self.assertEqual(self.usr.pk,
+                         Pokemon.objects.get(pk=self.pk.pk).owner_id)
+        self.assertFalse(Pokemon.objects.using("replica1")
+                         .filter(name="Pikachu").exists())
+
+        # the cookie sends the next page to the primary
+        rv = self.client.get(url)
+        self.assertEqual(["Pikachu"], self._names(rv))
+
+
+class BenchmarkSummaryTest(TestCase):
+    """Test the statistics of the load-testing harness.
+    """
+    def test_percentile(self):
+        """Test nearest-rank percentiles"""
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(1, percentile(values, 0))
+        self.assertEqual(7, percentile([7], 95))
+        self.assertIsNone(percentile([], 50))
+
+    def test_summarize(self):
+        """Test if samples are summarized per endpoint"""
+        rv = summarize([(0.002, 3, 200), (0.001, 5, 200), (0.004, 3, 403)],
+                       wall_time=1.5)
+        self.assertEqual(3, rv["requests"])
+        self.assertEqual(2.0, rv["throughput_rps"])
+        self.assertEqual(2.0, rv["latency_ms"]["p50"])
+        self.assertEqual(4.0, rv["latency_ms"]["p99"])
+        self.assertEqual({"mean": 3.67, "max": 5}, rv["queries"])
+        self.assertEqual({"200": 2, "403": 1}, rv["status"])
+
+
+class SeedDataTest(TestCase):
+    """Test the synthetic catalogue generator.
+    """
+    def test_seeded(self):
+        """Test if the same seed gives the same catalogue"""
+        a = [x.name for x in CatalogueGenerator(7).pokemon(50)]
+        b = [x.name for x in CatalogueGenerator(7).pokemon(50)]
+        c = [x.name for x in CatalogueGenerator(8).pokemon(50)]
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_command(self):
+        """Test if the command streams rows in chunks"""
+        with tempfile.TemporaryDirectory() as tmp, \
+                self.settings(MEDIA_ROOT=tmp):
+            call_command("seeddata", pokemon=120, users=5, chunk_size=50,
+                         owned=1, for_sale=0, stdout=StringIO())
+            # one image and one card per type, not per row
+            self.assertEqual(len(TYPES),
+                             len(os.listdir(os.path.join(
+                                 tmp, "pokemon_card", "placeholder"))))
+        self.assertEqual(5, User.objects.count())
+        self.assertEqual(120, Pokemon.objects.filter(owner__isnull=False,
+                                                     sell_price=0).count())
+        self.assertFalse(Pokemon.objects.filter(card="").exists())
+
+    def test_prefix_taken(self):
+        """Test if existing usernames are not clobbered"""
+        User.objects.create(username="trainer0")
+        with self.assertRaises(CommandError):
+            call_command("seeddata", pokemon=1, users=1, no_images=True,
+                         stdout=StringIO())
+
+
+class ServerTimingTest(TestCase):
+    """Test the per-request instrumentation.
+    """
+    def setUp(self):
+        caches["default"].clear()
+        caches["template_fragments"].clear()
+        Pokemon.objects.create(name="Pikachu", card="pokemon_card/pika.png")
+
+    def _timings(self, rv):
+        """Parse a Server-Timing header into a dict"""
+        return {x.split(";")[0].strip(): x
+                for x in rv["Server-Timing"].split(",")}
+
+    @override_settings(POKETRADE_TIMING_SAMPLE_RATE=1)
+    def test_sampled(self):
+        """Test if sampled requests report SQL, cache and render time"""
+        with self.assertLogs("poketrade2.timing") as logs:
+            rv = self.client.get(reverse("trading:list"))
+        t = self._timings(rv)
+        self.assertRegex(t["db"], r'dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+        # catalogue generation hit, search count and tile missed
+        self.assertIn('desc="hits=1 misses=2"', t["cache"])
+        self.assertIn("dur=", t["tpl"])
+        self.assertIn("dur=", t["view"])
+        self.assertEqual(200, json.loads(logs.records[0].getMessage())
+                         ["status"])
+
+        with self.assertLogs("poketrade2.timing") as logs:
+            rv = self.client.get(reverse("trading:list"))
+        self.assertIn('desc="hits=3 misses=0"',
+                      self._timings(rv)["cache"])
+        self.assertEqual(1, len(logs.records))
+
+    @override_settings(POKETRADE_TIMING_SAMPLE_RATE=0)
+    def test_not_sampled(self):
+        """Test if other requests are left alone"""
+        rv = self.client.get(reverse("trading:list"))
+        self.assertNotIn("Server-Timing", rv)
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    """Pin the number of queries of every trading view.
+
+    Budgets must not depend on the number of Pokemon shown - if one of
+    these fails after a template change, look for an N+1.
+    """
+    def setUp(self):
+        caches["template_fragments"].clear()
+        self.usr = User.objects.create(username="ash", coins=10 ** 6)
+        self.other = User.objects.create(username="gary")
+        self.client.force_login(self.usr)
+        self.n = 0
+        self.grow(3)
+        self.mine = self.usr.pokemons.first()
+        self.theirs = self.other.pokemons.first()
+        SIMILAR.build()
+
+    def grow(self, n=20):
+        """Add Pokemon, with abilities and attacks, for both users"""
+        for i in range(self.n, self.n + n):
+            for usr in (self.usr, self.other):
+                pk = Pokemon.objects.create(
+                        name="Pikachu %d" % i, owner=usr, sell_price=10,
+                        hp=60, card="pokemon_card/pika.png")
+                Ability.objects.create(name="Static %d %s" % (i, usr),
+                                       text="", type="Ability") \
+                        .pokemons.add(pk)
+                Attack.objects.create(name="Thunder %d %s" % (i, usr),
+                                      cost_s="Lightning", text="",
+                                      damage="30", pokemons=pk)
+        self.n += n
+
+    def get_cold(self, url, data=None):
+        """Get a page without cached search counts"""
+        caches["default"].clear()
+        return self.client.get(url, data)
+
+    def test_sql_shape(self):
+        """Test if literals are stripped from statements"""
+        self.assertEqual(
+                sql_shape("SELECT a FROM t WHERE b = 'x''y' AND c = 12.5 "
+                          "AND d IN (1, 2, 3)"),
+                "SELECT a FROM t WHERE b = ? AND c = ? AND d IN (?...)")
+
+    def test_list(self):
+        url = reverse("trading:list")
+        with self.assertQueryBudget(5):
+            self.client.get(url)
+        self.assertConstantQueries(lambda: self.get_cold(url), self.grow)
+
+    def test_search(self):
+        url = reverse("trading:list")
+        q = {"q": "name,CONTAINS,Pika;hp,GT,50;@AND"}
+        with self.assertQueryBudget(5):
+            self.client.get(url, q)
+        self.assertConstantQueries(lambda: self.get_cold(url, q),
+                                   self.grow)
+
+    def test_user_collection(self):
+        url = reverse("trading:user_collection", args=[self.other.pk])
+        with self.assertQueryBudget(5):
+            self.client.get(url)
+        self.assertConstantQueries(lambda: self.get_cold(url), self.grow)
+
+    def test_detail(self):
+        # includes the similar cards and the evolution chain; the card
+        # with its owner, abilities and attacks is cached
+        url = reverse("trading:single_detail", args=[self.theirs.pk])
+        with self.assertQueryBudget(8):
+            rv = self.get_cold(url)
+        self.assertContains(rv, "Thunder 0 gary")
+        self.assertContains(rv, "Static 0 gary")
+        with self.assertQueryBudget(5):
+            self.client.get(url)
+        self.assertConstantQueries(lambda: self.get_cold(url), self.grow)
+
+    def test_buy(self):
+        # includes logging the collection changes and moving the
+        # statistics of both users
+        with self.assertQueryBudget(8):
+            rv = self.client.post(reverse("trading:buy_single",
+                                          args=[self.theirs.pk]))
+        self.assertEqual(200, rv.status_code)
+
+    def test_sell(self):
+        url = reverse("trading:sell_single", args=[self.mine.pk])
+        with self.assertQueryBudget(3):
+            self.client.get(url)
+        with self.assertQueryBudget(5):
+            rv = self.client.post(url, {"sell_price": 5})
+        self.assertEqual(302, rv.status_code)
+
+
+class MetricsTest(TestCase):
+    """Test the metrics registry and endpoint.
+    """
+    def _registry(self, directory=None, ident=None):
+        reg = Registry(directory, ident)
+        reg.counter("hits_total", "Hits.")
+        reg.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+        return reg
+
+    def test_exposition(self):
+        """Test the text format of counters and histograms"""
+        reg = self._registry()
+        reg.metrics["hits_total"].inc(page='a"b')
+        reg.metrics["hits_total"].inc(2, page='a"b')
+        for val in (0.05, 0.5, 5):
+            reg.metrics["latency_seconds"].observe(val)
+        text = reg.exposition()
+        self.assertIn("# TYPE hits_total counter\n", text)
+        self.assertIn('hits_total{page="a\\"b"} 3\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn("latency_seconds_sum 5.55\n", text)
+        self.assertIn("latency_seconds_count 3\n", text)
+
+    def test_processes_merged(self):
+        """Test if the values of several processes are summed"""
+        with tempfile.TemporaryDirectory() as tmp:
+            one = self._registry(tmp, "one")
+            two = self._registry(tmp, "two")
+            # the directory is gone by then
+            self.addCleanup(atexit.unregister, one.flush)
+            self.addCleanup(atexit.unregister, two.flush)
+            one.metrics["hits_total"].inc(page="x")
+            two.metrics["hits_total"].inc(4, page="x")
+            two.metrics["latency_seconds"].observe(0.5)
+            one.flush()
+            two.flush()
+            for reg in (one, two):
+                text = reg.exposition()
+                self.assertIn('hits_total{page="x"} 5\n', text)
+                self.assertIn("latency_seconds_count 1\n", text)
+
+    def test_exited_merged(self):
+        """Test if files of exited processes are merged, not lost"""
+        proc = subprocess.Popen([sys.executable, "-c", ""])
+        proc.wait()
+        with tempfile.TemporaryDirectory() as tmp:
+            live = self._registry(tmp)
+            self.addCleanup(atexit.unregister, live.flush)
+            live.metrics["hits_total"].inc(page="x")
+            for i in (1, 2):
+                dead = self._registry(tmp, "%d-%d" % (proc.pid, i))
+                self.addCleanup(atexit.unregister, dead.flush)
+                dead.metrics["hits_total"].inc(2, page="x")
+                dead.metrics["latency_seconds"].observe(0.5)
+                dead.flush()
+                text = live.exposition()
+                self.assertIn('hits_total{page="x"} %d\n' % (1 + 2 * i),
+                              text)
+                self.assertIn("latency_seconds_count %d\n" % i, text)
+                self.assertEqual(
+                        sorted(["merged.json", os.path.basename(live._file)]),
+                        sorted(x for x in os.listdir(tmp)
+                               if x.endswith(".json")))
+
+            # collectors wait for a merge in progress
+            with live._locked():
+                done = threading.Event()
+                reader = threading.Thread(
+                        target=lambda: (live.collect(), done.set()))
+                reader.start()
+                self.assertFalse(done.wait(0.2))
+            reader.join(5)
+            self.assertTrue(done.is_set())
+
+    def test_admin_only(self):
+        """Test if only staff can see the metrics"""
+        url = reverse("metrics")
+        self.assertEqual(302, self.client.get(url).status_code)
+        self.client.force_login(User.objects.create(username="ash"))
+        self.assertEqual(302, self.client.get(url).status_code)
+
+        self.client.force_login(User.objects.create(username="oak",
+                                                    is_staff=True))
+        rv = self.client.get(url)
+        self.assertEqual(200, rv.status_code)
+        self.assertTrue(rv["Content-Type"].startswith("text/plain"))
+        self.assertIn(b"poketrade_purchases_total", rv.content)
+
+    def test_purchases_counted(self):
+        """Test if purchases and refusals are counted"""
+        buyer = User.objects.create(username="ash", coins=10)
+        seller = User.objects.create(username="gary")
+        cheap = Pokemon.objects.create(name="Pikachu", owner=seller,
+                                       sell_price=5)
+        dear = Pokemon.objects.create(name="Mew", owner=seller,
+                                      sell_price=50)
+        self.client.force_login(buyer)
+
+        bought = PURCHASES.values.get((), 0)
+        refused = PURCHASE_FAILURES.values.get(
+                (("reason", "insufficient_coins"),), 0)
+        self.client.post(reverse("trading:buy_single", args=[cheap.pk]))
+        self.client.post(reverse("trading:buy_single", args=[dear.pk]))
+        self.assertEqual(bought + 1, PURCHASES.values[()])
+        self.assertEqual(refused + 1, PURCHASE_FAILURES.values[
+                (("reason", "insufficient_coins"),)])
+
+
+class SlowQueryLogTest(TestCase):
+    """Test the slow query log and its summary.
+    """
+    def setUp(self):
+        caches["template_fragments"].clear()
+        Pokemon.objects.create(name="Pikachu", hp=60,
+                               card="pokemon_card/pika.png")
+
+    @override_settings(POKETRADE_SLOW_QUERY_MS=0)
+    def test_recorded(self):
+        """Test if a search's queries are logged with their plan"""
+        q = "name,CONTAINS,Pika;hp,GT,50;@AND"
+        with self.assertLogs("poketrade2.slowlog") as logs:
+            self.client.get(reverse("trading:list"), {"q": q})
+        recs = [json.loads(x.getMessage()) for x in logs.records]
+        search = [x for x in recs if "LIKE" in x["sql"]][0]
+        self.assertEqual(q, search["q"])
+        self.assertIn("%Pika%", search["params"])
+        self.assertTrue(search["plan"])
+        self.assertIn("pokemon", " ".join(search["plan"]).lower())
+
+    @override_settings(POKETRADE_SLOW_QUERY_MS=None)
+    def test_disabled(self):
+        """Test if nothing is logged when disabled"""
+        with self.assertNoLogs("poketrade2.slowlog"):
+            self.client.get(reverse("trading:list"))
+
+    def test_summary(self):
+        """Test if the command ranks shapes by total time"""
+        self.assertEqual("SELECT a WHERE b IN (%s...)",
+                         query_shape("SELECT a WHERE b IN (%s, %s, %s)"))
+        recs = [
+            {"sql": "SELECT a WHERE b IN (%s)", "ms": 300, "q": "x"},
+            {"sql": "SELECT a WHERE b IN (%s, %s)", "ms": 400, "q": "y",
+             "plan": ["SCAN a"]},
+            {"sql": "SELECT c", "ms": 500},
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "slow.log")
+            # the oldest records are rotated away
+            with open(path + ".1", "w") as fp:
+                fp.write(json.dumps(recs[0]) + "\n")
+            with open(path, "w") as fp:
+                fp.write("garbage\n")
+                fp.writelines(json.dumps(x) + "\n" for x in recs[1:])
+            out = StringIO()
+            call_command("slowqueries", file=path, json=True, stdout=out)
+        shapes = json.loads(out.getvalue())
+        self.assertEqual(["SELECT a WHERE b IN (%s...)", "SELECT c"],
+                         [x["shape"] for x in shapes])
+        self.assertEqual(2, shapes[0]["count"])
+        self.assertEqual(350, shapes[0]["mean_ms"])
+        self.assertEqual(["SCAN a"], shapes[0]["slowest"]["plan"])
+        self.assertEqual(["x", "y"], shapes[0]["searches"])
+
+
+class SearchLimitTest(TestCase):
+    """Test if bad searches get a 400 instead of a 500.
+    """
+    def setUp(self):
+        caches["template_fragments"].clear()
+        Pokemon.objects.bulk_create(
+                Pokemon(name="Pikachu %d" % i, hp=60,
+                        card="pokemon_card/pika.png") for i in range(300))
+        self.url = reverse("trading:list")
+
+    def test_valid(self):
+        rv = self.client.get(self.url, {"q": "name,CONTAINS,Pika"})
+        self.assertEqual(200, rv.status_code)
+
+    def test_invalid(self):
+        for q in ("name,CONTAINS", "hp,GT,x", "name,IDENT,a;@OR"):
+            rv = self.client.get(self.url, {"q": q})
+            self.assertEqual(400, rv.status_code)
+            self.assertContains(rv, "could not be run", status_code=400)
+
+    @override_settings(POKETRADE_SEARCH_MAX_WILDCARDS=2)
+    def test_too_complex(self):
+        q = ";".join(["name,CONTAINS,a"] * 3 + ["@OR"] * 2)
+        rv = self.client.get(self.url, {"q": q})
+        self.assertContains(rv, "Too many CONTAINS", status_code=400)
+
+    @override_settings(POKETRADE_SEARCH_TIMEOUT_MS=0)
+    def test_timeout(self):
+        rv = self.client.get(self.url, {"q": "name,CONTAINS,chu"})
+        self.assertContains(rv, "took too long", status_code=400)
+        # the time limit is gone afterwards
+        self.assertEqual(300, Pokemon.objects.filter(
+                name__contains="chu").count())
+
+
+class SearchCacheTest(TestCase):
+    """Test if equivalent searches share their cached count.
+    """
+    def setUp(self):
+        caches["default"].clear()
+        caches["template_fragments"].clear()
+        for i in range(3):
+            Pokemon.objects.create(name="Pikachu %d" % i, hp=60 + i,
+                                   card="pokemon_card/pika.png")
+        self.url = reverse("trading:list")
+
+    def _count_queries(self, q):
+        with CaptureQueriesContext(connection) as ctx:
+            rv = self.client.get(self.url, {"q": q})
+        self.assertEqual(200, rv.status_code)
+        return [x["sql"] for x in ctx.captured_queries
+                if x["sql"].startswith("SELECT COUNT(*)")]
+
+    def test_shared(self):
+        self.assertTrue(self._count_queries(
+                "name,CONTAINS,Pika;hp,GT,60;@AND"))
+        self.assertFalse(self._count_queries(
+                "hp,GT,60;name,contains,Pika;@and"))
+
+    def test_invalidated(self):
+        q = "name,CONTAINS,Pika"
+        self._count_queries(q)
+        Pokemon.objects.create(name="Pikachu 9")
+        self.assertTrue(self._count_queries(q))
+        rv = self.client.get(self.url, {"q": q})
+        self.assertEqual(4, rv.context["paginator"].count)
+
+
+class SortTest(TestCase):
+    """Test sorting and keyset pagination of the Pokemon lists.
+    """
+    def setUp(self):
+        caches["template_fragments"].clear()
+        self.usr = User.objects.create(username="ash")
+        Pokemon.objects.bulk_create(
+                Pokemon(name="Pikachu %02d" % i, hp=10 * (i % 4),
+                        sell_price=i % 7, owner=self.usr,
+                        rarity=Pokemon.Rarity.COMMON if i % 2
+                        else Pokemon.Rarity.RARE,
+                        card="pokemon_card/pika.png") for i in range(25))
+        self.url = reverse("trading:list")
+
+    def _names(self, rv):
+        return [x.name for x in rv.context["pokemons"]]
+
+    def test_sorted(self):
+        rv = self.client.get(self.url, {"o": "-hp"})
+        expected = list(Pokemon.objects.order_by("-hp", "-pk")
+                        .values_list("name", flat=True))
+        self.assertEqual(expected, self._names(rv))
+
+        q = {"q": "name,CONTAINS,Pika", "o": "sell_price"}
+        rv = self.client.get(self.url, q)
+        prices = [x.sell_price for x in rv.context["pokemons"]]
+        self.assertEqual(sorted(prices), prices)
+
+    def test_invalid_sort(self):
+        rv = self.client.get(self.url, {"o": "password"})
+        self.assertContains(rv, "Cannot sort by", status_code=400)
+        rv = self.client.get(self.url, {"o": "hp", "c": "nonsense!"})
+        self.assertEqual(400, rv.status_code)
+
+    def _queryset(self, view_cls, data, **kwargs):
+        view = view_cls()
+        view.setup(RequestFactory().get(self.url, data), **kwargs)
+        return view.get_queryset()
+
+    @mock.patch.object(PokemonListView, "paginate_by", 4)
+    def test_cursor(self):
+        """Test if cursors visit every row once, in order"""
+        for o in ("sell_price", "-sell_price", "recent", "name", ""):
+            with self.subTest(o=o):
+                q = {"o": o, "q": "hp,GTE,10", "c": ""}
+                seen = list()
+                while True:
+                    rv = self.client.get(self.url, q)
+                    seen += self._names(rv)
+                    if not rv.context["next_cursor"]:
+                        break
+                    q["c"] = rv.context["next_cursor"]
+                expected = self._queryset(PokemonListView,
+                                          {"o": o, "q": "hp,GTE,10"})
+                self.assertEqual([x.name for x in expected], seen)
+                self.assertEqual(18, len(seen))
+
+    def test_index_order(self):
+        """Test if sorted pages are read in index order"""
+        plan = lambda qs: qs[:100].explain()
+        for o in PokemonListView.sort_fields:
+            for desc in ("", "-"):
+                with self.subTest(o=desc + o):
+                    self.assertNotIn("TEMP B-TREE", plan(self._queryset(
+                            PokemonListView, {"o": desc + o})))
+                    # collections are small - found by owner, then
+                    # sorted, but for the name sort
+                    mine = plan(self._queryset(
+                            UserPokemonListView, {"o": desc + o},
+                            pk=self.usr.pk))
+                    self.assertIn("owner_id=?", mine)
+                    if o == "name":
+                        self.assertIn("ix_pokemon_owner_name", mine)
+                        self.assertNotIn("TEMP B-TREE", mine)
+                    self.assertNotIn("TEMP B-TREE", plan(self._queryset(
+                            PokemonListView, {"o": desc + o,
+                                              "q": "rarity,IDENT,Rare"})))
+
+
+class AutocompleteTest(TestCase):
+    """Test the autocomplete index and endpoint.
+    """
+    def setUp(self):
+        for name, n in (("Pikachu", 3), ("Pichu", 1), ("Dark Pidgey", 2)):
+            for _ in range(n):
+                Pokemon.objects.create(name=name, artist="Ken Sugimori")
+        self.pk = Pokemon.objects.create(name="Raichu", artist="sowsow")
+        Ability.objects.create(name="Pickup", text="", type="Ability") \
+                .pokemons.add(self.pk)
+        INDEX.build()
+
+    def _texts(self, prefix, **kw):
+        return [x[1] for x in INDEX.lookup(prefix, **kw)]
+
+    def test_ranked(self):
+        """Test if more popular suggestions come first"""
+        self.assertEqual(["Pikachu", "Dark Pidgey", "Pichu", "Pickup"],
+                         self._texts("pi"))
+        # ties are alphabetical
+        self.assertEqual(["Pichu", "Pickup"], self._texts("PIC"))
+        self.assertEqual(["Pikachu"], self._texts("pi", limit=1))
+        self.assertEqual(["Ken Sugimori"], self._texts("sugi"))
+        self.assertEqual([], self._texts(""))
+
+    @mock.patch("trading.autocomplete.MEMO_THRESHOLD", 0)
+    def test_incremental(self):
+        """Test if saves and deletes update the index"""
+        self.assertEqual("Raichu", self._texts("r")[0])
+        self.pk.name = "Pikachu"
+        self.pk.save()
+        self.assertEqual([], self._texts("raic"))
+        self.assertEqual(4, INDEX.lookup("pika")[0][2])
+        # memoized prefixes are updated too
+        self.assertEqual("Pikachu", self._texts("p")[0])
+        Pokemon.objects.filter(name="Pichu").get().delete()
+        self.assertNotIn("Pichu", self._texts("pi"))
+        Pokemon.objects.create(name="Zapdos")
+        self.assertEqual(["Zapdos"], self._texts("za"))
+
+    def test_endpoint(self):
+        """Test if lookups never touch the database"""
+        url = reverse("trading:autocomplete")
+        with self.assertNumQueries(0):
+            rv = self.client.get(url, {"q": "pik", "n": 1})
+        self.assertEqual({"q": "pik", "suggestions": [
+            {"kind": "name", "text": "Pikachu", "weight": 3}]}, rv.json())
+
+    def test_not_built(self):
+        """Test if lookups never build the index in the request"""
+        idx = AutocompleteIndex()
+        with self.assertNumQueries(0):
+            self.assertEqual([], idx.lookup("pi"))
+
+    def test_unloaded_save(self):
+        """Test if saves of objects not read from the database are
+        left to the next rebuild"""
+        Pokemon(pk=self.pk.pk, name="Raichu", artist="sowsow").save()
+        Pokemon.objects.only("pk", "name").get(pk=self.pk.pk).save()
+        self.assertEqual(1, INDEX.lookup("raichu")[0][2])
+        # deferred fields are neither read nor counted again
+        pk = Pokemon.objects.defer("artist").get(pk=self.pk.pk)
+        with CaptureQueriesContext(connection) as ctx:
+            pk.save()
+        self.assertFalse([q for q in ctx.captured_queries
+                          if q["sql"].startswith("SELECT")
+                          and '"artist"' in q["sql"]])
+        self.assertEqual(1, INDEX.lookup("sowsow")[0][2])
+
+    def test_weights(self):
+        """Test if suggestions go away when their count reaches 0"""
+        idx = AutocompleteIndex()
+        idx.built_at = 0
+        with self.settings(POKETRADE_AUTOCOMPLETE_REBUILD_SECONDS=1e12):
+            idx.add("name", "Mew", 2)
+            idx.remove("name", "Mew")
+            self.assertEqual([("name", "Mew", 1)], idx.lookup("mew"))
+            idx.remove("name", "Mew")
+            self.assertEqual([], idx.lookup("mew"))
+
+
+class ExportTest(TestCase):
+    """Test the streaming exports.
+    """
+    def setUp(self):
+        self.usr = User.objects.create(username="ash")
+        for i in range(5):
+            Pokemon.objects.create(name="Pikachu %d" % i, hp=10 * i,
+                                   sell_price=i, owner=self.usr)
+        Pokemon.objects.create(name="Mew", hp=100)
+
+    def _get(self, url, data=None):
+        rv = self.client.get(url, data)
+        self.assertTrue(rv.streaming)
+        return rv, b"".join(rv.streaming_content).decode()
+
+    @override_settings(POKETRADE_EXPORT_CHUNK_SIZE=2)
+    def test_ndjson(self):
+        rv, body = self._get(reverse("trading:export", args=["ndjson"]),
+                             {"q": "hp,GTE,20", "o": "-hp",
+                              "fields": "name,owner,hp"})
+        self.assertEqual("application/x-ndjson", rv["Content-Type"])
+        self.assertEqual(
+                [{"name": "Mew", "owner": None, "hp": 100},
+                 {"name": "Pikachu 4", "owner": "ash", "hp": 40},
+                 {"name": "Pikachu 3", "owner": "ash", "hp": 30},
+                 {"name": "Pikachu 2", "owner": "ash", "hp": 20}],
+                [json.loads(x) for x in body.splitlines()])
+
+    def test_csv(self):
+        rv, body = self._get(reverse("trading:export", args=["csv"]),
+                             {"fields": "name,updated_at"})
+        self.assertIn('filename="pokemon.csv"',
+                      rv["Content-Disposition"])
+        rows = body.splitlines()
+        self.assertEqual("name,updated_at", rows[0])
+        self.assertEqual(7, len(rows))
+
+    def test_collection(self):
+        url = reverse("trading:collection_export", args=["csv"])
+        self.assertEqual(302, self.client.get(url).status_code)
+        self.client.force_login(self.usr)
+        rv, body = self._get(url, {"fields": "name"})
+        self.assertNotIn("Mew", body)
+        self.assertEqual(6, len(body.splitlines()))
+
+    def test_invalid(self):
+        url = reverse("trading:export", args=["ndjson"])
+        self.assertEqual(400, self.client.get(
+                url, {"fields": "name,password"}).status_code)
+        self.assertEqual(400, self.client.get(
+                url, {"q": "hp,GT,x"}).status_code)
+        self.assertEqual(404, self.client.get(
+                reverse("trading:export", args=["xml"])).status_code)
+
+
+class CollectionChangesTest(TestCase):
+    """Test the change log and the delta sync endpoint.
+    """
+    def setUp(self):
+        self.usr = User.objects.create(username="ash", coins=1000)
+        self.other = User.objects.create(username="gary")
+        self.mine = Pokemon.objects.create(name="Pikachu", owner=self.usr)
+        self.theirs = Pokemon.objects.create(name="Eevee", sell_price=10,
+                                             owner=self.other)
+        self.client.force_login(self.usr)
+        self.url = reverse("trading:collection_changes")
+
+    def sync(self, since=None):
+        rv = self.client.get(self.url, {} if since is None
+                             else {"since": since})
+        self.assertEqual(200, rv.status_code)
+        return rv.json()
+
+    def test_log(self):
+        """Test which saves are logged"""
+        kinds = lambda: list(self.usr.collection_changes.order_by("id")
+                             .values_list("pokemon_id", "kind"))
+        self.assertEqual([(self.mine.pk, "A")], kinds())
+        # untracked fields are not changes
+        self.mine.low_price = 2
+        self.mine.save()
+        self.mine.sell_price = 5
+        self.mine.save()
+        self.assertEqual([(self.mine.pk, "A"), (self.mine.pk, "M")],
+                         kinds())
+        # the market price sent to clients is tracked too
+        mine = Pokemon.objects.get(pk=self.mine.pk)
+        mine.trend_price = 7
+        mine.save()
+        self.assertEqual((self.mine.pk, "M"), kinds()[-1])
+        self.assertEqual(3, len(kinds()))
+        self.mine.delete()
+        self.assertEqual("R", kinds()[-1][1])
+
+    def test_sync(self):
+        """Test a full sync followed by deltas"""
+        full = self.sync()
+        self.assertTrue(full["resync"])
+        self.assertEqual(["Pikachu"], [x["name"] for x in full["added"]])
+
+        rv = self.client.post(reverse("trading:buy_single",
+                                      args=[self.theirs.pk]))
+        self.assertEqual(200, rv.status_code)
+        self.mine.sell_price = 3
+        self.mine.save()
+        delta = self.sync(full["token"])
+        self.assertFalse(delta["resync"])
+        self.assertEqual(["Eevee"], [x["name"] for x in delta["added"]])
+        self.assertEqual([3], [x["sell_price"] for x in delta["modified"]])
+        self.assertEqual([], delta["removed"])
+
+        # nothing happened since
+        self.assertEqual({"token": delta["token"], "resync": False,
+                          "added": [], "modified": [], "removed": []},
+                         self.sync(delta["token"]))
+
+        # sold to someone else, and bought and deleted in between
+        self.mine.owner = self.other
+        self.mine.save()
+        tmp = Pokemon.objects.create(name="Ditto", owner=self.usr)
+        tmp.delete()
+        last = self.sync(delta["token"])
+        self.assertEqual([self.mine.pk], last["removed"])
+        self.assertEqual([], last["added"])
+        # the other user sees their new card
+        self.client.force_login(self.other)
+        self.assertEqual(["Pikachu"], [x["name"] for x
+                                       in self.sync(delta["token"])["added"]])
+
+    def test_pruned(self):
+        """Test that pruned and invalid tokens resync"""
+        token = self.sync()["token"]
+        self.mine.sell_price = 3
+        self.mine.save()
+        CollectionChange.objects.update(
+                created_at=timezone.now() - datetime.timedelta(days=60))
+        Pokemon.objects.create(name="Mew", owner=self.other)
+        call_command("prunechanges", stdout=StringIO())
+        # the newest change is kept
+        self.assertEqual(1, CollectionChange.objects.count())
+
+        rv = self.sync(token)
+        self.assertTrue(rv["resync"])
+        self.assertEqual([self.mine.pk], [x["id"] for x in rv["added"]])
+        self.assertFalse(self.sync(rv["token"])["resync"])
+        self.assertTrue(self.sync(10 ** 9)["resync"])
+        self.assertEqual(400, self.client.get(
+                self.url, {"since": "x"}).status_code)
+
+
+class ValuationTest(TestCase):
+    """Test the portfolio valuation.
+    """
+    def setUp(self):
+        self.usr = User.objects.create(username="ash")
+        self.other = User.objects.create(username="gary")
+        Pokemon.objects.create(name="Pikachu", owner=self.usr,
+                               cost_price=10, trend_price=15,
+                               low_price=5, suggested_price=0)
+        Pokemon.objects.create(name="Eevee", owner=self.usr,
+                               cost_price=4, trend_price=2, low_price=1,
+                               average_sell_price=3, suggested_price=6)
+        Pokemon.objects.create(name="Mew", owner=self.other,
+                               cost_price=1, trend_price=100)
+        Pokemon.objects.create(name="Ditto", trend_price=1000)
+        caches["default"].clear()
+
+    def test_columns(self):
+        """Test the grouped reductions against a plain loop"""
+        rng = random.Random(0)
+        cards = [(rng.randrange(50), rng.uniform(0, 10),
+                  [rng.choice((0, rng.uniform(0, 10))) for _ in range(4)])
+                 for _ in range(2000)]
+        val = Valuation.from_columns(
+                np.array([x[0] for x in cards]),
+                np.array([x[1] for x in cards]),
+                np.array([x[2] for x in cards]))
+        for pk in (0, 17, 49):
+            mine = [x for x in cards if x[0] == pk]
+            rv = val.for_user(pk)
+            self.assertEqual(len(mine), rv["cards"])
+            for j, row in enumerate(rv["sources"]):
+                value = sum(x[2][j] or x[1] for x in mine)
+                self.assertAlmostEqual(value, row["value"])
+                self.assertAlmostEqual(value - sum(x[1] for x in mine),
+                                       row["profit"])
+        self.assertIsNone(val.for_user(50))
+
+    def test_load(self):
+        val = Valuation.load()
+        rv = val.for_user(self.usr.pk)
+        self.assertEqual((2, 14), (rv["cards"], rv["cost"]))
+        by_source = {x["source"]: x for x in rv["sources"]}
+        # no price - worth what was paid
+        self.assertEqual(13, by_source["average_sell_price"]["value"])
+        self.assertEqual(16, by_source["suggested_price"]["value"])
+        self.assertEqual(3, by_source["trend_price"]["profit"])
+        self.assertEqual([self.other.pk, self.usr.pk],
+                         [x[0] for x in val.top("trend_price")])
+        self.assertEqual([self.usr.pk, self.other.pk],
+                         [x[0] for x in val.top("suggested_price",
+                                                by="profit")])
+        self.assertEqual(1, len(val.top("trend_price", limit=1)))
+
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "valuation.json")
+            call_command("valuationreport", output=path, stdout=StringIO())
+            report = load_report(path)
+        self.assertEqual(2, report["users"])
+        self.assertEqual(set(PRICE_SOURCES), set(report["leaderboards"]))
+        top = report["leaderboards"]["trend_price"]["profit"][0]
+        self.assertEqual(("gary", 99), (top["username"], top["profit"]))
+        self.assertEqual(Valuation.load().for_user(self.usr.pk),
+                         report["portfolios"][str(self.usr.pk)])
+
+    def test_pages(self):
+        self.client.force_login(self.usr)
+        url = reverse("accounts:portfolio_leaderboard")
+        with override_settings(POKETRADE_VALUATION_REPORT="/nonexistent"):
+            rv = self.client.get(url, {"source": "low_price"})
+            self.assertEqual(["ash", "gary"],
+                             [x["username"] for x in rv.context["rows"]])
+            self.assertEqual(404, self.client.get(
+                    url, {"by": "coins"}).status_code)
+        # profiles show the latest report (computed on demand above),
+        # never valuing anything themselves
+        profile = reverse("accounts:profile", args=[self.usr.pk])
+        with override_settings(POKETRADE_VALUATION_REPORT="/nonexistent"):
+            with self.assertNumQueries(3):
+                rv = self.client.get(profile)
+            self.assertEqual(2, rv.context["valuation"]["cards"])
+            caches["default"].clear()
+            self.assertIsNone(self.client.get(profile).context["valuation"])
+        self.assertContains(rv, "Market Value: 17.00")
+
+        # a new report is a new page
+        etag = rv["ETag"]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "valuation.json")
+            call_command("valuationreport", output=path, stdout=StringIO())
+            with override_settings(POKETRADE_VALUATION_REPORT=path):
+                rv = self.client.get(profile,
+                                     headers={"if-none-match": etag})
+                self.assertEqual(200, rv.status_code)
+                self.assertEqual(14, rv.context["valuation"]["cost"])
+                rv = self.client.get(profile,
+                                     headers={"if-none-match": rv["ETag"]})
+                self.assertEqual(304, rv.status_code)
+
+
+@override_settings(POKETRADE_PRICE_DAILY_DAYS=14,
+                   POKETRADE_PRICE_WEEKLY_DAYS=60)
+class PriceHistoryTest(TestCase):
+    """Test price snapshots and their rollups.
+    """
+    def setUp(self):
+        self.pk = Pokemon.objects.create(name="Pikachu", trend_price=1)
+        self.mew = Pokemon.objects.create(name="Mew", trend_price=0)
+        self.today = datetime.date(2026, 3, 18)
+        # a year of daily prices, trend price = day number
+        start = self.today - datetime.timedelta(days=364)
+        for i in range(365):
+            Pokemon.objects.filter(pk=self.pk.pk).update(trend_price=i + 1)
+            snapshot(start + datetime.timedelta(days=i))
+
+    def test_snapshot(self):
+        self.assertEqual(2 * 365, PriceSnapshot.objects.count())
+        snapshot(self.today)
+        self.assertEqual(2 * 365, PriceSnapshot.objects.count())
+        # 0 is no price
+        self.assertFalse(self.mew.price_history
+                         .exclude(trend_price=None).exists())
+
+    def test_compact(self):
+        compact(self.today)
+        rows = list(self.pk.price_history.order_by("period"))
+        Res = PriceSnapshot.Resolution
+        days = [x for x in rows if x.resolution == Res.DAY]
+        weeks = [x for x in rows if x.resolution == Res.WEEK]
+        months = [x for x in rows if x.resolution == Res.MONTH]
+        # the recent days are kept, from a Monday
+        self.assertEqual(0, days[0].period.weekday())
+        self.assertGreaterEqual(
+                (self.today - days[0].period).days, 14 - 6)
+        self.assertEqual(self.today, days[-1].period)
+        self.assertTrue(all(x.period.weekday() == 0 for x in weeks))
+        self.assertTrue(all(x.period.day == 1 for x in months))
+        self.assertLess(len(rows), 60)
+        # periods are in order and do not overlap
+        self.assertEqual(months + weeks + days, rows)
+        # a week is the mean of its days
+        self.assertEqual(
+                sum(x for x in range(7)) / 7 + days[0].trend_price - 7,
+                weeks[-1].trend_price)
+        self.assertIsNone(months[0].low_price)
+        # compacting again changes nothing
+        compact(self.today)
+        self.assertEqual(rows, list(self.pk.price_history
+                                    .order_by("period")))
+
+    def test_view(self):
+        compact(self.today)
+        url = reverse("trading:price_history", args=[self.pk.pk])
+        rv = self.client.get(url, {"since": "2026-03-01"})
+        self.assertEqual(200, rv.status_code)
+        series = rv.json()["series"]
+        self.assertEqual("2026-03-18", series[-1]["period"])
+        self.assertEqual(365, series[-1]["trend_price"])
+        self.assertTrue(all(x["period"] >= "2026-03-01" for x in series))
+        self.assertEqual(400, self.client.get(
+                url, {"since": "yesterday"}).status_code)
+        self.assertEqual(404, self.client.get(reverse(
+                "trading:price_history", args=[10 ** 6])).status_code)
+
+
+@override_settings(POKETRADE_SIMILAR_CARDS=2)
+class SimilarityTest(TestCase):
+    """Test the similar card index.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "similarity.npy")
+        override = override_settings(POKETRADE_SIMILARITY_INDEX=self.path)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        def make(name, types, hp, price, **kwargs):
+            return Pokemon.objects.create(
+                    name=name, type_l=types, hp=hp, trend_price=price,
+                    card="pokemon_card/%s.png" % name.lower(), **kwargs)
+        self.pika = make("Pikachu", "Lightning", 60, 2,
+                         weakness_h="Fighting=x2")
+        self.raichu = make("Raichu", "Lightning", 90, 5,
+                           weakness_h="Fighting=x2")
+        self.zapdos = make("Zapdos", "Lightning", 120, 40)
+        self.charmander = make("Charmander", "Fire", 60, 2,
+                               weakness_h="Water=x2")
+        self.index = SimilarityIndex()
+        self.index.build()
+
+    def test_features(self):
+        vec = features(self.pika)
+        self.assertEqual((DIM,), vec.shape)
+        self.assertAlmostEqual(1, float(np.linalg.norm(vec)), places=5)
+        # the same card is the same vector, however it is read
+        row = Pokemon.objects.values(*FEATURE_FIELDS).get(pk=self.pika.pk)
+        np.testing.assert_array_equal(vec, features(row))
+        # missing values are no features, not NaN
+        self.assertFalse(np.isnan(features(Pokemon(hp=None))).any())
+
+    def test_similar(self):
+        rv = self.index.similar(self.pika.pk)
+        self.assertEqual([self.raichu.pk, self.zapdos.pk],
+                         [pk for pk, _ in rv])
+        self.assertGreater(rv[0][1], rv[1][1])
+        self.assertEqual(3, len(self.index.similar(self.pika.pk, k=10)))
+        self.assertEqual([], self.index.similar(10 ** 6))
+
+    def test_save_load(self):
+        self.index.save(self.path)
+        other = SimilarityIndex()
+        self.assertTrue(other.load(self.path))
+        self.assertEqual(len(self.index), len(other))
+        self.assertEqual(self.index.similar(self.pika.pk),
+                         other.similar(self.pika.pk))
+        self.assertFalse(other.load(self.path + ".missing"))
+
+    def test_reload(self):
+        """Test if lookups pick up a new file"""
+        other = SimilarityIndex()
+        self.index.save(self.path)
+        self.assertEqual(3, len(other.similar(self.pika.pk, k=10)))
+        # written by another process
+        Pokemon.objects.create(name="Pichu", type_l="Lightning", hp=30)
+        self.index.build()
+        self.index.save(self.path)
+        os.utime(self.path, ns=(0, 0))
+        self.assertEqual(4, len(other.similar(self.pika.pk, k=10)))
+
+    def test_not_built(self):
+        """Test if lookups never build the index in the request"""
+        with self.assertNumQueries(0):
+            self.assertEqual([], SimilarityIndex().similar(self.pika.pk))
+
+    @mock.patch("trading.similarity.connection")
+    def test_warm(self, _):
+        """Test if startup builds the index without a file, and loads
+        the file otherwise"""
+        self.addCleanup(SIMILAR.__init__)
+        SIMILAR.__init__()
+        warm()
+        self.assertEqual(4, len(SIMILAR))
+        Pokemon.objects.create(name="Pichu", type_l="Lightning", hp=30)
+        self.index.save(self.path)
+        SIMILAR.__init__()
+        with self.assertNumQueries(0):
+            warm()
+        self.assertEqual(4, len(SIMILAR))
+
+    def test_update(self):
+        SIMILAR.build()
+        self.addCleanup(SIMILAR.__init__)
+        pichu = Pokemon.objects.create(name="Pichu", type_l="Lightning",
+                                       hp=50, trend_price=2,
+                                       weakness_h="Fighting=x2")
+        self.assertEqual(pichu.pk, SIMILAR.similar(self.pika.pk)[0][0])
+        # a changed card moves
+        pichu.type_l = "Fire"
+        pichu.weakness_h = "Water=x2"
+        pichu.save()
+        self.assertEqual(pichu.pk, SIMILAR.similar(self.charmander.pk)[0][0])
+        self.assertNotIn(pichu.pk, dict(SIMILAR.similar(self.pika.pk)))
+        pichu.delete()
+        self.assertEqual(4, len(SIMILAR))
+
+    def test_version(self):
+        """Test if processes loading the same file share a version,
+        changed only by new vectors"""
+        self.index.save(self.path)
+        other = SimilarityIndex()
+        version = other.version()
+        self.assertEqual(version, self.index.version())
+        self.assertFalse(self.index.update(self.pika))
+        self.pika.sell_price = 10
+        self.pika.save()
+        self.assertEqual(version, other.version())
+        self.pika.hp = 70
+        self.assertTrue(self.index.update(self.pika))
+        self.pika.save()
+        self.assertEqual(self.index.version(), other.version())
+        self.assertNotEqual(version, other.version())
+
+    def test_detail(self):
+        SIMILAR.build()
+        self.addCleanup(SIMILAR.__init__)
+        rv = self.client.get(reverse("trading:single_detail",
+                                     args=[self.pika.pk]))
+        self.assertEqual([self.raichu, self.zapdos],
+                         rv.context["similar"])
+        self.assertContains(rv, "Cards like this")
+
+    def test_command(self):
+        out = StringIO()
+        call_command("buildsimilarity", stdout=out)
+        self.assertIn("Indexed 4 Pokemon", out.getvalue())
+        other = SimilarityIndex()
+        self.assertTrue(other.load(self.path))
+        self.assertEqual(4, len(other))
+
+
+class EvolutionTest(TestCase):
+    """Test the evolution chains.
+    """
+    def setUp(self):
+        for name, parent in (("Pichu", None), ("Pikachu", "Pichu"),
+                             ("Raichu", "Pikachu"), ("Raichu", "Pikachu"),
+                             ("Eevee", None), ("Vaporeon", "Eevee"),
+                             ("Jolteon", "Eevee")):
+            Pokemon.objects.create(name=name, evolves_from=parent,
+                                   card="pokemon_card/x.png")
+
+    def rows(self):
+        return set(Evolution.objects.values_list("name", "relative",
+                                                 "offset"))
+
+    def test_closure(self):
+        rows = set(closure([("B", "A"), ("C", "B"), ("A", "C"),
+                            ("D", "B")]))
+        self.assertIn(("D", "B", -1), rows)
+        self.assertIn(("B", "D", 1), rows)
+        self.assertIn(("D", "D", 0), rows)
+        # the cycle is cut, not followed forever
+        self.assertIn(("C", "A", -2), rows)
+
+    def test_incremental(self):
+        """Test if saves give the same table as a rebuild"""
+        saved = self.rows()
+        self.assertIn(("Raichu", "Pichu", -2), saved)
+        self.assertIn(("Pichu", "Raichu", 2), saved)
+        self.assertEqual(3 + 3 * 2 + 3 + 2 * 2, len(saved))
+        rebuild()
+        self.assertEqual(saved, self.rows())
+
+    def test_chain(self):
+        with self.assertNumQueries(1):
+            rv = chain("Pikachu")
+        self.assertEqual([("Pichu", -1, 1), ("Pikachu", 0, 1),
+                          ("Raichu", 1, 2)],
+                         [(x["relative"], x["offset"], x["cards"])
+                          for x in rv])
+        # siblings are not in the chain
+        self.assertEqual(["Eevee", "Vaporeon"],
+                         [x["relative"] for x in chain("Vaporeon")])
+        self.assertEqual([], chain("Mew"))
+
+    def test_search(self):
+        url = reverse("trading:list")
+        rv = self.client.get(url, {"q": "evolution_line,IDENT,Pichu"})
+        self.assertEqual({"Pichu", "Pikachu", "Raichu"},
+                         {x.name for x in rv.context["pokemons"]})
+        rv = self.client.get(url, {"q": "evolves_from,IDENT,Eevee"})
+        self.assertEqual({"Vaporeon", "Jolteon"},
+                         {x.name for x in rv.context["pokemons"]})
+        # a species that does not evolve is its own line
+        Pokemon.objects.create(name="Mew", card="pokemon_card/x.png")
+        rv = self.client.get(url, {"q": "evolution_line,IDENT,Mew"})
+        self.assertEqual(["Mew"], [x.name for x in rv.context["pokemons"]])
+
+    def test_detail(self):
+        pk = Pokemon.objects.get(name="Pikachu")
+        rv = self.client.get(reverse("trading:single_detail", args=[pk.pk]))
+        self.assertEqual(["Pichu", "Pikachu", "Raichu"],
+                         [x["relative"] for x in rv.context["evolution"]])
+        self.assertContains(rv, "evolution_line%2CIDENT%2CPikachu")
+
+    def test_links(self):
+        """Test if names using the query syntax are escaped in links"""
+        odd = "Mime Jr.: 50%2F, @Galar; 1%"
+        Pokemon.objects.create(name=odd, card="pokemon_card/x.png")
+        pk = Pokemon.objects.create(name="Mr. Mime", evolves_from=odd,
+                                    card="pokemon_card/x.png")
+        rv = self.client.get(reverse("trading:single_detail", args=[pk.pk]))
+        stage = rv.context["evolution"][0]
+        self.assertEqual(odd, stage["relative"])
+        rv2 = self.client.get(stage["url"])
+        self.assertEqual([odd], [x.name for x in rv2.context["pokemons"]])
+        rv2 = self.client.get(rv.context["evolution_line_url"])
+        self.assertEqual({odd, "Mr. Mime"},
+                         {x.name for x in rv2.context["pokemons"]})
+        # plain searches too
+        rv2 = self.client.get(reverse("trading:list"), {"s": "50%2F, @"})
+        self.assertEqual([odd], [x.name for x in rv2.context["pokemons"]])
+
+    def test_command(self):
+        Evolution.objects.all().delete()
+        out = StringIO()
+        call_command("buildevolutions", stdout=out)
+        self.assertIn("Wrote 16 evolution rows", out.getvalue())
+        self.assertEqual(16, Evolution.objects.count())
@@ -21,6 +21,16 @@ urlpatterns = [
              name="buy_single"),
         path("pokemon/<int:pk>/sell", v.UpdateSellPriceView.as_view(),
              name="sell_single"),
+        path("pokemon/<int:pk>/prices", v.PriceHistoryView.as_view(),
+             name="price_history"),
+        path("export.<str:fmt>", v.PokemonExportView.as_view(),
+             name="export"),
+        path("collection/export.<str:fmt>",
+             v.CollectionExportView.as_view(), name="collection_export"),
+        path("collection/changes", v.CollectionChangesView.as_view(),
+             name="collection_changes"),
+        path("autocomplete", v.AutocompleteView.as_view(),
+             name="autocomplete"),
         path("accounts/profile/<int:pk>/collection",
              v.UserPokemonListView.as_view(), name="user_collection"),
         ]
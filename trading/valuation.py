@@ -0,0 +1,266 @@
+"""Portfolio valuation
+
+Values every user's collection by each market price source against what
+they paid (``cost_price``). The price and ownership columns are loaded
+into NumPy arrays and reduced per owner with ``numpy.bincount``, so
+valuing every collection takes one pass over the owned cards instead of
+a Python loop (or an aggregate query) per user.
+
+A price of 0 means the source has no price for the card; such cards are
+valued at what was paid for them, so they make neither profit nor loss.
+
+The nightly ``manage.py valuationreport`` writes every leaderboard, and
+every user's valuation (shown on profiles), to
+``POKETRADE_VALUATION_REPORT``, shared by all processes. Without a
+report, leaderboards are computed on demand and cached for
+``POKETRADE_VALUATION_CACHE_SECONDS``; profiles never value anything
+themselves.
+"""
+
+__all__ = ["PRICE_SOURCES", "RANKINGS", "Valuation", "load_report",
+           "latest_report", "leaderboard", "portfolio"]
+__author__ = "Advaith Menon"
+
+import json
+import os
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from accounts.models import User
+from .models import Pokemon
+
+
+# Market price sources, as Pokemon fields.
+PRICE_SOURCES = ("average_sell_price", "low_price", "trend_price",
+                 "suggested_price")
+
+# What leaderboards are ranked by.
+RANKINGS = ("value", "profit")
+
+# The columns loaded, and their types.
+_DTYPE = [("owner", "i8"), ("cost", "f8"),
+          *((src, "f8") for src in PRICE_SOURCES)]
+
+# Cache key of leaderboards computed on demand.
+_CACHE_KEY = "trading:valuation:report"
+
+# (path, mtime) -> report, of the report file last read
+_report_memo = dict()
+
+
+class Valuation(object):
+    """The collection values of a set of users.
+
+    Rows are users, sorted by id; value and profit have one column per
+    price source (see ``PRICE_SOURCES``).
+
+    :param users: The user ids
+    :type users: numpy.ndarray
+    :param cards: The number of cards of each user
+    :type cards: numpy.ndarray
+    :param cost: What each user paid for their cards
+    :type cost: numpy.ndarray
+    :param value: The value of each user's cards by source
+    :type value: numpy.ndarray
+    """
+    def __init__(self, users, cards, cost, value):
+        self.users = users
+        self.cards = cards
+        self.cost = cost
+        self.value = value
+
+    @property
+    def profit(self):
+        return self.value - self.cost[:, None]
+
+    @classmethod
+    def from_columns(cls, owner, cost, prices):
+        """Value collections from card columns.
+
+        :param owner: The owner id of each card
+        :type owner: numpy.ndarray
+        :param cost: The cost price of each card
+        :type cost: numpy.ndarray
+        :param prices: The prices of each card, one column per source
+        :type prices: numpy.ndarray
+        :rtype: class`Valuation`
+        """
+        users, group = np.unique(owner, return_inverse=True)
+        n = len(users)
+        # no price: worth what was paid
+        prices = np.where(prices > 0, prices, cost[:, None])
+        value = np.column_stack(
+                [np.bincount(group, weights=prices[:, i], minlength=n)
+                 for i in range(prices.shape[1])]) \
+                if n else np.zeros((0, prices.shape[1]))
+        return cls(users, np.bincount(group, minlength=n),
+                   np.bincount(group, weights=cost, minlength=n), value)
+
+    @classmethod
+    def load(cls, queryset=None):
+        """Value the collections of the owners of some Pokemon.
+
+        :param queryset: The Pokemon to load, defaults to every owned
+            Pokemon. Filter it by owner to value a few users.
+        :type queryset: class`QuerySet`
+        :rtype: class`Valuation`
+        """
+        if queryset is None:
+            queryset = Pokemon.objects.all()
+        rows = queryset.filter(owner__isnull=False).order_by() \
+                .values_list("owner_id", "cost_price", *PRICE_SOURCES) \
+                .iterator(chunk_size=settings.POKETRADE_EXPORT_CHUNK_SIZE)
+        cols = np.fromiter(rows, dtype=_DTYPE)
+        prices = np.column_stack([cols[src] for src in PRICE_SOURCES]) \
+                if len(cols) else np.zeros((0, len(PRICE_SOURCES)))
+        return cls.from_columns(cols["owner"], cols["cost"], prices)
+
+    def for_user(self, pk):
+        """Get the valuation of a user.
+
+        :param pk: The user's id
+        :type pk: int
+        :return: A dict of cards, cost and value and profit by source,
+            or None if the user has no cards
+        :rtype: dict
+        """
+        i = np.searchsorted(self.users, pk)
+        if i == len(self.users) or self.users[i] != pk:
+            return None
+        profit = self.profit[i]
+        return {"cards": int(self.cards[i]),
+                "cost": float(self.cost[i]),
+                "sources": [{"source": src,
+                             "value": float(self.value[i, j]),
+                             "profit": float(profit[j])}
+                            for j, src in enumerate(PRICE_SOURCES)]}
+
+    def top(self, source, by="value", limit=10):
+        """Rank users by the value or profit of their collections.
+
+        :param source: The price source, one of ``PRICE_SOURCES``
+        :type source: str
+        :param by: "value" or "profit"
+        :type by: str
+        :param limit: The number of users to return
+        :type limit: int
+        :return: A list of (user id, cards, cost, value, profit) tuples,
+            the best first
+        :rtype: list
+        """
+        j = PRICE_SOURCES.index(source)
+        profit = self.profit[:, j]
+        key = self.value[:, j] if by == "value" else profit
+        limit = min(limit, len(key))
+        if not limit:
+            return []
+        # partial sort - only the top ones need ordering
+        idx = np.argpartition(-key, limit - 1)[:limit]
+        idx = idx[np.lexsort((self.users[idx], -key[idx]))]
+        return [(int(self.users[i]), int(self.cards[i]),
+                 float(self.cost[i]), float(self.value[i, j]),
+                 float(profit[i])) for i in idx]
+
+    def report(self, limit=None):
+        """Make the leaderboards of every source and ranking, and the
+        valuation of every user (by id, as a string).
+
+        :param limit: The number of users per leaderboard, defaults to
+            ``POKETRADE_LEADERBOARD_SIZE``
+        :type limit: int
+        :return: A JSON-serializable dict
+        :rtype: dict
+        """
+        limit = limit or settings.POKETRADE_LEADERBOARD_SIZE
+        boards = {src: {by: self.top(src, by, limit) for by in RANKINGS}
+                  for src in PRICE_SOURCES}
+        ids = {row[0] for board in boards.values()
+               for rows in board.values() for row in rows}
+        names = dict(User.objects.filter(pk__in=ids)
+                     .values_list("pk", "username"))
+        profit = self.profit
+        return {
+            "generated_at": timezone.now().isoformat(),
+            "users": len(self.users),
+            "totals": {src: {"value": float(self.value[:, j].sum()),
+                             "profit": float(profit[:, j].sum())}
+                       for j, src in enumerate(PRICE_SOURCES)},
+            "leaderboards": {
+                src: {by: [{"user": pk, "username": names.get(pk),
+                            "cards": cards, "cost": cost, "value": value,
+                            "profit": gain}
+                           for pk, cards, cost, value, gain in rows]
+                      for by, rows in board.items()}
+                for src, board in boards.items()},
+            "portfolios": {str(pk): self.for_user(pk)
+                           for pk in self.users.tolist()},
+        }
+
+
+def load_report(path=None):
+    """Read the report of the last ``valuationreport``.
+
+    The file is only parsed again once it changes.
+
+    :param path: The report, defaults to ``POKETRADE_VALUATION_REPORT``
+    :type path: str
+    :return: The report, or None if there is none
+    :rtype: dict
+    """
+    path = path or settings.POKETRADE_VALUATION_REPORT
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    report = _report_memo.get((path, mtime))
+    if report is None:
+        with open(path) as f:
+            report = json.load(f)
+        _report_memo.clear()
+        _report_memo[(path, mtime)] = report
+    return report
+
+
+def latest_report():
+    """Get the latest report, without making one.
+
+    :return: The report of the last ``valuationreport``, or the one
+        last computed on demand, or None
+    :rtype: dict
+    """
+    report = load_report()
+    if report is None:
+        report = cache.get(_CACHE_KEY)
+    return report
+
+
+def portfolio(pk, report=None):
+    """Get the valuation of a user from the latest report.
+
+    :param pk: The user's id
+    :type pk: int
+    :param report: The report, defaults to ``latest_report()``
+    :type report: dict
+    :return: A dict as made by ``Valuation.for_user``, or None if the
+        user had no cards or there is no report
+    :rtype: dict
+    """
+    report = latest_report() if report is None else report
+    return (report or {}).get("portfolios", {}).get(str(pk))
+
+
+def leaderboard():
+    """Get the latest leaderboards.
+
+    :return: A report, as made by ``Valuation.report``
+    :rtype: dict
+    """
+    report = latest_report()
+    if report is None:
+        report = Valuation.load().report()
+        cache.set(_CACHE_KEY, report,
+                  settings.POKETRADE_VALUATION_CACHE_SECONDS)
+    return report
@@ -6,46 +6,89 @@ be under the Trading app.
 
 __all__ = ["PokemonListView", "PokemonDetailView",
            "UserPokemonListView", "BuyPokemonView",
-           "UpdateSellPriceView"]
+           "UpdateSellPriceView", "AutocompleteView",
+           "PokemonExportView", "CollectionExportView",
+           "CollectionChangesView", "PriceHistoryView"]
 __author__ = "Advaith Menon"
 
+import datetime
+import time
+
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.views import View
 from django.views.generic import ListView
 from django.views.generic.detail import DetailView
 from django.views.generic.base import TemplateView
 from django.views.generic.edit import UpdateView
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_protect
 from django.shortcuts import get_object_or_404, reverse
-from django.db.models import Q
+from django.db.models import Max, Min, Q
+from django.utils.http import urlencode
 
-from .models import Pokemon, TradingPolicy
-from .helpers import QueryParser, QueryableMixin
+from poketrade2.metrics import LIST_LATENCY, PURCHASES, \
+        PURCHASE_FAILURES
+from . import evolution
+from .autocomplete import INDEX
+from .export import ExportMixin
+from .models import CollectionChange, Pokemon, TradingPolicy
+from .pricehistory import series
+from .similarity import INDEX as SIMILAR
+from .helpers import ConditionalGetMixin, QueryParser, QueryableMixin
 
 
-class PokemonListView(QueryableMixin, ListView):
+class PokemonListView(QueryableMixin, ConditionalGetMixin, ListView):
     """Lists all Pokemon.
     """
     # template name is trading/pokemon_list.html
     # the default ^^ is okay
     model = Pokemon
     context_object_name = "pokemons"
+    # browse traffic - may be served from a read replica
+    replica_reads = True
     paginate_by = 100
 
     # defines the custom query
     generic_qparse = QueryParser(valid_fields={"name": str, "hp": int,
                             "rarity": str, "sell_price": float,
-                            "owner__username": str})
+                            "owner__username": str, "evolves_from": str},
+                            virtual_fields={
+                                "evolution_line": (str, evolution.line)})
+    # o= - see Pokemon.Meta.indexes
+    sort_fields = {"sell_price": "sell_price", "hp": "hp", "name": "name",
+                   "rarity": "rarity", "recent": "-updated_at"}
+
+    def get(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().get(request, *args, **kwargs)
+
+        def observe(response):
+            LIST_LATENCY.observe(time.perf_counter() - start)
+        if hasattr(response, "add_post_render_callback"):
+            # time the lazy render too
+            response.add_post_render_callback(observe)
+        else:
+            # 304s are never rendered
+            observe(response)
+        return response
 
 
-class UserPokemonListView(QueryableMixin, LoginRequiredMixin, ListView):
+class UserPokemonListView(QueryableMixin, LoginRequiredMixin,
+                          ConditionalGetMixin, ListView):
     """Lists a single users' Pokemon.
     """
     model = Pokemon
     context_object_name = "pokemons"
+    # browse traffic - may be served from a read replica
+    replica_reads = True
     paginate_by = 100
+    generic_qparse = PokemonListView.generic_qparse
+    sort_fields = PokemonListView.sort_fields
 
     def get_queryset(self):
         # print("kwe:", type(self.kwargs.get("pk")))
@@ -68,13 +111,16 @@ class BuyPokemonView(LoginRequiredMixin, TemplateView):
 
     def post(self, request, *args, **kwargs):
         pok_id = self.kwargs["pk"]
-        pok_obj = get_object_or_404(Pokemon, Q(pk=pok_id)
+        pok_obj = get_object_or_404(Pokemon.objects.select_related("owner"),
+                                    Q(pk=pok_id)
                                     & ~Q(owner=self.request.user))
         if pok_obj.trading_policy != TradingPolicy.FOR_SALE:
+            PURCHASE_FAILURES.inc(reason="not_for_sale")
             raise PermissionDenied
 
         # subtract its sell price to your account
         if self.request.user.coins < pok_obj.sell_price:
+            PURCHASE_FAILURES.inc(reason="insufficient_coins")
             raise PermissionDenied("Not enough couns to buy Pokemon")
         self.request.user.coins -= pok_obj.sell_price
 
@@ -95,6 +141,7 @@ class BuyPokemonView(LoginRequiredMixin, TemplateView):
         # save both
         self.request.user.save()
         pok_obj.save()
+        PURCHASES.inc()
         return super().get(request, *args, **kwargs)
 
 
@@ -111,7 +158,8 @@ class UpdateSellPriceView(LoginRequiredMixin, UpdateView):
         pokemon
         """
         obj = super().get_object(*args, **kw)
-        if obj.owner != self.request.user:
+        # compare ids, so that the owner is not fetched
+        if obj.owner_id != self.request.user.pk:
             # malicious user
             raise PermissionDenied
         return obj
@@ -126,8 +174,198 @@ class UpdateSellPriceView(LoginRequiredMixin, UpdateView):
         return reverse("trading:list")
 
 
-class PokemonDetailView(DetailView):
+class PokemonDetailView(ConditionalGetMixin, DetailView):
+    """Shows a Pokemon with its owner, abilities and attacks.
+
+    The Pokemon and everything shown with it are loaded in three
+    queries and cached per version and save time of the card and its
+    owner, so repeat views only check those. Abilities and attacks are
+    written on import only - save the Pokemon after changing them.
+    """
     # template: trading/pokemon_detail.html
     model = Pokemon
     context_object_name = "the_pokemon"
+    # browse traffic - may be served from a read replica
+    replica_reads = True
+    _cache_key = None
+
+    def get_version_token(self):
+        row = Pokemon.objects.filter(pk=self.kwargs["pk"]) \
+                .values_list("version", "owner__updated_at", "updated_at") \
+                .first()
+        if row is None:
+            return None
+        # the save time too - versions are bumped in Python, so two
+        # concurrent saves may write the same one. The page shows the
+        # owner, so their saves change it too (by time - User versions
+        # may repeat, see User.add_stats).
+        token = "%s:%s:%s" % (row[0], row[2].timestamp(),
+                              row[1] and row[1].timestamp())
+        self._cache_key = "trading:pokemon_detail:%s:%s" % (
+                self.kwargs["pk"], token)
+        # the similar cards and evolution chain are not cached, but
+        # change the page - and so the ETag - all the same
+        return "%s:%s:%s" % (token, SIMILAR.version(),
+                             evolution.evolution_generation()), row[2]
+
+    def get_queryset(self):
+        return super().get_queryset().select_related("owner") \
+                .prefetch_related("ability_set", "attack_set")
+
+    def get_object(self, queryset=None):
+        obj = cache.get(self._cache_key) if self._cache_key else None
+        if obj is None:
+            obj = super().get_object(queryset)
+            # hashed once per version, not per view
+            obj.owner_avatar = obj.owner.gravatar_64 if obj.owner else None
+            if self._cache_key:
+                # keys are versioned - the timeout only evicts unused ones
+                cache.set(self._cache_key, obj,
+                          settings.POKETRADE_FRAGMENT_CACHE_TIMEOUT)
+        return obj
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ranked = [pk for pk, _ in SIMILAR.similar(self.object.pk)]
+        found = Pokemon.objects.only("card", "version").in_bulk(ranked)
+        ctx["similar"] = [found[pk] for pk in ranked if pk in found]
+        ctx["evolution"] = evolution.chain(self.object.name)
+        for stage in ctx["evolution"]:
+            stage["url"] = self._search_url("name", stage["relative"])
+        ctx["evolution_line_url"] = self._search_url("evolution_line",
+                                                     self.object.name)
+        return ctx
+
+    @staticmethod
+    def _search_url(field, name):
+        """Link to the cards whose field is a name."""
+        return "%s?%s" % (reverse("trading:list"), urlencode(
+                {"q": "%s,IDENT,%s" % (field, QueryParser.tangle(name))}))
+
+
+class PokemonExportView(ExportMixin, QueryableMixin, View):
+    """Streams all Pokemon, or those matching a search.
+
+    Takes the same ``q``, ``s`` and ``o`` as the list.
+    """
+    model = Pokemon
+    generic_qparse = PokemonListView.generic_qparse
+    sort_fields = PokemonListView.sort_fields
+
+
+class CollectionExportView(LoginRequiredMixin, ExportMixin, QueryableMixin,
+                           View):
+    """Streams the Pokemon of the logged-in user.
+    """
+    model = Pokemon
+    generic_qparse = PokemonListView.generic_qparse
+    sort_fields = PokemonListView.sort_fields
+    export_name = "collection"
+
+    def get_queryset(self):
+        return super().get_queryset().filter(owner=self.request.user)
+
+
+class CollectionChangesView(LoginRequiredMixin, View):
+    """Returns the changes to the user's collection since a token.
+
+    Clients send the ``token`` of their last sync as ``since`` and get
+    the cards added, modified and removed since then, and a new token.
+    Without ``since``, or if the token is too old (its changes were
+    pruned), ``resync`` is true and every card is returned as added -
+    the client should replace what it has.
+    """
+    http_method_names = ["get", "head", "options"]
+    # fields of the cards returned - changes of any are logged
+    fields = ("id", *CollectionChange.TRACKED_FIELDS, "version")
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = int(request.GET.get("since") or -1)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid token",
+                                          content_type="text/plain")
+        # read the token first - anything changing while the cards
+        # are read is sent again next time
+        agg = CollectionChange.objects.aggregate(first=Min("id"),
+                                                 last=Max("id"))
+        last = agg["last"] or 0
+        # changes up to here were pruned
+        floor = (agg["first"] or 1) - 1
+        cards = Pokemon.objects.filter(owner=request.user)
+
+        if not floor <= since <= last:
+            return JsonResponse({
+                "token": str(last),
+                "resync": True,
+                "added": list(cards.order_by("pk").values(*self.fields)),
+                "modified": [],
+                "removed": [],
+            })
+
+        # the first change of each card tells if the client has it
+        first = dict()
+        for pid, kind in request.user.collection_changes \
+                .filter(id__gt=since, id__lte=last).order_by("id") \
+                .values_list("pokemon_id", "kind"):
+            first.setdefault(pid, kind)
+        current = {x["id"]: x for x in cards.filter(pk__in=first)
+                   .values(*self.fields)} if first else {}
+
+        rv = {"token": str(last), "resync": False, "added": [],
+              "modified": [], "removed": []}
+        for pid, kind in first.items():
+            if pid in current:
+                rv["added" if kind == CollectionChange.Kind.ADDED
+                   else "modified"].append(current[pid])
+            elif kind != CollectionChange.Kind.ADDED:
+                # added and removed since - the client never had it
+                rv["removed"].append(pid)
+        return JsonResponse(rv)
+
+
+class PriceHistoryView(View):
+    """Returns the price history of a Pokemon as JSON.
+
+    Recent prices are daily, older ones weekly and monthly averages.
+    ``since=YYYY-MM-DD`` skips older periods.
+    """
+    http_method_names = ["get", "head", "options"]
+    # browse traffic - may be served from a read replica
+    replica_reads = True
+
+    def get(self, request, *args, **kwargs):
+        since = request.GET.get("since")
+        try:
+            since = datetime.date.fromisoformat(since) if since else None
+        except ValueError:
+            return HttpResponseBadRequest("Invalid date",
+                                          content_type="text/plain")
+        rows = series(self.kwargs["pk"], since)
+        if not rows and not Pokemon.objects.filter(
+                pk=self.kwargs["pk"]).exists():
+            raise Http404("No such Pokemon")
+        return JsonResponse({"pokemon": self.kwargs["pk"],
+                             "series": rows})
+
+
+class AutocompleteView(View):
+    """Suggests completions for the search box, as JSON.
+
+    Takes the prefix as ``q`` and the number of suggestions as ``n``.
+    Served from memory, see ``trading.autocomplete``.
+    """
+    http_method_names = ["get", "head", "options"]
 
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = int(request.GET.get("n", 10))
+        except ValueError:
+            limit = 10
+        prefix = request.GET.get("q", "")
+        return JsonResponse({
+            "q": prefix,
+            "suggestions": [{"kind": kind, "text": text, "weight": weight}
+                            for kind, text, weight
+                            in INDEX.lookup(prefix, limit)],
+        })